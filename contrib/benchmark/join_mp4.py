@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+
+"""Measures the time join_mp4 spends on the sample tables of large moovs.
+
+Synthetic MP4 parts are made with an H.264 and an AAC track of the given
+length, each sample in its own chunk as in the worst real files, and tiny
+samples so that the tables and not the payloads are measured. 'parse' is
+the reading of the parts, 'merge' the merging of their moovs and 'write'
+the writing of the merged moov.
+
+    PYTHONPATH=src python contrib/benchmark/join_mp4.py --minutes 120
+"""
+
+import argparse
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import time
+from io import BytesIO
+
+from you_get.processor import join_mp4
+
+def box(type, body):
+    return struct.pack('>I', 8 + len(body)) + type + body
+
+def full_box(type, body, flags=0):
+    return box(type, struct.pack('>I', flags) + body)
+
+def table(type, entries, format='>I'):
+    return full_box(type, struct.pack('>I', len(entries)) +
+                    b''.join(struct.pack(format, *e) for e in entries))
+
+def trak(track_id, handler, time_scale, delta, samples, offsets):
+    n = len(samples)
+    if handler == b'vide':
+        entry = box(b'avc1', bytes(6) + struct.pack('>H', 1) + bytes(16) +
+                    struct.pack('>HHII', 1920, 1080, 72 << 16, 72 << 16) +
+                    bytes(4) + struct.pack('>H', 1) + bytes(32) +
+                    struct.pack('>H', 24) + b'\xff\xff' +
+                    box(b'avcC', bytes(16)))
+        header = full_box(b'vmhd', bytes(8), 1)
+        extra = [table(b'stss', [(i,) for i in range(1, n + 1, 60)]),
+                 table(b'ctts', [(1, delta * (i % 3)) for i in range(n)],
+                       '>II')]
+    else:
+        entry = box(b'mp4a', bytes(6) + struct.pack('>H', 1) + bytes(8) +
+                    struct.pack('>HH', 2, 16) + bytes(4) +
+                    struct.pack('>H', 44100) + bytes(2) +
+                    full_box(b'esds', bytes(27)))
+        header = full_box(b'smhd', bytes(4))
+        extra = []
+    stbl = box(b'stbl', b''.join([
+        full_box(b'stsd', struct.pack('>I', 1) + entry),
+        table(b'stts', [(n, delta)], '>II'),
+    ] + extra + [
+        table(b'stsc', [(1, 1, 1)], '>III'),
+        full_box(b'stsz', struct.pack('>II', 0, n) +
+                 struct.pack('>%dI' % n, *samples)),
+        table(b'stco', [(o,) for o in offsets]),
+    ]))
+    dinf = box(b'dinf', full_box(b'dref', struct.pack('>I', 1) +
+                                 full_box(b'url ', b'', 1)))
+    mdia = box(b'mdia', b''.join([
+        full_box(b'mdhd', struct.pack('>IIIIHH', 0, 0, time_scale,
+                                      n * delta, 0x55c4, 0)),
+        full_box(b'hdlr', bytes(4) + handler + bytes(12) + b'\0'),
+        box(b'minf', header + dinf + stbl),
+    ]))
+    tkhd = full_box(b'tkhd', struct.pack('>IIIII', 0, 0, track_id, 0,
+                                         n * delta) +
+                    bytes(16) + bytes(36) + struct.pack('>II', 0, 0), 3)
+    return box(b'trak', tkhd + mdia)
+
+def make_mp4(path, minutes):
+    video = [1 + i % 7 for i in range(minutes * 60 * 30)]
+    audio = [1 + i % 5 for i in range(minutes * 60 * 44100 // 1024)]
+    ftyp = box(b'ftyp', b'isom\0\0\2\0isomavc1')
+    mvhd = full_box(b'mvhd', struct.pack('>IIII', 0, 0, 1000,
+                                         minutes * 60000) +
+                    struct.pack('>IH', 0x10000, 0x100) + bytes(10 + 36 + 24) +
+                    struct.pack('>I', 3))
+
+    def moov(start):
+        offsets = [[], []]
+        for i, size in enumerate(video + audio):
+            offsets[i >= len(video)].append(start)
+            start += size
+        return box(b'moov', mvhd +
+                   trak(1, b'vide', 30000, 1001, video, offsets[0]) +
+                   trak(2, b'soun', 44100, 1024, audio, offsets[1]))
+
+    moov_size = len(moov(0))
+    with open(path, 'wb') as f:
+        f.write(ftyp + moov(len(ftyp) + moov_size + 8))
+        f.write(box(b'mdat', bytes(sum(video) + sum(audio))))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--minutes', type=int, default=120,
+                        help='length of each part')
+    parser.add_argument('--parts', type=int, default=2)
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        files = [os.path.join(tmpdir, '%d.mp4' % i) for i in range(args.parts)]
+        for path in files:
+            make_mp4(path, args.minutes)
+        stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+        try:
+            start = time.process_time()
+            ins = [open(path, 'rb') for path in files]
+            mp4s = [join_mp4.read_mp4(f) for f in ins]
+            parse = time.process_time() - start
+            start = time.process_time()
+            # the parts start with an ftyp, then the moov
+            moov = join_mp4.merge_moov([m[1] for m in mp4s],
+                                       [m[2] for m in mp4s],
+                                       mp4s[0][0][0].size)
+            merge = time.process_time() - start
+            start = time.process_time()
+            moov.write(BytesIO())
+            write = time.process_time() - start
+            for f in ins:
+                f.close()
+        finally:
+            sys.stdout = stdout
+        print('%d parts, moov of %.1f MB each' % (
+            args.parts, mp4s[0][1].size / 1024 ** 2
+        ))
+        print('parse %6.2f s\nmerge %6.2f s\nwrite %6.2f s' % (
+            parse, merge, write
+        ))
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+
+"""Measures the time muxing a video and an audio file takes, natively
+(processor.mux) and with ffmpeg, which decides the MUXERS flags.
+
+The files are those of a DASH stream, as downloaded with --no-merge, or
+synthetic ones of the given length, whose payloads are random bytes: an
+MP4 and a WebM pair, of 2 Mbit/s video and 128 kbit/s audio. ffmpeg may
+refuse the synthetic files, whose payloads cannot be decoded; it is
+skipped where it is not installed.
+
+    PYTHONPATH=src python contrib/benchmark/mux.py --minutes 30
+    PYTHONPATH=src python contrib/benchmark/mux.py video.webm audio.webm
+"""
+
+import argparse
+import os
+import resource
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+from you_get.processor import mux
+
+VIDEO_SAMPLE = 2000000 // 8 // 30
+AUDIO_SAMPLE = 128000 // 8 // 50
+PAYLOAD = os.urandom(VIDEO_SAMPLE)
+
+def box(type, body):
+    return struct.pack('>I', 8 + len(body)) + type + body
+
+def full_box(type, body, flags=0):
+    return box(type, struct.pack('>I', flags) + body)
+
+def table(type, entries, format='>I'):
+    return full_box(type, struct.pack('>I', len(entries)) +
+                    b''.join(struct.pack(format, *e) for e in entries))
+
+def make_mp4(path, handler, seconds):
+    # samples of 1/30 s of video or 1/50 s of audio, a second per chunk
+    rate, size = (30, VIDEO_SAMPLE) if handler == b'vide' \
+        else (50, AUDIO_SAMPLE)
+    n = seconds * rate
+    if handler == b'vide':
+        entry = box(b'avc1', bytes(6) + struct.pack('>H', 1) + bytes(16) +
+                    struct.pack('>HHII', 1920, 1080, 72 << 16, 72 << 16) +
+                    bytes(4) + struct.pack('>H', 1) + bytes(32) +
+                    struct.pack('>H', 24) + b'\xff\xff' +
+                    box(b'avcC', b'\x01\x64\x00\x28\xff\xe0\x00'))
+        header = full_box(b'vmhd', bytes(8), 1)
+    else:
+        entry = box(b'mp4a', bytes(6) + struct.pack('>H', 1) + bytes(8) +
+                    struct.pack('>HH', 2, 16) + bytes(4) +
+                    struct.pack('>H', 48000) + bytes(2) +
+                    full_box(b'esds', bytes(27)))
+        header = full_box(b'smhd', bytes(4))
+    ftyp = box(b'ftyp', b'isom\0\0\2\0isomavc1')
+    start = len(ftyp) + 8
+    offsets = [(start + i * rate * size,) for i in range(seconds)]
+    stbl = box(b'stbl', b''.join([
+        full_box(b'stsd', struct.pack('>I', 1) + entry),
+        table(b'stts', [(n, 1000 // rate)], '>II'),
+        table(b'stsc', [(1, rate, 1)], '>III'),
+        full_box(b'stsz', struct.pack('>II%dI' % n, 0, n, *[size] * n)),
+        table(b'stco', offsets),
+    ]))
+    dinf = box(b'dinf', full_box(b'dref', struct.pack('>I', 1) +
+                                 full_box(b'url ', b'', 1)))
+    mdia = box(b'mdia', b''.join([
+        full_box(b'mdhd', struct.pack('>IIIIHH', 0, 0, 1000, seconds * 1000,
+                                      0x55c4, 0)),
+        full_box(b'hdlr', bytes(4) + handler + bytes(12) + b'\0'),
+        box(b'minf', header + dinf + stbl),
+    ]))
+    tkhd = full_box(b'tkhd', struct.pack('>IIIII', 0, 0, 1, 0,
+                                         seconds * 1000) + bytes(60), 3)
+    mvhd = full_box(b'mvhd', struct.pack('>IIII', 0, 0, 1000,
+                                         seconds * 1000) +
+                    struct.pack('>IH', 0x10000, 0x100) + bytes(70) +
+                    struct.pack('>I', 2))
+    with open(path, 'wb') as f:
+        f.write(ftyp + box(b'mdat', b''))
+        for _ in range(n):
+            f.write(PAYLOAD[:size])
+        f.write(box(b'moov', mvhd + box(b'trak', tkhd + mdia)))
+        # the size of the mdat, once known
+        f.seek(len(ftyp))
+        f.write(struct.pack('>I', 8 + n * size))
+
+def make_webm(path, codec, seconds):
+    # a cluster a second, of blocks of 1/30 s of video or 1/50 s of audio
+    rate, size = (30, VIDEO_SAMPLE) if codec == b'V_VP9' \
+        else (50, AUDIO_SAMPLE)
+    info = mux.elements([(mux.TIMECODE_SCALE, mux.uint(1000000)),
+                         (mux.DURATION, struct.pack('>d', seconds * 1000))])
+    track = mux.elements([(mux.TRACK_NUMBER, mux.uint(1)),
+                          (mux.TRACK_UID, mux.uint(1)),
+                          # TrackType, CodecID
+                          (0x83, mux.uint(1 if codec == b'V_VP9' else 2)),
+                          (0x86, codec)])
+    with open(path, 'wb') as f:
+        f.write(mux.element(mux.EBML, mux.elements([(0x4282, b'webm')])))
+        # of unknown size, running to the end of the file
+        f.write(mux.uint(mux.SEGMENT) + b'\xff')
+        f.write(mux.element(mux.INFO, info))
+        f.write(mux.element(mux.TRACKS, mux.element(mux.TRACK_ENTRY, track)))
+        for second in range(seconds):
+            f.write(mux.element(mux.CLUSTER, mux.elements(
+                [(mux.TIMECODE, mux.uint(second * 1000))] +
+                # track 1, at its time in the cluster, a keyframe
+                [(mux.SIMPLE_BLOCK, b'\x81' + struct.pack(
+                    '>hB', i * 1000 // rate, 0x80
+                ) + PAYLOAD[:size]) for i in range(rate)]
+            )))
+
+def mux_native(files, output, ext):
+    # without the names of the files read_mp4() prints
+    stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+    try:
+        mux.MUXERS[ext][0](files, output)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+def mux_ffmpeg(files, output, ext):
+    params = ['ffmpeg', '-loglevel', 'error', '-y']
+    for path in files:
+        params.extend(['-i', path])
+    params.extend(['-c', 'copy', output])
+    return subprocess.call(params, stdin=subprocess.DEVNULL) == 0
+
+def measure(function, *args):
+    # the CPU time of ffmpeg is that of the children
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu, wall = time.process_time(), time.time()
+    ok = function(*args) is not False
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu = time.process_time() - cpu + children.ru_utime - usage.ru_utime + \
+        children.ru_stime - usage.ru_stime
+    return ok, cpu, time.time() - wall
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('files', nargs='*', help='a video and an audio file')
+    parser.add_argument('--minutes', type=int, default=30,
+                        help='length of the synthetic files')
+    parser.add_argument('--runs', type=int, default=3)
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        if args.files:
+            ext = os.path.splitext(args.files[0])[1][1:]
+            pairs = [(ext, args.files)]
+        else:
+            seconds = args.minutes * 60
+            pairs = []
+            for ext, make, video, audio in [
+                    ('mp4', make_mp4, b'vide', b'soun'),
+                    ('webm', make_webm, b'V_VP9', b'A_OPUS')]:
+                files = [os.path.join(tmpdir, 'video.' + ext),
+                         os.path.join(tmpdir, 'audio.' + ext)]
+                make(files[0], video, seconds)
+                make(files[1], audio, seconds)
+                pairs.append((ext, files))
+        muxers = [('native', mux_native)]
+        if shutil.which('ffmpeg'):
+            muxers.append(('ffmpeg', mux_ffmpeg))
+        for ext, files in pairs:
+            size = sum(map(os.path.getsize, files))
+            print('%s, %.1f MB' % (ext, size / 1024 ** 2))
+            for name, function in muxers:
+                cpu = wall = 0
+                for run in range(args.runs):
+                    output = os.path.join(tmpdir, 'muxed.' + ext)
+                    ok, run_cpu, run_wall = measure(function, files, output,
+                                                    ext)
+                    if os.path.exists(output):
+                        os.remove(output)
+                    if not ok:
+                        break
+                    cpu += run_cpu
+                    wall += run_wall
+                if not ok:
+                    print('  %-7s failed' % name)
+                    continue
+                print('  %-7s %6.2f CPU s %6.2f s %8.1f MB/s' % (
+                    name, cpu / args.runs, wall / args.runs,
+                    size * args.runs / wall / 1024 ** 2
+                ))
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+
+"""Measures the CPU time url_save() spends per GB received.
+
+A local server (in a separate process, so its CPU time is not counted)
+serves the data. 'read1' is the former receive loop, which allocates a new
+bytes object for every read, 'receiver' the receive loop of the
+downloaders (common.Receiver), which reads into a reused buffer, and
+'url_save' the whole function.
+
+    PYTHONPATH=src python contrib/benchmark/url_save.py --size 1024
+"""
+
+import argparse
+import http.server
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+from urllib import request
+
+from you_get import common
+
+BLOCK = os.urandom(1024 * 1024)
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        size = self.server.size
+        self.send_response(200)
+        self.send_header('Content-Type', 'video/mp4')
+        self.send_header('Content-Length', str(size))
+        self.end_headers()
+        for _ in range(size // len(BLOCK)):
+            self.wfile.write(BLOCK)
+
+def serve(size, port):
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.size = size
+    port.put(server.server_address[1])
+    server.serve_forever()
+
+def receive_read1(url, filepath):
+    response = common.urlopen_with_retry(request.Request(url))
+    with open(filepath, 'wb') as output:
+        while True:
+            buffer = response.read1(1024 * 256)
+            if not buffer:
+                break
+            output.write(buffer)
+
+def receive_receiver(url, filepath):
+    response = common.urlopen_with_retry(request.Request(url))
+    with open(filepath, 'wb') as output:
+        common.Receiver(url, output).receive(response)
+
+def receive_url_save(url, filepath):
+    common.url_save(url, filepath, None)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--size', type=int, default=512, help='MB per run')
+    parser.add_argument('--runs', type=int, default=3)
+    args = parser.parse_args()
+
+    size = args.size * len(BLOCK)
+    port = multiprocessing.Queue()
+    server = multiprocessing.Process(target=serve, args=(size, port),
+                                     daemon=True)
+    server.start()
+    url = 'http://127.0.0.1:%d/video.mp4' % port.get()
+    # without force, as downloads are usually made, each run to a new file
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for name, receive in [('read1', receive_read1),
+                              ('receiver', receive_receiver),
+                              ('url_save', receive_url_save)]:
+            cpu = wall = 0
+            for run in range(args.runs):
+                filepath = os.path.join(tmpdir, '%s-%d.mp4' % (name, run))
+                cpu_start, wall_start = time.process_time(), time.time()
+                receive(url, filepath)
+                cpu += time.process_time() - cpu_start
+                wall += time.time() - wall_start
+                os.remove(filepath)
+            gb = size * args.runs / 1024 ** 3
+            print('%-10s %6.2f CPU s/GB %8.1f MB/s' % (
+                name, cpu / gb, size * args.runs / wall / 1024 ** 2
+            ))
+    finally:
+        shutil.rmtree(tmpdir)
+        server.terminate()
+
+if __name__ == '__main__':
+    sys.exit(main())
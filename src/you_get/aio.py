@@ -0,0 +1,565 @@
+#!/usr/bin/env python
+
+"""HTTP/1.1 client on asyncio, used instead of urllib with --engine asyncio.
+
+All requests run on one event loop in a background thread. urlopen() hands
+out blocking responses that look like those of urllib, so that get_content()
+and url_save() work unchanged, while save_parts() downloads many files
+concurrently within the loop itself.
+"""
+
+import asyncio
+import itertools
+import logging
+import os
+import socket
+import threading
+import time
+from email.parser import BytesParser
+from http import client
+from urllib import error, parse, request
+
+from . import common
+from .util.retry import STREAM_ERRORS
+
+MAX_REDIRECTS = 10
+idle_timeout = 30
+stats = {'new': 0, 'reused': 0}
+
+_loop = None
+_loop_lock = threading.Lock()
+_idle = {}
+
+def get_loop():
+    """Returns the event loop of the engine, starting it if needed."""
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, daemon=True).start()
+    return _loop
+
+def run(coro):
+    """Runs a coroutine on the engine's loop and waits for its result."""
+    return asyncio.run_coroutine_threadsafe(coro, get_loop()).result()
+
+async def _wait(aw, timeout):
+    try:
+        return await asyncio.wait_for(aw, timeout)
+    except asyncio.TimeoutError:
+        raise socket.timeout('timed out')
+
+def supports(url, session):
+    """Whether the engine can send a request for url in session: HTTPS
+    through a proxy needs StreamWriter.start_tls(), from Python 3.11, and
+    goes through urllib before.
+    """
+    if hasattr(asyncio.StreamWriter, 'start_tls'):
+        return True
+    url = parse.urlsplit(url)
+    return url.scheme.lower() != 'https' or \
+        _get_proxy('https', url.hostname, session.proxies) is None
+
+def _get_proxy(scheme, host, proxies):
+    if proxies is None:
+        # system default setting
+        proxies = request.getproxies()
+        if proxies and request.proxy_bypass(host):
+            return None
+    proxy = proxies.get(scheme)
+    if not proxy:
+        return None
+    if '://' not in proxy:
+        proxy = 'http://' + proxy
+    proxy = parse.urlsplit(proxy)
+    return proxy.hostname, proxy.port or 80
+
+async def _read_head(reader, timeout):
+    status_line = await _wait(reader.readline(), timeout)
+    if not status_line:
+        raise client.RemoteDisconnected('Remote end closed connection')
+    try:
+        version, status, reason = (
+            status_line.decode('iso-8859-1').rstrip('\r\n') + ' '
+        ).split(' ', 2)
+        status = int(status)
+    except ValueError:
+        raise client.BadStatusLine(status_line)
+    lines = []
+    while True:
+        line = await _wait(reader.readline(), timeout)
+        if line in (b'\r\n', b'\n', b''):
+            break
+        lines.append(line)
+    headers = BytesParser(_class=client.HTTPMessage).parsebytes(
+        b''.join(lines)
+    )
+    return version, status, reason.strip(), headers
+
+async def _open_tcp(host, port, timeout, **kwargs):
+    # asyncio.open_connection(), resolving through common.dns_cache
+    infos = await asyncio.get_running_loop().run_in_executor(
+        None, common.dns_cache.getaddrinfo, host, port, 0, socket.SOCK_STREAM
+    )
+    err = None
+    for af, _, _, _, sa in infos:
+        try:
+            return await _wait(asyncio.open_connection(
+                sa[0], sa[1], family=af, **kwargs
+            ), timeout)
+        except OSError as e:
+            err = e
+    common.dns_cache.forget(host)
+    raise err or OSError('getaddrinfo returns an empty list')
+
+async def _open_connection(scheme, host, port, proxy, insecure, timeout):
+    ctx = common.get_ssl_context(insecure) if scheme == 'https' else None
+    if proxy is None:
+        start = time.time()
+        reader, writer = await _open_tcp(
+            host, port, timeout, ssl=ctx, server_hostname=host if ctx else None
+        )
+        if ctx is not None:
+            logging.debug('TCP connect and TLS handshake with %s: %.1f ms' % (
+                host, (time.time() - start) * 1000
+            ))
+        return reader, writer, False
+
+    if ctx is not None and not hasattr(asyncio.StreamWriter, 'start_tls'):
+        # reached by a redirect, as supports() keeps the others out
+        raise OSError('HTTPS through a proxy needs Python 3.11 with the '
+                      'asyncio engine')
+    reader, writer = await _open_tcp(*proxy, timeout=timeout)
+    if ctx is None:
+        # plain HTTP through a proxy: send absolute URIs
+        return reader, writer, True
+    writer.write(('CONNECT %s:%s HTTP/1.1\r\nHost: %s:%s\r\n\r\n' % (
+        host, port, host, port
+    )).encode('ascii'))
+    _, status, reason, _ = await _read_head(reader, timeout)
+    if status != 200:
+        writer.close()
+        raise OSError('Tunnel connection failed: %d %s' % (status, reason))
+    start = time.time()
+    await _wait(writer.start_tls(ctx, server_hostname=host), timeout)
+    logging.debug('TLS handshake with %s: %.1f ms' % (
+        host, (time.time() - start) * 1000
+    ))
+    return reader, writer, False
+
+async def _connect(key, timeout):
+    now = time.time()
+    conns = _idle.get(key)
+    while conns:
+        conn, last_used = conns.pop()
+        if now - last_used <= idle_timeout and not conn[0].at_eof():
+            stats['reused'] += 1
+            return conn, True
+        conn[1].close()
+    stats['new'] += 1
+    return await _open_connection(
+        *key, timeout=common.connect_timeout or timeout
+    ), False
+
+def _release(key, conn):
+    _idle.setdefault(key, []).append((conn, time.time()))
+
+class Response:
+    """A response of the engine, in the style of http.client.HTTPResponse.
+
+    The coroutine aread() is meant for code running on the engine's loop,
+    read() for any other thread.
+    """
+
+    def __init__(self, url, method, status, reason, headers, key, conn):
+        self.url = url
+        self.status = status
+        self.reason = reason
+        self.msg = reason
+        self.headers = headers
+        self._key = key
+        self._conn = conn
+        self._timeout = None
+        self.chunked = 'chunked' in headers.get('transfer-encoding', '').lower()
+        self.length = None
+        if method == 'HEAD' or status in (204, 304) or 100 <= status < 200:
+            self.length = 0
+        elif not self.chunked and headers.get('content-length') is not None:
+            self.length = int(headers['content-length'])
+        self.chunk_left = 0
+        self.will_close = self.length is None and not self.chunked or \
+            headers.get('connection', '').lower() == 'close'
+        if self.length == 0:
+            self._done()
+
+    def getcode(self):
+        return self.status
+
+    def geturl(self):
+        return self.url
+
+    def info(self):
+        return self.headers
+
+    def getheader(self, name, default=None):
+        return self.headers.get(name, default)
+
+    def isclosed(self):
+        return self._conn is None
+
+    def _done(self):
+        conn, self._conn = self._conn, None
+        if conn is None:
+            return
+        if self.will_close:
+            conn[1].close()
+        else:
+            _release(self._key, conn)
+
+    async def _read_chunked(self, n):
+        reader = self._conn[0]
+        if not self.chunk_left:
+            line = await _wait(reader.readline(), self._timeout)
+            self.chunk_left = int(line.split(b';', 1)[0], 16)
+            if not self.chunk_left:
+                # last chunk, skip the trailer
+                while (await _wait(reader.readline(), self._timeout)) \
+                        not in (b'\r\n', b'\n', b''):
+                    pass
+                self._done()
+                return b''
+        data = await _wait(reader.read(min(n, self.chunk_left)),
+                           self._timeout)
+        if not data:
+            raise client.IncompleteRead(data)
+        self.chunk_left -= len(data)
+        if not self.chunk_left:
+            await _wait(reader.readline(), self._timeout)
+        return data
+
+    async def aread(self, n=-1):
+        """Reads up to n bytes of the body (all of it if n < 0)."""
+        if self._conn is None:
+            return b''
+        if n is None or n < 0:
+            chunks = []
+            while True:
+                data = await self.aread(1024 * 256)
+                if not data:
+                    return b''.join(chunks)
+                chunks.append(data)
+        if self.chunked:
+            return await self._read_chunked(n)
+        if self.length is not None:
+            n = min(n, self.length)
+        data = await _wait(self._conn[0].read(n), self._timeout)
+        if self.length is not None:
+            self.length -= len(data)
+            if not data and self.length:
+                self._conn[1].close()
+                self._conn = None
+                raise client.IncompleteRead(data, self.length)
+        if not data or self.length == 0:
+            self._done()
+        return data
+
+    def read(self, n=-1):
+        return run(self.aread(n))
+
+    # aread() never waits for more than what has arrived
+    read1 = read
+
+    def readinto1(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        conn, self._conn = self._conn, None
+        if conn is not None:
+            # closed before the body was drained
+            get_loop().call_soon_threadsafe(conn[1].close)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class _CookieResponse:
+    # what CookieJar.extract_cookies() needs from a response
+    def __init__(self, headers):
+        self.headers = headers
+
+    def info(self):
+        return self.headers
+
+async def aurlopen(req, data=None, timeout=socket._GLOBAL_DEFAULT_TIMEOUT,
+                   session=None):
+    """Sends a request, following redirects like urllib does.
+
+    Args:
+        req: A URL or a urllib.request.Request.
+        data: The request body, if req is not a Request carrying one.
+        timeout: Seconds to wait on each network operation.
+        session: The common.DownloadSession to send the request in, the
+            default one if None (the loop has no current session).
+    """
+    session = session or common.default_session
+    if isinstance(req, str):
+        req = request.Request(req)
+    if data is not None:
+        req.data = data
+    if timeout is socket._GLOBAL_DEFAULT_TIMEOUT:
+        timeout = common.read_timeout or socket.getdefaulttimeout()
+
+    for _ in range(MAX_REDIRECTS + 1):
+        response = await _send(req, timeout, session)
+        if session.cookies is not None:
+            session.cookies.extract_cookies(
+                _CookieResponse(response.headers), req
+            )
+        location = response.headers.get('location') or \
+            response.headers.get('uri')
+        if response.status not in (301, 302, 303, 307, 308) or not location:
+            break
+        # drain the body so that the connection can be reused
+        await response.aread()
+        method = req.get_method()
+        body = req.data if response.status in (307, 308) else None
+        if body is None and method not in ('GET', 'HEAD'):
+            method = 'GET'
+        # like urllib, without the unredirected headers: the cookies are
+        # added again for the new URL, by the cookie jar
+        headers = {k: v for k, v in req.headers.items()
+                   if body is not None or
+                   k.lower() not in ('content-length', 'content-type')}
+        req = request.Request(
+            parse.urljoin(req.full_url, location), data=body,
+            headers=headers, origin_req_host=req.origin_req_host,
+            unverifiable=True, method=method
+        )
+    else:
+        raise error.HTTPError(
+            req.full_url, response.status, 'too many redirects',
+            response.headers, response
+        )
+
+    if response.status >= 400:
+        raise error.HTTPError(
+            req.full_url, response.status, response.reason, response.headers,
+            response
+        )
+    return response
+
+async def _send(req, timeout, session):
+    url = parse.urlsplit(req.full_url)
+    scheme = url.scheme.lower()
+    if scheme not in ('http', 'https'):
+        raise error.URLError('unknown url type: %s' % scheme)
+    host = url.hostname
+    if not host:
+        raise error.URLError('no host given')
+    port = url.port or (443 if scheme == 'https' else 80)
+    # connections are only shared by requests with the same settings
+    key = (scheme, host, port, _get_proxy(scheme, host, session.proxies),
+           session.insecure)
+
+    if session.cookies is not None:
+        session.cookies.add_cookie_header(req)
+    headers = {'Host': url.netloc.rsplit('@', 1)[-1],
+               'User-Agent': 'Python-urllib/%d.%d' % common.sys.version_info[:2],
+               'Accept-Encoding': 'identity'}
+    for name, value in req.header_items():
+        headers[name.title()] = value
+    body = req.data
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    if body is not None:
+        headers.setdefault('Content-Type', 'application/x-www-form-urlencoded')
+        headers['Content-Length'] = str(len(body))
+
+    for attempt in range(2):
+        try:
+            (reader, writer, absolute), reused = await _connect(key, timeout)
+        except (OSError, asyncio.TimeoutError) as err:
+            raise error.URLError(err)
+        target = req.full_url.split('#', 1)[0] if absolute else \
+            parse.urlunsplit(('', '', url.path or '/', url.query, ''))
+        head = '%s %s HTTP/1.1\r\n' % (req.get_method(), target)
+        head += ''.join('%s: %s\r\n' % x for x in headers.items())
+        try:
+            writer.write(head.encode('iso-8859-1') + b'\r\n')
+            if body:
+                writer.write(body)
+            await _wait(writer.drain(), timeout)
+            version, status, reason, resp_headers = \
+                await _read_head(reader, timeout)
+            while status == 100:
+                version, status, reason, resp_headers = \
+                    await _read_head(reader, timeout)
+        except (ConnectionError, client.BadStatusLine):
+            writer.close()
+            if reused and attempt == 0:
+                # the server has dropped the idle connection meanwhile
+                continue
+            raise
+        break
+
+    response = Response(
+        req.full_url, req.get_method(), status, reason, resp_headers, key,
+        (reader, writer, absolute)
+    )
+    response._timeout = timeout
+    if version == 'HTTP/1.0' and \
+            resp_headers.get('connection', '').lower() != 'keep-alive':
+        response.will_close = True
+    return response
+
+def urlopen(req, data=None, timeout=socket._GLOBAL_DEFAULT_TIMEOUT):
+    """Blocking counterpart of aurlopen(), a drop-in for request.urlopen()."""
+    return run(aurlopen(req, data=data, timeout=timeout,
+                        session=common.get_session()))
+
+async def aurlopen_with_retry(req, timeout=socket._GLOBAL_DEFAULT_TIMEOUT,
+                              session=None):
+    """Like common.urlopen_with_retry(), without blocking the loop."""
+    policy, breaker = common.retry_policy, common.circuit_breaker
+    host = parse.urlsplit(req.full_url).netloc
+    for attempt in itertools.count():
+        breaker.check(host)
+        try:
+            response = await aurlopen(req, timeout=timeout, session=session)
+        except Exception as err:
+            delay = policy.handle(err, attempt, host, breaker)
+            if delay is None:
+                raise
+            await asyncio.sleep(delay)
+        else:
+            breaker.success(host)
+            return response
+
+async def _save_part(url, filepath, bar, headers, timeout, session):
+    if os.path.exists(filepath) and not session.force:
+        size = os.path.getsize(filepath)
+        # asks for a byte only, the total is in Content-Range
+        tmp_headers = headers.copy()
+        tmp_headers['Range'] = 'bytes=0-0'
+        response = await aurlopen_with_retry(
+            request.Request(url, headers=tmp_headers), timeout=timeout,
+            session=session
+        )
+        if response.status == 206:
+            total = common.match1(
+                response.headers.get('content-range', ''), r'/(\d+)$'
+            )
+        else:
+            total = response.headers.get('content-length')
+        if response.length == 1:
+            # read, so that the connection can be reused
+            await response.aread()
+        else:
+            # the range has been ignored, and the body is not read
+            response.close()
+        if total is not None and int(total) == size:
+            if bar:
+                bar.update_received(size)
+            return
+
+    temp_filepath = filepath + '.download'
+    received = 0
+    if os.path.exists(temp_filepath) and not session.force:
+        received = os.path.getsize(temp_filepath)
+        if bar:
+            bar.update_received(received)
+    with open(temp_filepath, 'ab' if received else 'wb') as output:
+        receiver = common.Receiver(url, output, bar, offset=received)
+        while True:
+            tmp_headers = headers.copy()
+            if receiver.offset:
+                tmp_headers['Range'] = 'bytes=%s-' % receiver.offset
+            try:
+                response = await aurlopen_with_retry(
+                    request.Request(url, headers=tmp_headers),
+                    timeout=timeout, session=session
+                )
+            except error.HTTPError as http_error:
+                if http_error.code == 416 and receiver.offset:
+                    # nothing left after what we have
+                    break
+                raise
+            if receiver.offset and response.status != 206:
+                # Range ignored, start over
+                output.seek(0)
+                output.truncate()
+                if bar:
+                    bar.update_received(-receiver.offset)
+                receiver.offset = 0
+            stalled = False
+            receiver.start()
+            try:
+                while True:
+                    buffer = await response.aread(receiver.sizer.size)
+                    if not buffer:
+                        break
+                    wait, stalled = receiver.write(buffer)
+                    if wait:
+                        await asyncio.sleep(wait)
+                    if stalled and not response.isclosed():
+                        # too slow, try again on a new connection
+                        common.record_stall(url)
+                        response.close()
+                        break
+                    stalled = False
+            except STREAM_ERRORS as e:
+                if isinstance(e, socket.timeout):
+                    common.record_stall(url)
+                # Unexpected termination. Retry request
+                response.close()
+                await asyncio.sleep(receiver.fail())
+                continue
+            if stalled:
+                continue
+            if not response.chunked and response.length is None or \
+                    response.isclosed():
+                break
+    if os.access(filepath, os.W_OK):
+        os.remove(filepath)
+    os.rename(temp_filepath, filepath)
+
+async def _save_parts(jobs, bar, headers, workers, timeout, on_done,
+                      session):
+    semaphore = asyncio.Semaphore(workers)
+    finished = []
+
+    async def save(url, filepath):
+        async with semaphore:
+            await _save_part(url, filepath, bar, headers, timeout, session)
+        if on_done:
+            on_done(filepath)
+        finished.append(filepath)
+        if bar:
+            bar.update_piece(len(finished))
+
+    tasks = [asyncio.ensure_future(save(url, filepath))
+             for url, filepath in jobs]
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        # a failed part fails the download, so stop the others, and wait
+        # for them not to write to their parts any longer
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+def save_parts(jobs, bar, headers={}, workers=16, timeout=None,
+               on_done=None):
+    """Downloads (url, filepath) pairs concurrently on the engine's loop,
+    with up to workers transfers at a time, calling on_done with the
+    filepath of each finished part.
+    """
+    if bar:
+        bar.update_piece(0)
+    run(_save_parts(jobs, bar, headers, workers, timeout or
+                    common.read_timeout or socket.getdefaulttimeout(),
+                    on_done, common.get_session()))
@@ -11,14 +11,30 @@ import locale
 import logging
 import argparse
 import ssl
+import threading
+import zlib
+import codecs
+import functools
+import traceback
+from concurrent.futures import ThreadPoolExecutor
 from http import cookiejar
 from importlib import import_module
 from urllib import request, parse, error
 
 from .version import __version__
 from .util import log, term
+from .util.cache import ResponseCache
+from .util.dns import DNSCache
 from .util.git import get_version
+from .util.journal import Journal
+from .util.pool import (
+    ConnectionPool, PooledHTTPHandler, PooledHTTPSHandler, TLSSessionCache
+)
+from .util.ratelimit import RateLimiter, parse_rate
+from .util.readsize import ReadSizer
+from .util.retry import CircuitBreaker, RetryPolicy, STREAM_ERRORS
 from .util.strings import get_filename, unescape_html
+from .util.watchdog import StallWatchdog
 from . import json_output as json_output_
 sys.stdout = io.TextIOWrapper(sys.stdout.buffer,encoding='utf8')
 
@@ -137,6 +153,32 @@ cookies = None
 output_filename = None
 auto_rename = False
 insecure = False
+connections = 1
+part_workers = 1
+size_probe_workers = 8
+url_headers_cache = {}
+# the oldest headers are dropped past this, for long-running processes
+url_headers_cache_size = 10000
+url_headers_lock = threading.Lock()
+segment_min_size = 1024 * 1024
+dns_cache = DNSCache()
+connection_pool = ConnectionPool(resolver=dns_cache)
+tls_sessions = TLSSessionCache()
+ssl_contexts = {}
+engine = 'urllib'
+proxies = None
+response_cache = None
+connect_timeout = None
+read_timeout = None
+stall_window = 30
+stall_min_speed = 1024
+transfer_stats = {'stalls': 0, 'bytes': 0}
+rate_limiter = None
+read_size_min = 64 * 1024
+read_size_max = 4 * 1024 * 1024
+transfer_stats_lock = threading.Lock()
+retry_policy = RetryPolicy()
+circuit_breaker = CircuitBreaker()
 
 fake_headers = {
     'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',  # noqa
@@ -340,8 +382,9 @@ def get_response(url, faker=False):
     logging.debug('get_response: %s' % url)
 
     # install cookies
+    cookies = get_session().cookies
     if cookies:
-        opener = request.build_opener(request.HTTPCookieProcessor(cookies))
+        opener = build_opener(request.HTTPCookieProcessor(cookies))
         request.install_opener(opener)
 
     if faker:
@@ -389,31 +432,336 @@ def get_location(url, headers=None, get_method='HEAD'):
     return res.geturl()
 
 
+def get_ssl_context(insecure=None):
+    """Returns the SSLContext shared by all HTTPS connections, so that the
+    certificate store is loaded once and TLS sessions can be resumed.
+
+    Args:
+        insecure: Whether to skip certificate verification, as set in the
+            current session if None.
+    """
+    if insecure is None:
+        insecure = get_session().insecure
+    ctx = ssl_contexts.get(insecure)
+    if ctx is None:
+        ctx = ssl.create_default_context()
+        ctx.set_alpn_protocols(['http/1.1'])
+        if insecure:
+            # ignore ssl errors
+            ctx.check_hostname = False
+            ctx.verify_mode = ssl.CERT_NONE
+        ssl_contexts[insecure] = ctx
+    return ctx
+
+
+def prefetch_hosts(urls):
+    """Resolves the distinct hosts of urls ahead of the requests to them."""
+    hosts = set()
+    for url in urls:
+        if type(url) is list:
+            prefetch_hosts(url)
+            continue
+        url = parse.urlsplit(url)
+        if url.hostname:
+            hosts.add((url.hostname,
+                       url.port or (443 if url.scheme == 'https' else 80)))
+    dns_cache.prefetch(hosts)
+
+
+def get_timeouts():
+    return connect_timeout, read_timeout
+
+
+def stream_timeout(timeout=None):
+    """Returns the read timeout for a download, which is at most the stall
+    window so that a silent connection is noticed in time.
+    """
+    timeout = timeout or read_timeout
+    if not stall_window:
+        return timeout
+    return min(timeout, stall_window) if timeout else stall_window
+
+
+def record_stall(url):
+    with transfer_stats_lock:
+        transfer_stats['stalls'] += 1
+    logging.debug('transfer stalled, reconnecting: %s' % url)
+
+
+def record_received(n):
+    with transfer_stats_lock:
+        transfer_stats['bytes'] += n
+
+
+class DownloadSession:
+    """The settings and connections downloads are made with, so that
+    downloads with different settings can run in parallel in one process.
+
+    A session becomes the current one of the calling thread inside a with
+    statement, and requests and downloads go through the current session.
+    Outside of any, the default session is current, whose settings are the
+    module globals of the same names (as set by script_main()).
+
+    Args:
+        force: Overwrite existing files.
+        dry_run: Print the real URLs instead of downloading.
+        json_output: Print the information in JSON instead of downloading.
+        player: A command to play the media with instead of downloading it.
+        cookies: A http.cookiejar.CookieJar to send cookies from.
+        output_filename: The name of the downloaded file.
+        auto_rename: Rename the download if a different file has its name.
+        insecure: Skip the verification of TLS certificates.
+        proxies: A dict of schemes to proxies, {} for no proxy, or None for
+            the proxies of the system.
+        connection_pool: A ConnectionPool shared with other sessions, or
+            None for a pool of its own.
+        progress_bar: A callable making the progress bar of a download from
+            its total size and number of pieces, instead of the terminal's.
+    """
+
+    progress_bar = None
+
+    def __init__(self, force=False, dry_run=False, json_output=False,
+                 player=None, cookies=None, output_filename=None,
+                 auto_rename=False, insecure=False, proxies=None,
+                 connection_pool=None, progress_bar=None):
+        self.force = force
+        self.dry_run = dry_run
+        self.json_output = json_output
+        self.player = player
+        self.cookies = cookies
+        self.output_filename = output_filename
+        self.auto_rename = auto_rename
+        self.insecure = insecure
+        self.connection_pool = connection_pool or \
+            ConnectionPool(resolver=dns_cache)
+        self.progress_bar = progress_bar
+        self.proxies = proxies
+
+    @property
+    def proxies(self):
+        return self._proxies
+
+    @proxies.setter
+    def proxies(self, proxies):
+        self._proxies = proxies
+        self._opener = None
+
+    def urlopen(self, *args, **kwargs):
+        """Opens a URL like request.urlopen(), through the proxies and the
+        connection pool of the session.
+        """
+        opener = self._opener
+        if opener is None:
+            handlers = [] if self.proxies is None else \
+                [request.ProxyHandler(self.proxies)]
+            opener = self._opener = build_opener(*handlers, session=self)
+        return opener.open(*args, **kwargs)
+
+    def __enter__(self):
+        _current.__dict__.setdefault('sessions', []).append(self)
+        return self
+
+    def __exit__(self, *args):
+        _current.sessions.pop()
+
+
+def _global_setting(name):
+    return property(
+        lambda self: globals()[name],
+        lambda self, value: globals().__setitem__(name, value)
+    )
+
+
+class _DefaultSession(DownloadSession):
+    # the settings are the module globals, for the callers that set them
+    force = _global_setting('force')
+    dry_run = _global_setting('dry_run')
+    json_output = _global_setting('json_output')
+    player = _global_setting('player')
+    cookies = _global_setting('cookies')
+    output_filename = _global_setting('output_filename')
+    auto_rename = _global_setting('auto_rename')
+    insecure = _global_setting('insecure')
+    connection_pool = _global_setting('connection_pool')
+
+    def __init__(self):
+        pass
+
+    @property
+    def proxies(self):
+        return proxies
+
+    @proxies.setter
+    def proxies(self, value):
+        global proxies
+        proxies = value
+        handlers = [] if value is None else [request.ProxyHandler(value)]
+        request.install_opener(build_opener(*handlers))
+
+    def urlopen(self, *args, **kwargs):
+        # through the installed opener, which older callers may replace
+        return request.urlopen(*args, **kwargs)
+
+
+_current = threading.local()
+default_session = _DefaultSession()
+
+
+def get_session():
+    """Returns the current session of the calling thread."""
+    sessions = getattr(_current, 'sessions', None)
+    return sessions[-1] if sessions else default_session
+
+
+def uses_session(func):
+    """Makes func take a session argument (the current session by default),
+    which is also made current while func runs, so that the requests it
+    makes go through it.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, session=None, **kwargs):
+        session = session or get_session()
+        with session:
+            return func(*args, session=session, **kwargs)
+    return wrapper
+
+
+def build_opener(*handlers, session=None):
+    """Builds an opener whose HTTP(S) connections are kept alive in the
+    connection pool of session (the default one if None) and reused across
+    requests.
+    """
+    session = session or default_session
+    return request.build_opener(
+        *handlers,
+        PooledHTTPHandler(session.connection_pool, get_timeouts),
+        PooledHTTPSHandler(
+            session.connection_pool,
+            lambda: get_ssl_context(session.insecure), get_timeouts,
+            tls_sessions
+        )
+    )
+
+
+def aio_supports(url):
+    """Whether the asyncio engine can fetch url in the current session."""
+    from . import aio
+    return aio.supports(url, get_session())
+
+
 def urlopen_with_retry(*args, **kwargs):
-    retry_time = 3
-    for i in range(retry_time):
-        try:
-            if insecure:
-                # ignore ssl errors
-                ctx = ssl.create_default_context()
-                ctx.check_hostname = False
-                ctx.verify_mode = ssl.CERT_NONE
-                return request.urlopen(*args, context=ctx, **kwargs)
-            else:
-                return request.urlopen(*args, **kwargs)
-        except socket.timeout as e:
-            logging.debug('request attempt %s timeout' % str(i + 1))
-            if i + 1 == retry_time:
-                raise e
-        # try to tackle youku CDN fails
-        except error.HTTPError as http_error:
-            logging.debug('HTTP Error with code{}'.format(http_error.code))
-            if i + 1 == retry_time:
-                raise http_error
+    """Opens a URL like request.urlopen(), retrying failures as decided by
+    retry_policy and skipping hosts that circuit_breaker has given up on.
+    """
+    req = args[0]
+    url = req.full_url if isinstance(req, request.Request) else req
+    if engine == 'asyncio' and aio_supports(url):
+        from . import aio
+        urlopen = aio.urlopen
+    else:
+        urlopen = get_session().urlopen
+    return retry_policy.call(
+        lambda: urlopen(*args, **kwargs), host=parse.urlsplit(url).netloc,
+        breaker=circuit_breaker
+    )
 
 
-def get_content(url, headers={}, decoded=True):
-    """Gets the content of a URL via sending a HTTP GET request.
+def urlopen_cached(req, data=None):
+    """Sends a request through response_cache, if there is one.
+
+    Args:
+        req: A urllib.request.Request.
+        data: The request body, if any.
+
+    Returns:
+        A tuple of the response headers and an iterable of the (still
+        encoded) chunks of the body.
+    """
+    if response_cache is None:
+        response = urlopen_with_retry(req, data=data)
+        return response.headers, iter_response(response)
+
+    method = 'POST' if data is not None else req.get_method()
+    key = response_cache.key(method, req.full_url, req.header_items(), data)
+    entry = response_cache.load(key)
+    if entry is not None:
+        if entry.is_fresh():
+            logging.debug('cache hit: %s' % req.full_url)
+            return entry.headers, [entry.body]
+        for name, value in entry.validators().items():
+            req.add_header(name, value)
+
+    try:
+        response = urlopen_with_retry(req, data=data)
+    except error.HTTPError as http_error:
+        if http_error.code != 304 or entry is None:
+            raise
+        response = http_error
+    if response.getcode() == 304 and entry is not None:
+        logging.debug('cache revalidated: %s' % req.full_url)
+        response_cache.refresh(key, entry, response.headers)
+        return entry.headers, [entry.body]
+    data = response.read()
+    response_cache.store(key, req.full_url, response.headers, data)
+    return response.headers, [data]
+
+
+def iter_response(response, chunk_size=64 * 1024):
+    """Yields the body of a response in chunks, as they arrive."""
+    while True:
+        chunk = response.read(chunk_size)
+        if not chunk:
+            break
+        yield chunk
+
+
+def decode_chunks(chunks, content_encoding=None, charset=None, errors='ignore'):
+    """Decompresses and decodes the chunks of a response body incrementally.
+
+    Args:
+        chunks: An iterable of the raw chunks of the body.
+        content_encoding: 'gzip', 'deflate' or None.
+        charset: The charset to decode with, or None to yield bytes.
+        errors: How to handle decoding errors.
+
+    Returns:
+        A generator of decoded chunks.
+    """
+    decompressor = None
+    if content_encoding == 'gzip':
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif content_encoding == 'deflate':
+        decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+    decoder = None
+    if charset is not None:
+        decoder = codecs.getincrementaldecoder(charset)(errors)
+
+    for chunk in chunks:
+        if decompressor is not None:
+            data = decompressor.decompress(chunk)
+            # a gzip stream may hold several members
+            while content_encoding == 'gzip' and decompressor.eof and \
+                    decompressor.unused_data:
+                chunk = decompressor.unused_data
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                data += decompressor.decompress(chunk)
+            chunk = data
+        if decoder is not None:
+            chunk = decoder.decode(chunk)
+        if chunk:
+            yield chunk
+
+    chunk = decompressor.flush() if decompressor is not None else b''
+    if decoder is not None:
+        chunk = decoder.decode(chunk, final=True)
+    if chunk:
+        yield chunk
+
+
+def iter_content(url, headers={}, decoded=True):
+    """Gets the content of a URL via sending a HTTP GET request, chunk by
+    chunk, so that large responses can be processed with bounded memory.
 
     Args:
         url: A URL.
@@ -421,37 +769,45 @@ def get_content(url, headers={}, decoded=True):
         decoded: Whether decode the response body using UTF-8 or the charset specified in Content-Type.
 
     Returns:
-        The content as a string.
+        A generator of strings (or bytes if not decoded).
     """
 
-    logging.debug('get_content: %s' % url)
+    logging.debug('iter_content: %s' % url)
 
     req = request.Request(url, headers=headers)
+    cookies = get_session().cookies
     if cookies:
         cookies.add_cookie_header(req)
         req.headers.update(req.unredirected_hdrs)
 
-    response = urlopen_with_retry(req)
-    data = response.read()
-
-    # Handle HTTP compression for gzip and deflate (zlib)
-    content_encoding = response.getheader('Content-Encoding')
-    if content_encoding == 'gzip':
-        data = ungzip(data)
-    elif content_encoding == 'deflate':
-        data = undeflate(data)
+    response_headers, chunks = urlopen_cached(req)
 
-    # Decode the response body
+    charset = None
     if decoded:
         charset = match1(
-            response.getheader('Content-Type', ''), r'charset=([\w-]+)'
-        )
-        if charset is not None:
-            data = data.decode(charset, 'ignore')
-        else:
-            data = data.decode('utf-8', 'ignore')
+            response_headers.get('Content-Type', ''), r'charset=([\w-]+)'
+        ) or 'utf-8'
+    return decode_chunks(
+        chunks, response_headers.get('Content-Encoding'), charset
+    )
+
+
+def get_content(url, headers={}, decoded=True):
+    """Gets the content of a URL via sending a HTTP GET request.
+
+    Args:
+        url: A URL.
+        headers: Request headers used by the client.
+        decoded: Whether decode the response body using UTF-8 or the charset specified in Content-Type.
+
+    Returns:
+        The content as a string.
+    """
+
+    logging.debug('get_content: %s' % url)
 
-    return data
+    chunks = iter_content(url, headers=headers, decoded=decoded)
+    return ('' if decoded else b'').join(chunks)
 
 
 def post_content(url, headers={}, post_data={}, decoded=True, **kwargs):
@@ -471,6 +827,7 @@ def post_content(url, headers={}, post_data={}, decoded=True, **kwargs):
         logging.debug('post_content: %s\npost_data: %s' % (url, post_data))
 
     req = request.Request(url, headers=headers)
+    cookies = get_session().cookies
     if cookies:
         cookies.add_cookie_header(req)
         req.headers.update(req.unredirected_hdrs)
@@ -478,44 +835,63 @@ def post_content(url, headers={}, post_data={}, decoded=True, **kwargs):
         post_data_enc = bytes(kwargs['post_data_raw'], 'utf-8')
     else:
         post_data_enc = bytes(parse.urlencode(post_data), 'utf-8')
-    response = urlopen_with_retry(req, data=post_data_enc)
-    data = response.read()
-
-    # Handle HTTP compression for gzip and deflate (zlib)
-    content_encoding = response.getheader('Content-Encoding')
-    if content_encoding == 'gzip':
-        data = ungzip(data)
-    elif content_encoding == 'deflate':
-        data = undeflate(data)
+    response_headers, chunks = urlopen_cached(req, data=post_data_enc)
 
-    # Decode the response body
+    charset = None
     if decoded:
         charset = match1(
-            response.getheader('Content-Type'), r'charset=([\w-]+)'
-        )
-        if charset is not None:
-            data = data.decode(charset)
-        else:
-            data = data.decode('utf-8')
-
-    return data
+            response_headers.get('Content-Type'), r'charset=([\w-]+)'
+        ) or 'utf-8'
+    chunks = decode_chunks(
+        chunks, response_headers.get('Content-Encoding'), charset, 'strict'
+    )
+    return ('' if decoded else b'').join(chunks)
 
 
-def url_size(url, faker=False, headers={}):
+def url_headers(url, faker=False, headers={}):
+    """Gets the response headers of a URL, remembering them for the rest of
+    the run (per URL and request headers).
+    """
     if faker:
-        response = urlopen_with_retry(
-            request.Request(url, headers=fake_headers)
-        )
-    elif headers:
+        headers = fake_headers
+    key = (url, tuple(sorted(headers.items())))
+    response_headers = url_headers_cache.get(key)
+    if response_headers is None:
+        logging.debug('url_headers: %s' % url)
         response = urlopen_with_retry(request.Request(url, headers=headers))
-    else:
-        response = urlopen_with_retry(url)
+        response.close()
+        response_headers = response.headers
+        with url_headers_lock:
+            # dicts keep their insertion order, the oldest comes first
+            while len(url_headers_cache) >= url_headers_cache_size:
+                del url_headers_cache[next(iter(url_headers_cache))]
+            url_headers_cache[key] = response_headers
+    return response_headers
+
+
+def prefetch_url_headers(urls, faker=False, headers={}):
+    """Gets the response headers of many URLs concurrently, so that the
+    following url_size() and url_info() calls do not wait on the network.
+    """
+    def probe(url):
+        try:
+            url_headers(url, faker=faker, headers=headers)
+        except Exception:
+            # will be raised again where the size is actually needed
+            pass
+
+    urls = list(set(urls))
+    if len(urls) > 1:
+        run_in_threads(probe, [(url,) for url in urls], size_probe_workers)
+
 
-    size = response.headers['content-length']
+def url_size(url, faker=False, headers={}):
+    size = url_headers(url, faker=faker, headers=headers)['content-length']
     return int(size) if size is not None else float('inf')
 
 
 def urls_size(urls, faker=False, headers={}):
+    prefetch_url_headers(urls, faker=faker, headers=headers)
     return sum([url_size(url, faker=faker, headers=headers) for url in urls])
 
 
@@ -534,16 +910,7 @@ def get_head(url, headers=None, get_method='HEAD'):
 def url_info(url, faker=False, headers={}):
     logging.debug('url_info: %s' % url)
 
-    if faker:
-        response = urlopen_with_retry(
-            request.Request(url, headers=fake_headers)
-        )
-    elif headers:
-        response = urlopen_with_retry(request.Request(url, headers=headers))
-    else:
-        response = urlopen_with_retry(request.Request(url))
-
-    headers = response.headers
+    headers = url_headers(url, faker=faker, headers=headers)
 
     type = headers['content-type']
     if type == 'image/jpg; charset=UTF-8' or type == 'image/jpg':
@@ -613,11 +980,188 @@ def url_locations(urls, faker=False, headers={}):
     return locations
 
 
+def url_open_range(url, start=0, headers={}, timeout=None):
+    """Opens a URL for downloading from byte start onwards.
+
+    Returns:
+        A tuple (response, range_start, total_size). range_start is the
+        offset the response body begins at (0 if the server ignores Range),
+        total_size is float('inf') if unknown. response is None if there is
+        nothing left to download after start.
+    """
+    tmp_headers = headers.copy()
+    if start:
+        tmp_headers['Range'] = 'bytes=%s-' % start
+    req = request.Request(url, headers=tmp_headers)
+    try:
+        if timeout:
+            response = urlopen_with_retry(req, timeout=timeout)
+        else:
+            response = urlopen_with_retry(req)
+    except error.HTTPError as http_error:
+        total = match1(
+            http_error.headers.get('content-range', ''), r'^bytes \*/(\d+)'
+        )
+        if http_error.code == 416 and total and int(total) == start:
+            return None, start, start
+        raise
+
+    content_range = response.headers['content-range']
+    if response.getcode() == 206 and content_range:
+        range_start = int(match1(content_range, r'^bytes (\d+)-'))
+        total = match1(content_range, r'/(\d+)$')
+        total_size = int(total) if total else float('inf')
+    else:
+        range_start = 0
+        content_length = response.headers['content-length']
+        total_size = int(content_length) if content_length is not None \
+            else float('inf')
+    return response, range_start, total_size
+
+
+def preallocate(output, size):
+    """Reserves size bytes of disk space for the file output where the
+    platform supports it, so that the file does not fragment as it grows.
+
+    Returns:
+        True if the space has been reserved, which also extends the file.
+    """
+    if not hasattr(os, 'posix_fallocate') or size == float('inf'):
+        return False
+    try:
+        os.posix_fallocate(output.fileno(), 0, size)
+    except OSError as e:
+        logging.debug('preallocate: %s' % e)
+        return False
+    return True
+
+
+def read_into(response, buffer):
+    """Reads what has arrived of a response body into buffer, without
+    waiting for buffer to fill.
+
+    Returns:
+        The number of bytes read, 0 at the end of the body.
+    """
+    readinto1 = getattr(response, 'readinto1', None)
+    if readinto1 is not None:
+        return readinto1(buffer)
+    data = response.read1(len(buffer))
+    buffer[:len(data)] = data
+    return len(data)
+
+
+class Receiver:
+    """Receives response bodies into a file, for all downloaders.
+
+    Reads go into a reused buffer whose size a ReadSizer follows the
+    throughput with. Every block is written at offset, recorded in the
+    journal, on the progress bar and in transfer_stats, and counted by the
+    rate limiter. A StallWatchdog tells when the connection is too slow and
+    is to be replaced, and failures are counted against retry_policy.
+
+    Args:
+        url: The URL being downloaded.
+        output: The file to write to, positioned at offset.
+        bar: The progress bar, or None.
+        journal: The Journal to record the received ranges in, or None.
+        offset: Where the next byte goes in output.
+    """
+
+    # what receive() stopped at
+    DONE, EOF, STALLED, STOPPED = 'done', 'eof', 'stalled', 'stopped'
+
+    def __init__(self, url, output, bar=None, journal=None, offset=0):
+        self.url = url
+        self.host = parse.urlsplit(url).hostname
+        self.output = output
+        self.bar = bar
+        self.journal = journal
+        self.offset = offset
+        self.failures = 0
+        self.sizer = ReadSizer(read_size_min, read_size_max)
+        self.watchdog = StallWatchdog(stall_window, stall_min_speed)
+
+    def start(self):
+        """Starts measuring anew, for a new response."""
+        self.watchdog.reset()
+        self.sizer.reset()
+
+    def write(self, data):
+        """Writes and counts a received block.
+
+        Returns:
+            The seconds to wait for the rate limit, and whether the transfer
+            has stalled.
+        """
+        n = len(data)
+        self.failures = 0
+        self.output.write(data)
+        self.offset += n
+        if self.journal is not None:
+            self.journal.add_range(self.offset - n, self.offset, self.output)
+        if self.bar:
+            self.bar.update_received(n)
+        record_received(n)
+        self.sizer.update(n)
+        wait = rate_limiter.reserve(self.host, n) if rate_limiter else 0
+        return wait, self.watchdog.update(n)
+
+    def fail(self):
+        """Records that the transfer has broken off.
+
+        Returns:
+            The seconds to wait before reconnecting.
+        """
+        self.failures += 1
+        if self.failures > retry_policy.retries:
+            raise IOError('Download of %s keeps failing' % self.url)
+        return retry_policy.delay(self.failures)
+
+    def receive(self, response, end=float('inf'), stopped=None):
+        """Reads response until offset reaches end, the body ends or breaks
+        off (EOF), the transfer stalls, or the event stopped is set.
+
+        Returns:
+            DONE, EOF, STALLED or STOPPED.
+        """
+        self.start()
+        while self.offset < end:
+            if stopped is not None and stopped.is_set():
+                return self.STOPPED
+            n = 0
+            view = self.sizer.view()
+            if end - self.offset < len(view):
+                view = view[:end - self.offset]
+            try:
+                n = read_into(response, view)
+            except socket.timeout:
+                # nothing received within the stall window
+                record_stall(self.url)
+            except STREAM_ERRORS as e:
+                logging.debug('%s: %s' % (self.url, e))
+            if not n:
+                return self.EOF
+            wait, stalled = self.write(view[:n])
+            if wait:
+                time.sleep(wait)
+            if stalled and self.offset < end:
+                # too slow, try again on a new connection
+                record_stall(self.url)
+                return self.STALLED
+        return self.DONE
+
+
+@uses_session
 def url_save(
     url, filepath, bar, refer=None, is_part=False, faker=False,
-    headers=None, timeout=None, **kwargs
+    headers=None, timeout=None, session=None, **kwargs
 ):
+    force = session.force
+    timeout = stream_timeout(timeout)
     tmp_headers = headers.copy() if headers is not None else {}
+    if faker:
+        tmp_headers = fake_headers.copy()
     # When a referer specified with param refer,
     # the key must be 'Referer' for the hack here
     if refer is not None:
@@ -625,15 +1169,33 @@ def url_save(
     if type(url) is list:
         file_size = urls_size(url, faker=faker, headers=tmp_headers)
         is_chunked, urls = True, url
+        response = None
     else:
-        file_size = url_size(url, faker=faker, headers=tmp_headers)
         is_chunked, urls = False, [url]
+        # The response tells the file size, and is then read for the
+        # download itself, so no separate request is needed for the size
+        offset = 0
+        if not force and os.path.exists(filepath + '.download'):
+            journal = Journal.load(filepath + '.journal')
+            if journal is None:
+                offset = os.path.getsize(filepath + '.download')
+            else:
+                # the server sends the whole file instead of the range if
+                # it has changed since
+                offset = journal.head()
+                if journal.validator():
+                    tmp_headers['If-Range'] = journal.validator()
+        response, response_start, file_size = url_open_range(
+            url, offset, headers=tmp_headers, timeout=timeout
+        )
 
     continue_renameing = True
     while continue_renameing:
         continue_renameing = False
         if os.path.exists(filepath):
             if not force and file_size == os.path.getsize(filepath):
+                if response is not None:
+                    response.close()
                 if not is_part:
                     if bar:
                         bar.done()
@@ -650,7 +1212,7 @@ def url_save(
                 if not is_part:
                     if bar:
                         bar.done()
-                    if not force and auto_rename:
+                    if not force and session.auto_rename:
                         path, ext = os.path.basename(filepath).rsplit('.', 1)
                         finder = re.compile(' \([1-9]\d*?\)$')
                         if (finder.search(path) is None):
@@ -666,41 +1228,97 @@ def url_save(
                     if log.yes_or_no('File with this name already exists. Overwrite?'):
                         log.w('Overwriting %s ...' % tr(os.path.basename(filepath)))
                     else:
+                        if response is not None:
+                            response.close()
                         return
         elif not os.path.exists(os.path.dirname(filepath)):
-            os.mkdir(os.path.dirname(filepath))
+            os.makedirs(os.path.dirname(filepath), exist_ok=True)
 
     temp_filepath = filepath + '.download' if file_size != float('inf') \
         else filepath
+    journal = None
     received = 0
     if not force:
         open_mode = 'ab'
 
         if os.path.exists(temp_filepath):
-            received += os.path.getsize(temp_filepath)
+            if not is_chunked:
+                journal = Journal.load(filepath + '.journal')
+            if journal is None:
+                received += os.path.getsize(temp_filepath)
+            elif response is not None and \
+                    not journal.matches(file_size, response.headers):
+                log.w('%s has changed on the server, downloading it again' %
+                      tr(os.path.basename(filepath)))
+                journal = None
+                open_mode = 'wb'
+            else:
+                received = journal.completed()
             if bar:
-                bar.update_received(os.path.getsize(temp_filepath))
+                bar.update_received(received)
     else:
         open_mode = 'wb'
 
+    if journal is None and response is not None and not is_chunked and \
+            file_size != float('inf'):
+        journal = Journal.for_response(
+            filepath + '.journal', file_size, response.headers
+        )
+        if received:
+            # left by a download without a journal
+            journal.ranges = [[0, received]]
+        journal.save()
+    if journal is not None and journal.validator():
+        tmp_headers['If-Range'] = journal.validator()
+    # where a single connection continues the download
+    offset = journal.head() if journal is not None else received
+
+    if response is not None and (
+        received >= file_size or response_start not in (0, offset)
+    ):
+        # nothing left to download, or the response was opened for another
+        # offset (renamed or forced), so it cannot be used
+        response.close()
+        response = None
+    elif response is not None and response_start != offset:
+        # the whole file was sent instead of a range, so start over
+        if bar:
+            bar.update_received(-received)
+        received = offset = 0
+        open_mode = 'wb'
+        if journal is not None:
+            journal.ranges = []
+
+    if journal is not None and received < file_size and (
+        received != offset or response is not None and connections > 1
+    ):
+        # bytes after the first missing one are on disk already, or the
+        # rest can be fetched over several connections
+        if url_save_segmented(
+            url, temp_filepath, file_size, bar, response, journal,
+            headers=tmp_headers, timeout=timeout
+        ):
+            received = file_size
+            response = None
+        elif received != offset:
+            # the server does not serve ranges, so the rest of the file is
+            # downloaded again after the first missing byte
+            if bar:
+                bar.update_received(offset - received)
+            received = offset
+            if not received:
+                open_mode = 'wb'
+                journal.ranges = []
+
     for url in urls:
-        received_chunk = 0
         if received < file_size:
-            if faker:
-                tmp_headers = fake_headers
-            '''
-            if parameter headers passed in, we have it copied as tmp_header
-            elif headers:
-                headers = headers
-            else:
-                headers = {}
-            '''
             if received and not is_chunked:  # only request a range when not chunked
                 tmp_headers['Range'] = 'bytes=' + str(received) + '-'
-            if refer:
-                tmp_headers['Referer'] = refer
 
-            if timeout:
+            if response is not None:
+                # already opened by url_open_range()
+                pass
+            elif timeout:
                 response = urlopen_with_retry(
                     request.Request(url, headers=tmp_headers), timeout=timeout
                 )
@@ -730,31 +1348,58 @@ def url_save(
                 if bar:
                     bar.received = 0
                 open_mode = 'wb'
+                if journal is not None:
+                    journal.ranges = []
+            elif journal is not None and received:
+                # write at received, as the file may reach beyond it
+                open_mode = 'r+b'
+            elif not received:
+                # a fresh file, whose space can then be reserved
+                open_mode = 'wb'
 
             with open(temp_filepath, open_mode) as output:
-                while True:
-                    buffer = None
-                    try:
-                        buffer = response.read(1024 * 256)
-                    except socket.timeout:
-                        pass
-                    if not buffer:
-                        if is_chunked and received_chunk == range_length:
-                            break
-                        elif not is_chunked and received == file_size:  # Download finished
+                if open_mode == 'r+b':
+                    output.seek(received)
+                preallocated = open_mode == 'wb' and not is_chunked and \
+                    preallocate(output, file_size)
+                # a chunk ends after range_length bytes, a file at its size
+                end = received + range_length if is_chunked else file_size
+                receiver = Receiver(url, output, bar, journal, received)
+                try:
+                    while True:
+                        result = receiver.receive(response, end)
+                        if result == Receiver.DONE or \
+                                result == Receiver.EOF and end == float('inf'):
                             break
-                        # Unexpected termination. Retry request
-                        if not is_chunked:  # when
-                            tmp_headers['Range'] = 'bytes=' + str(received) + '-'
-                        response = urlopen_with_retry(
-                            request.Request(url, headers=tmp_headers)
-                        )
-                        continue
-                    output.write(buffer)
-                    received += len(buffer)
-                    received_chunk += len(buffer)
-                    if bar:
-                        bar.update_received(len(buffer))
+                        if result == Receiver.STALLED and is_chunked:
+                            # chunks are requested whole, so keep on reading
+                            continue
+                        response.close()
+                        if result == Receiver.EOF:
+                            # Unexpected termination. Retry request
+                            time.sleep(receiver.fail())
+                        if not is_chunked:
+                            tmp_headers['Range'] = \
+                                'bytes=' + str(receiver.offset) + '-'
+                        req = request.Request(url, headers=tmp_headers)
+                        if timeout:
+                            response = urlopen_with_retry(req, timeout=timeout)
+                        else:
+                            response = urlopen_with_retry(req)
+                        if not is_chunked and receiver.offset and \
+                                response.getcode() != 206:
+                            response.close()
+                            raise IOError('%s has changed on the server' % url)
+                finally:
+                    received = receiver.offset
+                    if preallocated and received < file_size:
+                        # give the reserved space back, so that a later run
+                        # resumes from the right offset
+                        output.truncate(received)
+                    if journal is not None:
+                        output.flush()
+                        journal.save()
+            response = None
 
     assert received == os.path.getsize(temp_filepath), '%s == %s == %s' % (
         received, os.path.getsize(temp_filepath), temp_filepath
@@ -764,6 +1409,99 @@ def url_save(
         # on Windows rename could fail if destination filepath exists
         os.remove(filepath)
     os.rename(temp_filepath, filepath)
+    if journal is not None:
+        journal.remove()
+
+
+def url_save_segmented(
+    url, filepath, file_size, bar, response, journal, headers={},
+    timeout=None
+):
+    """Downloads the missing byte ranges of a file of known size over several
+    connections at once, each writing at its offset in filepath.
+
+    Args:
+        response: A response for the file from the first missing byte on,
+            read for the first range, or None.
+        journal: The Journal of the download, which tells the missing ranges
+            and records the fetched ones.
+
+    Returns:
+        False if the rest of the file is too small to be split or the server
+        does not accept Range requests (response is left untouched then),
+        True otherwise.
+    """
+    if file_size == float('inf'):
+        return False
+    if response is not None and \
+            response.headers.get('accept-ranges', 'none').lower() != 'bytes':
+        logging.debug('url_save_segmented: no byte ranges from %s' % url)
+        return False
+    segments = journal.missing()
+    # split the largest ranges until there is one for each connection
+    while len(segments) < connections:
+        segments.sort(key=lambda segment: segment[0] - segment[1])
+        start, end = segments[0]
+        if end - start < 2 * segment_min_size:
+            break
+        segments[:1] = [[start, (start + end) // 2], [(start + end) // 2, end]]
+    segments.sort()
+    if len(segments) < 2 and segments[0][1] == file_size:
+        return False
+    stopped = threading.Event()
+    session = get_session()
+
+    def open_range(start, end):
+        tmp_headers = headers.copy()
+        tmp_headers['Range'] = 'bytes=%s-%s' % (start, end - 1)
+        req = request.Request(url, headers=tmp_headers)
+        if timeout:
+            response = urlopen_with_retry(req, timeout=timeout)
+        else:
+            response = urlopen_with_retry(req)
+        if response.getcode() != 206:
+            response.close()
+            if 'If-Range' in headers:
+                raise IOError('%s has changed on the server' % url)
+            raise IOError('Range ignored by %s' % url)
+        return response
+
+    @uses_session
+    def fetch(segment, response=None, session=None):
+        start, end = segment
+        # unbuffered, so that the journal never records unwritten bytes
+        with open(filepath, 'r+b', buffering=0) as output:
+            output.seek(start)
+            receiver = Receiver(url, output, bar, journal, start)
+            while receiver.offset < end and not stopped.is_set():
+                if response is None:
+                    response = open_range(receiver.offset, end)
+                result = receiver.receive(response, end, stopped)
+                if result in (Receiver.EOF, Receiver.STALLED):
+                    response.close()
+                    response = None
+                if result == Receiver.EOF:
+                    # Unexpected termination. Retry from where we stopped
+                    time.sleep(receiver.fail())
+        if response is not None:
+            response.close()
+
+    if not journal.ranges:
+        with open(filepath, 'wb') as output:
+            preallocate(output, file_size)
+    executor = ThreadPoolExecutor(min(max(connections, 1), len(segments)))
+    try:
+        futures = [executor.submit(fetch, segments[0], response,
+                                   session=session)]
+        futures += [executor.submit(fetch, segment, session=session)
+                    for segment in segments[1:]]
+        for future in futures:
+            future.result()
+    finally:
+        stopped.set()
+        executor.shutdown()
+        journal.save()
+    return True
 
 
 class SimpleProgressBar:
@@ -777,6 +1515,7 @@ class SimpleProgressBar:
         self.received = 0
         self.speed = ''
         self.last_updated = time.time()
+        self.lock = threading.Lock()
 
         total_pieces_len = len(str(total_pieces))
         # 38 is the size of all statically known size in self.bar
@@ -812,19 +1551,21 @@ class SimpleProgressBar:
         sys.stdout.flush()
 
     def update_received(self, n):
-        self.received += n
-        time_diff = time.time() - self.last_updated
-        bytes_ps = n / time_diff if time_diff else 0
-        if bytes_ps >= 1024 ** 3:
-            self.speed = '{:4.0f} GB/s'.format(bytes_ps / 1024 ** 3)
-        elif bytes_ps >= 1024 ** 2:
-            self.speed = '{:4.0f} MB/s'.format(bytes_ps / 1024 ** 2)
-        elif bytes_ps >= 1024:
-            self.speed = '{:4.0f} kB/s'.format(bytes_ps / 1024)
-        else:
-            self.speed = '{:4.0f}  B/s'.format(bytes_ps)
-        self.last_updated = time.time()
-        self.update()
+        # may be called from several download threads at once
+        with self.lock:
+            self.received += n
+            time_diff = time.time() - self.last_updated
+            bytes_ps = n / time_diff if time_diff else 0
+            if bytes_ps >= 1024 ** 3:
+                self.speed = '{:4.0f} GB/s'.format(bytes_ps / 1024 ** 3)
+            elif bytes_ps >= 1024 ** 2:
+                self.speed = '{:4.0f} MB/s'.format(bytes_ps / 1024 ** 2)
+            elif bytes_ps >= 1024:
+                self.speed = '{:4.0f} kB/s'.format(bytes_ps / 1024)
+            else:
+                self.speed = '{:4.0f}  B/s'.format(bytes_ps)
+            self.last_updated = time.time()
+            self.update()
 
     def update_piece(self, n):
         self.current_piece = n
@@ -842,6 +1583,7 @@ class PiecesProgressBar:
         self.total_pieces = total_pieces
         self.current_piece = 1
         self.received = 0
+        self.lock = threading.Lock()
 
     def update(self):
         self.displayed = True
@@ -852,8 +1594,9 @@ class PiecesProgressBar:
         sys.stdout.flush()
 
     def update_received(self, n):
-        self.received += n
-        self.update()
+        with self.lock:
+            self.received += n
+            self.update()
 
     def update_piece(self, n):
         self.current_piece = n
@@ -878,9 +1621,46 @@ class DummyProgressBar:
         pass
 
 
+def run_in_threads(func, items, workers):
+    """Calls func on every item, using up to workers (daemon) threads.
+
+    If a call raises, the items not started yet are skipped and the
+    exception is re-raised once the running calls have returned.
+    """
+    items = iter(items)
+    lock = threading.Lock()
+    errors = []
+
+    @uses_session
+    def worker(session=None):
+        while True:
+            with lock:
+                item = next(items, None) if not errors else None
+            if item is None:
+                return
+            try:
+                func(*item)
+            except BaseException as e:
+                with lock:
+                    errors.append(e)
+                return
+
+    # the threads work in the session of the caller
+    session = get_session()
+    threads = [threading.Thread(target=worker, kwargs={'session': session},
+                                daemon=True)
+               for _ in range(max(workers, 1))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+
+
 def get_output_filename(urls, title, ext, output_dir, merge):
     # lame hack for the --output-filename option
-    global output_filename
+    output_filename = get_session().output_filename
     if output_filename:
         if ext:
             return output_filename + '.' + ext
@@ -908,18 +1688,20 @@ def print_user_agent(faker=False):
     user_agent = fake_headers['User-Agent'] if faker else urllib_default_user_agent
     print('User Agent: %s' % user_agent)
 
+@uses_session
 def download_urls(
     urls, title, ext, total_size, output_dir='.', refer=None, merge=True,
-    faker=False, headers={}, **kwargs
+    faker=False, headers={}, session=None, **kwargs
 ):
     assert urls
-    if json_output:
+    force = session.force
+    if session.json_output:
         json_output_.download_urls(
             urls=urls, title=title, ext=ext, total_size=total_size,
             refer=refer
         )
         return
-    if dry_run:
+    if session.dry_run:
         print_user_agent(faker=faker)
         try:
             print('Real URLs:\n%s' % '\n'.join(urls))
@@ -927,8 +1709,8 @@ def download_urls(
             print('Real URLs:\n%s' % '\n'.join([j for i in urls for j in i]))
         return
 
-    if player:
-        launch_player(player, urls)
+    if session.player:
+        launch_player(session.player, urls)
         return
 
     if not total_size:
@@ -944,11 +1726,15 @@ def download_urls(
     output_filepath = os.path.join(output_dir, output_filename)
 
     if total_size:
-        if not force and os.path.exists(output_filepath) and not auto_rename\
-                and os.path.getsize(output_filepath) >= total_size * 0.9:
+        if not force and os.path.exists(output_filepath) and \
+                not session.auto_rename and \
+                os.path.getsize(output_filepath) >= total_size * 0.9:
             log.w('Skipping %s: file already exists' % output_filepath)
             print()
             return
+    if session.progress_bar is not None:
+        bar = session.progress_bar(total_size, len(urls))
+    elif total_size:
         bar = SimpleProgressBar(total_size, len(urls))
     else:
         bar = PiecesProgressBar(total_size, len(urls))
@@ -970,13 +1756,68 @@ def download_urls(
             filename = '%s[%02d].%s' % (title, i, ext)
             filepath = os.path.join(output_dir, filename)
             parts.append(filepath)
-            # print 'Downloading %s [%s/%s]...' % (tr(filename), i + 1, len(urls))
-            bar.update_piece(i + 1)
-            url_save(
-                url, filepath, bar, refer=refer, is_part=True, faker=faker,
-                headers=headers, **kwargs
+        # parts finished by an interrupted run are skipped without asking
+        # the server again, as long as they are still on disk
+        journal = None if force else \
+            Journal.load(output_filepath + '.journal')
+        if journal is None:
+            journal = Journal(output_filepath + '.journal')
+        jobs = []
+        for i, (url, filepath) in enumerate(zip(urls, parts)):
+            size = journal.parts.get(os.path.basename(filepath))
+            if size is not None and os.path.isfile(filepath) and \
+                    os.path.getsize(filepath) == size:
+                bar.update_received(size)
+            else:
+                jobs.append((i, url, filepath))
+
+        def part_done(filepath):
+            journal.add_part(
+                os.path.basename(filepath), os.path.getsize(filepath)
+            )
+
+        prefetch_hosts([url for _, url, _ in jobs])
+        if engine == 'asyncio' and \
+                not any(type(url) is list for url in urls) and \
+                all(aio_supports(url) for url in urls):
+            # all parts are transferred by the event loop of the engine
+            from . import aio
+            tmp_headers = fake_headers.copy() if faker else dict(headers)
+            if refer is not None:
+                tmp_headers['Referer'] = refer
+            os.makedirs(output_dir or '.', exist_ok=True)
+            aio.save_parts(
+                [(url, filepath) for _, url, filepath in jobs], bar,
+                headers=tmp_headers, workers=part_workers,
+                timeout=stream_timeout(kwargs.get('timeout')),
+                on_done=part_done
             )
+        elif part_workers > 1:
+            # parts finish out of order, so count the finished ones instead
+            finished = []
+            bar.update_piece(0)
+
+            def save_part(i, url, filepath):
+                url_save(
+                    url, filepath, bar, refer=refer, is_part=True,
+                    faker=faker, headers=headers, **kwargs
+                )
+                part_done(filepath)
+                finished.append(filepath)
+                bar.update_piece(len(finished))
+
+            run_in_threads(save_part, jobs, part_workers)
+        else:
+            for i, url, filepath in jobs:
+                # print 'Downloading %s [%s/%s]...' % (tr(filename), i + 1, len(urls))
+                bar.update_piece(i + 1)
+                url_save(
+                    url, filepath, bar, refer=refer, is_part=True,
+                    faker=faker, headers=headers, **kwargs
+                )
+                part_done(filepath)
         bar.done()
+        journal.remove()
 
         if not merge:
             print()
@@ -984,9 +1825,26 @@ def download_urls(
 
         if 'av' in kwargs and kwargs['av']:
             from .processor.ffmpeg import has_ffmpeg_installed
-            if has_ffmpeg_installed():
+            from .processor.mux import can_mux, prefers_native, mux_av
+            ret = None
+            # muxed natively where that is faster, or ffmpeg is missing
+            if can_mux(ext) and (prefers_native(ext) or
+                                 not has_ffmpeg_installed()):
+                try:
+                    mux_av(parts, output_filepath, ext)
+                    ret = 0
+                except Exception as e:
+                    if not has_ffmpeg_installed():
+                        raise
+                    log.w('Cannot merge the parts natively (%s), '
+                          'using ffmpeg' % e)
+                    # ffmpeg would ask before overwriting it
+                    if os.path.exists(output_filepath):
+                        os.remove(output_filepath)
+            if ret is None and has_ffmpeg_installed():
                 from .processor.ffmpeg import ffmpeg_concat_av
                 ret = ffmpeg_concat_av(parts, output_filepath, ext)
+            if ret is not None:
                 print('Merged into %s' % output_filename)
                 if ret == 0:
                     for part in parts:
@@ -1011,12 +1869,18 @@ def download_urls(
         elif ext == 'mp4':
             try:
                 from .processor.ffmpeg import has_ffmpeg_installed
-                if has_ffmpeg_installed():
+                from .processor.join_mp4 import concat_mp4
+                # merged natively, which only copies the payloads, unless
+                # the parts are not supported
+                try:
+                    concat_mp4(parts, output_filepath)
+                except Exception as e:
+                    if not has_ffmpeg_installed():
+                        raise
+                    log.w('Cannot merge the parts natively (%s), '
+                          'using ffmpeg' % e)
                     from .processor.ffmpeg import ffmpeg_concat_mp4_to_mp4
                     ffmpeg_concat_mp4_to_mp4(parts, output_filepath)
-                else:
-                    from .processor.join_mp4 import concat_mp4
-                    concat_mp4(parts, output_filepath)
                 print('Merged into %s' % output_filename)
             except:
                 raise
@@ -1051,16 +1915,17 @@ def download_rtmp_url(
     merge=True, faker=False
 ):
     assert url
-    if dry_run:
+    session = get_session()
+    if session.dry_run:
         print_user_agent(faker=faker)
         print('Real URL:\n%s\n' % [url])
         if params.get('-y', False):  # None or unset -> False
             print('Real Playpath:\n%s\n' % [params.get('-y')])
         return
 
-    if player:
+    if session.player:
         from .processor.rtmpdump import play_rtmpdump_stream
-        play_rtmpdump_stream(player, url, params)
+        play_rtmpdump_stream(session.player, url, params)
         return
 
     from .processor.rtmpdump import (
@@ -1075,21 +1940,22 @@ def download_url_ffmpeg(
     merge=True, faker=False, stream=True
 ):
     assert url
-    if dry_run:
+    session = get_session()
+    if session.dry_run:
         print_user_agent(faker=faker)
         print('Real URL:\n%s\n' % [url])
         if params.get('-y', False):  # None or unset ->False
             print('Real Playpath:\n%s\n' % [params.get('-y')])
         return
 
-    if player:
-        launch_player(player, [url])
+    if session.player:
+        launch_player(session.player, [url])
         return
 
     from .processor.ffmpeg import has_ffmpeg_installed, ffmpeg_download_stream
     assert has_ffmpeg_installed(), 'FFmpeg not installed.'
 
-    global output_filename
+    output_filename = session.output_filename
     if output_filename:
         dotPos = output_filename.rfind('.')
         if dotPos > 0:
@@ -1110,7 +1976,7 @@ def playlist_not_supported(name):
 
 
 def print_info(site_info, title, type, size, **kwargs):
-    if json_output:
+    if get_session().json_output:
         json_output_.print_info(
             site_info=site_info, title=title, type=type, size=size
         )
@@ -1227,32 +2093,28 @@ def parse_host(host):
 
 
 def set_proxy(proxy):
-    proxy_handler = request.ProxyHandler({
+    get_session().proxies = {
         'http': '%s:%s' % proxy,
         'https': '%s:%s' % proxy,
-    })
-    opener = request.build_opener(proxy_handler)
-    request.install_opener(opener)
+    }
 
 
 def unset_proxy():
-    proxy_handler = request.ProxyHandler({})
-    opener = request.build_opener(proxy_handler)
-    request.install_opener(opener)
+    get_session().proxies = {}
 
 
 # DEPRECATED in favor of set_proxy() and unset_proxy()
 def set_http_proxy(proxy):
     if proxy is None:  # Use system default setting
-        proxy_support = request.ProxyHandler()
+        get_session().proxies = None
     elif proxy == '':  # Don't use any proxy
-        proxy_support = request.ProxyHandler({})
+        get_session().proxies = {}
     else:  # Use proxy
-        proxy_support = request.ProxyHandler(
-            {'http': '%s' % proxy, 'https': '%s' % proxy}
-        )
-    opener = request.build_opener(proxy_support)
-    request.install_opener(opener)
+        get_session().proxies = {'http': '%s' % proxy, 'https': '%s' % proxy}
+
+
+# keep connections alive by default
+request.install_opener(build_opener())
 
 
 def print_more_compatible(*args, **kwargs):
@@ -1284,8 +2146,147 @@ def download_main(download, download_playlist, urls, playlist, **kwargs):
             download(url, **kwargs)
 
 
+class OutputRouter(io.TextIOBase):
+    """A stream writing what each thread prints to an output of its own.
+
+    Args:
+        stream: The stream of the threads with no output in outputs.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        # thread identifiers to the streams of their outputs
+        self.outputs = {}
+
+    def write(self, text):
+        output = self.outputs.get(threading.get_ident())
+        if output is None:
+            return self.stream.write(text)
+        return output.write(text)
+
+    def flush(self):
+        self.stream.flush()
+
+
+def any_download_isolated(url, playlist=False, **kwargs):
+    """Like any_download() (or any_download_playlist()), with an extractor
+    instance of its own, so that downloads can run in parallel threads.
+    """
+    from .extractor import VideoExtractor
+
+    m, url = url_to_module(url)
+    site = getattr(m, 'site', None)
+    if playlist:
+        m.download_playlist(url, **kwargs)
+    elif isinstance(site, VideoExtractor) and \
+            m.download == site.download_by_url:
+        # extractors keep the state of the last URL
+        type(site)().download_by_url(url, **kwargs)
+    else:
+        m.download(url, **kwargs)
+
+
+def _run_job(router, settings, download, download_playlist, url, playlist,
+             kwargs):
+    # runs in a worker thread of download_jobs()
+    ident = threading.get_ident()
+    router.outputs[ident] = output = io.StringIO()
+    exc = None
+    try:
+        with DownloadSession(**settings):
+            if download is any_download and \
+                    download_playlist is any_download_playlist:
+                if re.match(r'https?://', url) is None:
+                    url = 'http://' + url
+                any_download_isolated(url, playlist, **kwargs)
+            else:
+                download_main(download, download_playlist, [url], playlist,
+                              **kwargs)
+    except (Exception, SystemExit) as e:
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            exc = traceback.format_exc()
+        else:
+            exc = '%s: %s' % (type(e).__name__, e)
+    finally:
+        del router.outputs[ident]
+    # keep only the last state of progress bars
+    text = '\n'.join(
+        line.rsplit('\r', 1)[-1] for line in output.getvalue().split('\n')
+    )
+    return text, exc
+
+
+def download_jobs(download, download_playlist, urls, playlist, jobs,
+                  **kwargs):
+    """Downloads up to jobs URLs at once, each in a thread and a session of
+    its own, with the settings of the current session.
+
+    The output of each URL is printed once it is done, in the order of urls,
+    followed by a summary.
+
+    Returns:
+        The number of URLs that failed.
+    """
+    started = time.time()
+    received = transfer_stats['bytes']
+    failed = 0
+    caller = get_session()
+    settings = {name: getattr(caller, name) for name in (
+        'force', 'dry_run', 'json_output', 'player', 'cookies',
+        'output_filename', 'auto_rename', 'insecure', 'proxies',
+        'connection_pool', 'progress_bar'
+    )}
+    results = [None] * len(urls)
+    finished = [threading.Event() for _ in urls]
+
+    def job(i):
+        try:
+            results[i] = _run_job(router, settings, download,
+                                  download_playlist, urls[i], playlist,
+                                  kwargs)
+        finally:
+            finished[i].set()
+
+    stdout, stderr = sys.stdout, sys.stderr
+    router = sys.stdout = OutputRouter(stdout)
+    # a job prints both to its own output
+    sys.stderr = OutputRouter(stderr)
+    sys.stderr.outputs = router.outputs
+    try:
+        # daemon threads, which an interrupt does not wait for
+        threading.Thread(target=run_in_threads,
+                         args=(job, [(i,) for i in range(len(urls))], jobs),
+                         daemon=True).start()
+        for i, url in enumerate(urls):
+            finished[i].wait()
+            text, exc = results[i]
+            log.i('[%d/%d] %s' % (i + 1, len(urls), url))
+            if text.strip():
+                print(text.rstrip('\n'))
+            if exc is not None:
+                failed += 1
+                log.e('[error] %s' % exc.rstrip('\n'))
+            sys.stdout.flush()
+    finally:
+        sys.stdout, sys.stderr = stdout, stderr
+    log.i('%d succeeded, %d failed, %.1f MB downloaded in %.1f s' % (
+        len(urls) - failed, failed,
+        (transfer_stats['bytes'] - received) / 1048576,
+        time.time() - started
+    ))
+    return failed
+
+
 def load_cookies(cookiefile):
     global cookies
+    cookies = read_cookies(cookiefile)
+
+
+def read_cookies(cookiefile):
+    """Returns a cookie jar of the cookies in cookies.txt or cookies.sqlite
+    (None if the format is not supported).
+    """
+    cookies = None
     if cookiefile.endswith('.txt'):
         # MozillaCookieJar treats prefix '#HttpOnly_' as comments incorrectly!
         # do not use its load()
@@ -1373,6 +2374,7 @@ def load_cookies(cookiefile):
         # SELECT host_key, path, secure, expires_utc, name, encrypted_value
         # FROM cookies
         # http://n8henrie.com/2013/11/use-chromes-cookies-for-easier-downloading-with-python-requests/
+    return cookies
 
 
 def set_socks_proxy(proxy):
@@ -1398,19 +2400,8 @@ def set_socks_proxy(proxy):
         )
 
 
-def script_main(download, download_playlist, **kwargs):
-    logging.basicConfig(format='[%(levelname)s] %(message)s')
-
-    def print_version():
-        version = get_version(
-            kwargs['repo_path'] if 'repo_path' in kwargs else __version__
-        )
-        log.i(
-            'version {}, a tiny downloader that scrapes the web.'.format(
-                version
-            )
-        )
-
+def build_parser():
+    """Returns the parser of the command line options."""
     parser = argparse.ArgumentParser(
         prog='you-get',
         usage='you-get [OPTION]... URL...',
@@ -1478,6 +2469,32 @@ def script_main(download, download_playlist, **kwargs):
         '-t', '--timeout', metavar='SECONDS', type=int, default=600,
         help='Set socket timeout'
     )
+    download_grp.add_argument(
+        '--connect-timeout', metavar='SECONDS', type=int, default=30,
+        help='Set timeout for establishing connections (default: 30)'
+    )
+    download_grp.add_argument(
+        '--stall-window', metavar='SECONDS', type=int, default=30,
+        help='Reconnect when a download gets below 1 KB/s for SECONDS '
+             '(default: 30, 0 to disable)'
+    )
+    download_grp.add_argument(
+        '--dns-ttl', metavar='SECONDS', type=int, default=60,
+        help='Cache DNS lookups for SECONDS (default: 60, 0 to disable)'
+    )
+    download_grp.add_argument(
+        '--limit-rate', metavar='RATE',
+        help='Limit the total download speed to RATE bytes/s (e.g. 500K, 2M)'
+    )
+    download_grp.add_argument(
+        '--limit-host-rate', metavar='HOST=RATE', action='append',
+        default=[], help='Limit the download speed from HOST to RATE bytes/s'
+    )
+    download_grp.add_argument(
+        '--read-size', metavar='MIN-MAX', default='64K-4M',
+        help='Bounds of the read size, which follows the download speed '
+             '(default: 64K-4M)'
+    )
     download_grp.add_argument(
         '-d', '--debug', action='store_true',
         help='Show traceback and other debug info'
@@ -1502,6 +2519,40 @@ def script_main(download, download_playlist, **kwargs):
         '-k', '--insecure', action='store_true', default=False,
         help='ignore ssl errors'
     )
+    download_grp.add_argument(
+        '--connections', metavar='N', type=int, default=1,
+        help='Download each file over N connections in parallel'
+    )
+    download_grp.add_argument(
+        '--part-workers', metavar='N', type=int, default=1,
+        help='Download up to N parts of a video at the same time'
+    )
+    download_grp.add_argument(
+        '-j', '--jobs', metavar='N', type=int, default=1,
+        help='Download up to N URLs at the same time'
+    )
+    download_grp.add_argument(
+        '--serve', metavar='[HOST:]PORT', nargs='?', const='127.0.0.1:8765',
+        help='Run a server taking download jobs over HTTP/JSON at '
+             '[HOST:]PORT (default: 127.0.0.1:8765), up to --jobs at a time'
+    )
+    download_grp.add_argument(
+        '--engine', choices=['urllib', 'asyncio'], default='urllib',
+        help='Set the HTTP client used for all requests (default: urllib; '
+        'asyncio needs Python 3.7)'
+    )
+    download_grp.add_argument(
+        '--retries', metavar='N', type=int, default=2,
+        help='Retry failed requests up to N times with backoff (default: 2)'
+    )
+    download_grp.add_argument(
+        '--cache-dir', metavar='DIR',
+        help='Cache responses of extractor requests in DIR'
+    )
+    download_grp.add_argument(
+        '--cache-ttl', metavar='SECONDS', type=int, default=3600,
+        help='Keep cached responses fresh for SECONDS (default: 3600)'
+    )
 
     proxy_grp = parser.add_argument_group('Proxy options')
     proxy_grp = proxy_grp.add_mutually_exclusive_group()
@@ -1525,6 +2576,23 @@ def script_main(download, download_playlist, **kwargs):
     download_grp.add_argument('--itag', help=argparse.SUPPRESS)
 
     parser.add_argument('URL', nargs='*', help=argparse.SUPPRESS)
+    return parser
+
+
+def script_main(download, download_playlist, **kwargs):
+    logging.basicConfig(format='[%(levelname)s] %(message)s')
+
+    def print_version():
+        version = get_version(
+            kwargs['repo_path'] if 'repo_path' in kwargs else __version__
+        )
+        log.i(
+            'version {}, a tiny downloader that scrapes the web.'.format(
+                version
+            )
+        )
+
+    parser = build_parser()
 
     args = parser.parse_args()
 
@@ -1548,6 +2616,16 @@ def script_main(download, download_playlist, **kwargs):
     global output_filename
     global auto_rename
     global insecure
+    global connections
+    global part_workers
+    global engine
+    global response_cache
+    global connect_timeout
+    global read_timeout
+    global stall_window
+    global rate_limiter
+    global read_size_min
+    global read_size_max
     output_filename = args.output_filename
     extractor_proxy = args.extractor_proxy
 
@@ -1579,6 +2657,12 @@ def script_main(download, download_playlist, **kwargs):
         # ignore ssl
         insecure = True
 
+    connections = max(args.connections, 1)
+    part_workers = max(args.part_workers, 1)
+    engine = args.engine
+    retry_policy.retries = max(args.retries, 0)
+    if args.cache_dir:
+        response_cache = ResponseCache(args.cache_dir, ttl=args.cache_ttl)
 
     if args.no_proxy:
         set_http_proxy('')
@@ -1586,6 +2670,14 @@ def script_main(download, download_playlist, **kwargs):
         set_http_proxy(args.http_proxy)
     if args.socks_proxy:
         set_socks_proxy(args.socks_proxy)
+        if engine == 'asyncio':
+            log.w('SOCKS proxy is not supported by asyncio engine, '
+                  'using urllib instead.')
+            engine = 'urllib'
+    if engine == 'asyncio' and sys.version_info < (3, 7):
+        log.w('asyncio engine needs Python 3.7 or later, '
+              'using urllib instead.')
+        engine = 'urllib'
 
     URLs = []
     if args.input_file:
@@ -1600,11 +2692,37 @@ def script_main(download, download_playlist, **kwargs):
         args.input_file.close()
     URLs.extend(args.URL)
 
-    if not URLs:
+    if not URLs and not args.serve:
         parser.print_help()
         sys.exit()
 
+    connect_timeout = args.connect_timeout
+    read_timeout = args.timeout
+    # for the requests which do not go through the pool, like those of
+    # extractors that install their own opener or call urlopen() directly
     socket.setdefaulttimeout(args.timeout)
+    stall_window = args.stall_window
+    dns_cache.ttl = max(args.dns_ttl, 0)
+    if args.limit_rate or args.limit_host_rate:
+        try:
+            rate_limiter = RateLimiter(
+                parse_rate(args.limit_rate) if args.limit_rate else None,
+                {host: parse_rate(rate) for host, rate in
+                 (x.split('=', 1) for x in args.limit_host_rate)}
+            )
+        except ValueError:
+            log.wtf('[Failed] Invalid rate limit.')
+    try:
+        read_size_min, read_size_max = sorted(
+            parse_rate(x) for x in args.read_size.split('-', 1)
+        )
+    except ValueError:
+        log.wtf('[Failed] Invalid read size.')
+
+    if args.serve:
+        from .server import serve
+        serve(args.serve, workers=max(args.jobs, 1))
+        return
 
     try:
         extra = {}
@@ -1612,6 +2730,17 @@ def script_main(download, download_playlist, **kwargs):
             extra['extractor_proxy'] = extractor_proxy
         if stream_id:
             extra['stream_id'] = stream_id
+        if args.jobs > 1 and len(URLs) > 1:
+            if download_jobs(
+                download, download_playlist,
+                URLs, args.playlist, args.jobs,
+                output_dir=args.output_dir, merge=not args.no_merge,
+                info_only=info_only, json_output=json_output,
+                caption=caption, password=args.password,
+                **extra
+            ):
+                sys.exit(1)
+            return
         download_main(
             download, download_playlist,
             URLs, args.playlist,
@@ -1620,6 +2749,20 @@ def script_main(download, download_playlist, **kwargs):
             password=args.password,
             **extra
         )
+        if engine == 'asyncio':
+            from .aio import stats
+        else:
+            stats = connection_pool.stats
+        logging.debug('connections: %(new)d new, %(reused)d reused' % stats)
+        logging.debug('stalled transfers: %(stalls)d' % transfer_stats)
+        logging.debug(
+            'TLS handshakes: %(full)d full, %(resumed)d resumed' %
+            tls_sessions.stats
+        )
+        logging.debug(
+            'DNS lookups: %(hits)d cached, %(misses)d resolved' %
+            dns_cache.stats
+        )
     except KeyboardInterrupt:
         if args.debug:
             raise
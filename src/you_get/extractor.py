@@ -1,12 +1,23 @@
 #!/usr/bin/env python
 
-from .common import match1, maybe_print, download_urls, get_filename, parse_host, set_proxy, unset_proxy, get_content, dry_run, player
+from .common import match1, maybe_print, download_urls, get_filename, parse_host, set_proxy, unset_proxy, get_content, get_session
+from .common import urls_size, run_in_threads, uses_session
+from . import common
 from .common import print_more_compatible as print
 from .util import log
 from . import json_output
 import os
 import sys
 
+class UnresolvedSize():
+    """Stands for the size of a stream until it is needed.
+
+    The size is then probed as the total size of the stream's src URLs.
+    """
+    def __init__(self, headers={}, faker=False):
+        self.headers = headers
+        self.faker = faker
+
 class Extractor():
     def __init__(self, *args):
         self.url = None
@@ -39,7 +50,8 @@ class VideoExtractor():
         if args:
             self.url = args[0]
 
-    def download_by_url(self, url, **kwargs):
+    @uses_session
+    def download_by_url(self, url, session=None, **kwargs):
         self.url = url
         self.vid = None
 
@@ -60,7 +72,8 @@ class VideoExtractor():
 
         self.download(**kwargs)
 
-    def download_by_vid(self, vid, **kwargs):
+    @uses_session
+    def download_by_vid(self, vid, session=None, **kwargs):
         self.url = None
         self.vid = vid
 
@@ -87,11 +100,43 @@ class VideoExtractor():
         pass
         #raise NotImplementedError()
 
+    def stream_size(self, stream_id):
+        if stream_id in self.streams:
+            stream = self.streams[stream_id]
+        else:
+            stream = self.dash_streams[stream_id]
+
+        size = stream.get('size')
+        if isinstance(size, UnresolvedSize):
+            urls = []
+            for src in stream['src']:
+                # DASH streams have a list of URLs per track
+                urls.extend(src if isinstance(src, list) else [src])
+            stream['size'] = urls_size(urls, faker=size.faker,
+                                       headers=size.headers)
+        return stream.get('size')
+
+    def resolve_sizes(self, stream_ids=None):
+        if stream_ids is None:
+            stream_ids = list(self.streams) + list(self.dash_streams)
+        run_in_threads(self.stream_size, [(i,) for i in stream_ids],
+                       common.size_probe_workers)
+
+    def best_dash_stream(self):
+        # with sizes left unresolved, extractors add DASH streams best first
+        if any(isinstance(self.dash_streams[i].get('size'), UnresolvedSize)
+               for i in self.dash_streams):
+            return list(self.dash_streams)[0]
+        itags = sorted(self.dash_streams,
+                       key=lambda i: -self.dash_streams[i]['size'])
+        return itags[0]
+
     def p_stream(self, stream_id):
         if stream_id in self.streams:
             stream = self.streams[stream_id]
         else:
             stream = self.dash_streams[stream_id]
+        self.stream_size(stream_id)
 
         if 'itag' in stream:
             print("    - itag:          %s" % log.sprint(stream_id, log.NEGATIVE))
@@ -126,6 +171,7 @@ class VideoExtractor():
             stream = self.streams[stream_id]
         else:
             stream = self.dash_streams[stream_id]
+        self.stream_size(stream_id)
 
         maybe_print("    - title:         %s" % self.title)
         print("       size:         %s MiB (%s bytes)" % (round(stream['size'] / 1048576, 1), stream['size']))
@@ -149,6 +195,7 @@ class VideoExtractor():
             self.p_stream(stream_id)
 
         elif stream_id == []:
+            self.resolve_sizes()
             print("streams:             # Available quality and codecs")
             # Print DASH streams
             if self.dash_streams:
@@ -202,11 +249,15 @@ class VideoExtractor():
             else:
                 # Download stream with the best quality
                 from .processor.ffmpeg import has_ffmpeg_installed
-                if has_ffmpeg_installed() and player is None and self.dash_streams or not self.streams_sorted:
+                from .processor.mux import can_mux
+                # DASH streams need muxing, by ffmpeg or natively
+                dash = self.dash_streams and get_session().player is None \
+                    and (has_ffmpeg_installed() or can_mux(
+                        self.dash_streams[self.best_dash_stream()]['container']
+                    ))
+                if dash or not self.streams_sorted:
                     #stream_id = list(self.dash_streams)[-1]
-                    itags = sorted(self.dash_streams,
-                                   key=lambda i: -self.dash_streams[i]['size'])
-                    stream_id = itags[0]
+                    stream_id = self.best_dash_stream()
                 else:
                     stream_id = self.streams_sorted[0]['id'] if 'id' in self.streams_sorted[0] else self.streams_sorted[0]['itag']
 
@@ -215,14 +266,13 @@ class VideoExtractor():
             else:
                 self.p_i(stream_id)
 
+            total_size = self.stream_size(stream_id)
             if stream_id in self.streams:
                 urls = self.streams[stream_id]['src']
                 ext = self.streams[stream_id]['container']
-                total_size = self.streams[stream_id]['size']
             else:
                 urls = self.dash_streams[stream_id]['src']
                 ext = self.dash_streams[stream_id]['container']
-                total_size = self.dash_streams[stream_id]['size']
 
             if ext == 'm3u8' or ext == 'm4a':
                 ext = 'mp4'
@@ -253,13 +303,13 @@ class VideoExtractor():
                     x.write(srt)
                 print('Done.')
 
-            if self.danmaku is not None and not dry_run:
+            if self.danmaku is not None and not get_session().dry_run:
                 filename = '{}.cmt.xml'.format(get_filename(self.title))
                 print('Downloading {} ...\n'.format(filename))
                 with open(os.path.join(kwargs['output_dir'], filename), 'w', encoding='utf8') as fp:
                     fp.write(self.danmaku)
 
-            if self.lyrics is not None and not dry_run:
+            if self.lyrics is not None and not get_session().dry_run:
                 filename = '{}.lrc'.format(get_filename(self.title))
                 print('Downloading {} ...\n'.format(filename))
                 with open(os.path.join(kwargs['output_dir'], filename), 'w', encoding='utf8') as fp:
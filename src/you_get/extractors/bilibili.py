@@ -1,9 +1,10 @@
 #!/usr/bin/env python
 
 from ..common import *
-from ..extractor import VideoExtractor
+from ..extractor import VideoExtractor, UnresolvedSize
 
 import hashlib
+from collections import OrderedDict
 
 class Bilibili(VideoExtractor):
     name = "Bilibili"
@@ -40,6 +41,12 @@ class Bilibili(VideoExtractor):
         else:
             return 80
 
+    def sort_dash_streams(self):
+        # best quality first, as DASH sizes are only probed when needed
+        order = ['dash-' + s['id'] for s in self.stream_types]
+        self.dash_streams = OrderedDict(sorted(self.dash_streams.items(),
+                                               key=lambda x: order.index(x[0])))
+
     @staticmethod
     def bilibili_headers(referer=None, cookie=None):
         # a reasonable UA
@@ -235,7 +242,6 @@ class Bilibili(VideoExtractor):
 
                 # DASH formats
                 if 'dash' in playinfo['data']:
-                    audio_size_cache = {}
                     for video in playinfo['data']['dash']['video']:
                         # prefer the latter codecs!
                         s = self.stream_qualities[video['id']]
@@ -244,7 +250,7 @@ class Bilibili(VideoExtractor):
                         desc = s['desc']
                         audio_quality = s['audio_quality']
                         baseurl = video['baseUrl']
-                        size = url_size(baseurl, headers=self.bilibili_headers(referer=self.url))
+                        size = UnresolvedSize(headers=self.bilibili_headers(referer=self.url))
 
                         # find matching audio track
                         audio_baseurl = playinfo['data']['dash']['audio'][0]['baseUrl']
@@ -252,12 +258,10 @@ class Bilibili(VideoExtractor):
                             if int(audio['id']) == audio_quality:
                                 audio_baseurl = audio['baseUrl']
                                 break
-                        if not audio_size_cache.get(audio_quality, False):
-                            audio_size_cache[audio_quality] = url_size(audio_baseurl, headers=self.bilibili_headers(referer=self.url))
-                        size += audio_size_cache[audio_quality]
 
                         self.dash_streams[format_id] = {'container': container, 'quality': desc,
                                                         'src': [[baseurl], [audio_baseurl]], 'size': size}
+            self.sort_dash_streams()
 
             # get danmaku
             self.danmaku = get_content('http://comment.bilibili.com/%s.xml' % cid)
@@ -324,7 +328,7 @@ class Bilibili(VideoExtractor):
                         desc = s['desc']
                         audio_quality = s['audio_quality']
                         baseurl = video['baseUrl']
-                        size = url_size(baseurl, headers=self.bilibili_headers(referer=self.url))
+                        size = UnresolvedSize(headers=self.bilibili_headers(referer=self.url))
 
                         # find matching audio track
                         audio_baseurl = playinfo['result']['dash']['audio'][0]['baseUrl']
@@ -332,10 +336,10 @@ class Bilibili(VideoExtractor):
                             if int(audio['id']) == audio_quality:
                                 audio_baseurl = audio['baseUrl']
                                 break
-                        size += url_size(audio_baseurl, headers=self.bilibili_headers(referer=self.url))
 
                         self.dash_streams[format_id] = {'container': container, 'quality': desc,
                                                         'src': [[baseurl], [audio_baseurl]], 'size': size}
+            self.sort_dash_streams()
 
             # get danmaku
             self.danmaku = get_content('http://comment.bilibili.com/%s.xml' % cid)
@@ -364,26 +364,23 @@ def url_save_icourses(url, filepath, bar, total_size, dyn_callback=None, is_part
 # For other segments, content-length is the standard one, 15 * 1024 * 1024
 
     with open(temp_filepath, open_mode) as output:
-        before_this_uri = received
-# received - before_this_uri is size of the buf we get from one uri
+        receiver = Receiver(url, output, bar, offset=received)
         while True:
-            update_bs = 256 * 1024
-            left_bytes = total_size - received
-            to_read = left_bytes if left_bytes <= update_bs else update_bs
 # calc the block size to read -- The server can fail to send an EOF
-            buffer = response.read(to_read)
-            if not buffer:
-                logging.debug('Got EOF from server')
-                break
-            output.write(buffer)
-            received += len(buffer)
-            bar.update_received(len(buffer))
+            end = min(total_size, received + max_size) if max_size else total_size
+            result = receiver.receive(response, end)
+            received = receiver.offset
             if received >= total_size:
                 break
-            if max_size and (received - before_this_uri) >= max_size:
-                url = dyn_update_url(received)
-                before_this_uri = received
-                response = urlopen_with_retry(request.Request(url, headers=headers))
+            if result == Receiver.EOF:
+                # broken off before the end, which is never renamed to the
+                # file: go on from there, up to the retries of the policy
+                logging.debug('Got EOF from server')
+                sleep(receiver.fail())
+            # on to the next URL, or a new one if this one has stalled
+            response.close()
+            url = dyn_update_url(received)
+            response = urlopen_with_retry(request.Request(url, headers=headers))
 
     assert received == os.path.getsize(temp_filepath), '%s == %s' % (received, os.path.getsize(temp_filepath))
 
@@ -1,7 +1,7 @@
 #!/usr/bin/env python
 
 from ..common import *
-from ..extractor import VideoExtractor
+from ..extractor import VideoExtractor, UnresolvedSize
 from .universal import *
 
 class Imgur(VideoExtractor):
@@ -71,7 +71,7 @@ class Imgur(VideoExtractor):
         if 'stream_id' in kwargs and kwargs['stream_id']:
             i = kwargs['stream_id']
             if 'size' not in self.streams[i]:
-                self.streams[i]['size'] = urls_size(self.streams[i]['src'])
+                self.streams[i]['size'] = UnresolvedSize()
 
 site = Imgur()
 download = site.download_by_url
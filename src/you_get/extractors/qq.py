@@ -60,6 +60,9 @@ def qq_download_by_vid(vid, title, output_dir='.', merge=True, info_only=False):
             break
 
         part_urls.append(url)
+
+    prefetch_url_headers(part_urls)
+    for url in part_urls:
         _, ext, size = url_info(url)
         total_size += size
 
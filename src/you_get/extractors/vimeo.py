@@ -4,7 +4,7 @@ __all__ = ['vimeo_download', 'vimeo_download_by_id', 'vimeo_download_by_channel'
 
 from ..common import *
 from ..util.log import *
-from ..extractor import VideoExtractor
+from ..extractor import VideoExtractor, UnresolvedSize
 from json import loads
 import urllib.error
 import urllib.parse
@@ -74,7 +74,7 @@ class VimeoExtractor(VideoExtractor):
 
     def extract(self, **kwargs):
         for s in self.streams:
-            self.streams[s]['size'] = urls_size(self.streams[s]['src'])
+            self.streams[s]['size'] = UnresolvedSize()
 
         master_m3u8s = []
         for m in self.master_m3u8:
@@ -3,7 +3,7 @@
 import re
 
 from ..common import *
-from ..extractor import VideoExtractor
+from ..extractor import VideoExtractor, UnresolvedSize
 
 from xml.dom.minidom import parseString
 
@@ -378,6 +378,9 @@ class YouTube(VideoExtractor):
         try:
             dashmpd = ytplayer_config['args']['dashmpd']
             dash_xml = parseString(get_content(dashmpd))
+            # sizes not given in the manifest are probed only for the
+            # stream downloaded, which cannot be chunked by range then
+            bandwidths = {}
             for aset in dash_xml.getElementsByTagName('AdaptationSet'):
                 mimeType = aset.getAttribute('mimeType')
                 if mimeType == 'audio/mp4':
@@ -385,17 +388,11 @@ class YouTube(VideoExtractor):
                     burls = rep.getElementsByTagName('BaseURL')
                     dash_mp4_a_url = burls[0].firstChild.nodeValue
                     dash_mp4_a_size = burls[0].getAttribute('yt:contentLength')
-                    if not dash_mp4_a_size:
-                        try: dash_mp4_a_size = url_size(dash_mp4_a_url)
-                        except: continue
                 elif mimeType == 'audio/webm':
                     rep = aset.getElementsByTagName('Representation')[-1]
                     burls = rep.getElementsByTagName('BaseURL')
                     dash_webm_a_url = burls[0].firstChild.nodeValue
                     dash_webm_a_size = burls[0].getAttribute('yt:contentLength')
-                    if not dash_webm_a_size:
-                        try: dash_webm_a_size = url_size(dash_webm_a_url)
-                        except: continue
                 elif mimeType == 'video/mp4':
                     for rep in aset.getElementsByTagName('Representation'):
                         w = int(rep.getAttribute('width'))
@@ -404,11 +401,14 @@ class YouTube(VideoExtractor):
                         burls = rep.getElementsByTagName('BaseURL')
                         dash_url = burls[0].firstChild.nodeValue
                         dash_size = burls[0].getAttribute('yt:contentLength')
-                        if not dash_size:
-                            try: dash_size = url_size(dash_url)
-                            except: continue
-                        dash_urls = self.__class__.chunk_by_range(dash_url, int(dash_size))
-                        dash_mp4_a_urls = self.__class__.chunk_by_range(dash_mp4_a_url, int(dash_mp4_a_size))
+                        if dash_size and dash_mp4_a_size:
+                            dash_urls = self.__class__.chunk_by_range(dash_url, int(dash_size))
+                            dash_mp4_a_urls = self.__class__.chunk_by_range(dash_mp4_a_url, int(dash_mp4_a_size))
+                            size = int(dash_size) + int(dash_mp4_a_size)
+                        else:
+                            dash_urls, dash_mp4_a_urls = [dash_url], [dash_mp4_a_url]
+                            size = UnresolvedSize()
+                        bandwidths[itag] = int(rep.getAttribute('bandwidth') or 0)
                         self.dash_streams[itag] = {
                             'quality': '%sx%s' % (w, h),
                             'itag': itag,
@@ -416,7 +416,7 @@ class YouTube(VideoExtractor):
                             'mime': mimeType,
                             'container': 'mp4',
                             'src': [dash_urls, dash_mp4_a_urls],
-                            'size': int(dash_size) + int(dash_mp4_a_size)
+                            'size': size
                         }
                 elif mimeType == 'video/webm':
                     for rep in aset.getElementsByTagName('Representation'):
@@ -426,11 +426,14 @@ class YouTube(VideoExtractor):
                         burls = rep.getElementsByTagName('BaseURL')
                         dash_url = burls[0].firstChild.nodeValue
                         dash_size = burls[0].getAttribute('yt:contentLength')
-                        if not dash_size:
-                            try: dash_size = url_size(dash_url)
-                            except: continue
-                        dash_urls = self.__class__.chunk_by_range(dash_url, int(dash_size))
-                        dash_webm_a_urls = self.__class__.chunk_by_range(dash_webm_a_url, int(dash_webm_a_size))
+                        if dash_size and dash_webm_a_size:
+                            dash_urls = self.__class__.chunk_by_range(dash_url, int(dash_size))
+                            dash_webm_a_urls = self.__class__.chunk_by_range(dash_webm_a_url, int(dash_webm_a_size))
+                            size = int(dash_size) + int(dash_webm_a_size)
+                        else:
+                            dash_urls, dash_webm_a_urls = [dash_url], [dash_webm_a_url]
+                            size = UnresolvedSize()
+                        bandwidths[itag] = int(rep.getAttribute('bandwidth') or 0)
                         self.dash_streams[itag] = {
                             'quality': '%sx%s' % (w, h),
                             'itag': itag,
@@ -438,8 +441,11 @@ class YouTube(VideoExtractor):
                             'mime': mimeType,
                             'container': 'webm',
                             'src': [dash_urls, dash_webm_a_urls],
-                            'size': int(dash_size) + int(dash_webm_a_size)
+                            'size': size
                         }
+            # best first, as sizes left unresolved cannot rank them
+            self.dash_streams = dict(sorted(self.dash_streams.items(),
+                                            key=lambda x: -bandwidths[x[0]]))
         except:
             # VEVO
             if not self.html5player: return
@@ -542,7 +548,7 @@ class YouTube(VideoExtractor):
                 src += '&signature={}'.format(sig)
 
             self.streams[stream_id]['src'] = [src]
-            self.streams[stream_id]['size'] = urls_size(self.streams[stream_id]['src'])
+            self.streams[stream_id]['size'] = UnresolvedSize()
 
 
 site = YouTube()
@@ -6,6 +6,8 @@ last_info = None
 
 def output(video_extractor, pretty_print=True):
     ve = video_extractor
+    if hasattr(ve, 'resolve_sizes'):
+        ve.resolve_sizes(list(ve.streams))
     out = {}
     out['url'] = ve.url
     out['title'] = ve.title
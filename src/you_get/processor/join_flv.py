@@ -3,6 +3,8 @@
 import struct
 from io import BytesIO
 
+from ..util.fs import copy_range
+
 TAG_TYPE_METADATA = 18
 
 ##################################################
@@ -200,7 +202,7 @@ def read_unsigned_medium_int(stream):
     x1, x2, x3 = struct.unpack('BBB', stream.read(3))
     return (x1 << 16) | (x2 << 8) | x3
 
-def read_tag(stream):
+def read_tag_header(stream):
     # header size: 15 bytes
     header = stream.read(15)
     if len(header) == 4:
@@ -213,6 +215,13 @@ def read_tag(stream):
     timestamp = (x[5] << 16) | (x[6] << 8) | x[7]
     timestamp += x[8] << 24
     assert x[9:] == (0, 0, 0)
+    return (data_type, timestamp, body_size, previous_tag_size)
+
+def read_tag(stream):
+    header = read_tag_header(stream)
+    if not header:
+        return
+    data_type, timestamp, body_size, previous_tag_size = header
     body = stream.read(body_size)
     return (data_type, timestamp, body_size, body, previous_tag_size)
     #previous_tag_size = read_uint(stream)
@@ -225,18 +234,17 @@ def read_tag(stream):
     #body = stream.read(body_size)
     #return (data_type, timestamp, body_size, body, previous_tag_size)
 
+def write_tag_header(stream, data_type, timestamp, body_size,
+                     previous_tag_size):
+    stream.write(struct.pack('>IB', previous_tag_size, data_type) +
+                 body_size.to_bytes(3, 'big') +
+                 (timestamp & 0xffffff).to_bytes(3, 'big') +
+                 bytes([timestamp>>24 & 0xff]) + b'\0\0\0')
+
 def write_tag(stream, tag):
     data_type, timestamp, body_size, body, previous_tag_size = tag
-    write_uint(stream, previous_tag_size)
-    write_byte(stream, data_type)
-    write_byte(stream, body_size>>16 & 0xff)
-    write_byte(stream, body_size>>8  & 0xff)
-    write_byte(stream, body_size     & 0xff)
-    write_byte(stream, timestamp>>16 & 0xff)
-    write_byte(stream, timestamp>>8  & 0xff)
-    write_byte(stream, timestamp     & 0xff)
-    write_byte(stream, timestamp>>24 & 0xff)
-    stream.write(b'\0\0\0')
+    write_tag_header(stream, data_type, timestamp, body_size,
+                     previous_tag_size)
     stream.write(body)
 
 def read_flv_header(stream):
@@ -322,16 +330,20 @@ def concat_flv(flvs, output = None):
     timestamp_start = 0
     for stream in ins:
         while True:
-            tag = read_tag(stream)
-            if tag:
-                data_type, timestamp, body_size, body, previous_tag_size = tag
+            header = read_tag_header(stream)
+            if header:
+                data_type, timestamp, body_size, previous_tag_size = header
                 timestamp += timestamp_start
-                tag = data_type, timestamp, body_size, body, previous_tag_size
-                write_tag(out, tag)
+                write_tag_header(out, data_type, timestamp, body_size,
+                                 previous_tag_size)
+                # large bodies are copied by the kernel
+                copy_range(stream, out, body_size)
             else:
                 break
         timestamp_start = timestamp
+        stream.close()
     write_uint(out, previous_tag_size)
+    out.close()
     
     return output
 
@@ -7,8 +7,13 @@
 ##################################################
 
 import struct
+import sys
+from array import array
+from bisect import bisect_right
 from io import BytesIO
 
+from ..util.fs import copy_range
+
 def skip(stream, n):
     stream.seek(stream.tell() + n)
 
@@ -36,14 +41,32 @@ def read_ulong(stream):
 def read_byte(stream):
     return ord(stream.read(1))
 
+# array typecode of 32-bit unsigned ints
+UINT32 = 'I' if array('I').itemsize == 4 else 'L'
+UINT64 = 'Q'
+
+def read_uint_array(stream, n, typecode=UINT32):
+    """Reads n big-endian unsigned ints at once into an array."""
+    a = array(typecode)
+    data = stream.read(n * a.itemsize)
+    assert len(data) == n * a.itemsize, 'no enough data'
+    a.frombytes(data)
+    if sys.byteorder == 'little':
+        a.byteswap()
+    return a
+
+def write_uint_array(stream, a):
+    if sys.byteorder == 'little':
+        a = array(a.typecode, a)
+        a.byteswap()
+    stream.write(a.tobytes())
+
+def shift_array(a, delta, typecode=None):
+    """Returns a copy of the array a with delta added to all its items."""
+    return array(typecode or a.typecode, map(delta.__add__, a))
+
 def copy_stream(source, target, n):
-    buffer_size = 1024 * 1024
-    while n > 0:
-        to_read = min(buffer_size, n)
-        s = source.read(to_read)
-        assert len(s) == to_read, 'no enough data'
-        target.write(s)
-        n -= to_read
+    copy_range(source, target, n)
 
 class Atom:
     def __init__(self, type, size, body):
@@ -57,6 +80,11 @@ class Atom:
     def __repr__(self):
         return str(self)
     def write1(self, stream):
+        if self.size > 0xffffffff:
+            write_uint(stream, 1)
+            stream.write(self.type)
+            write_ulong(stream, self.size)
+            return
         write_uint(stream, self.size)
         stream.write(self.type)
     def write(self, stream):
@@ -84,7 +112,7 @@ class CompositeAtom(Atom):
             if a.type == k:
                 return a
         else:
-            raise Exception('atom not found: ' + k)
+            raise Exception('atom not found: %s' % k)
     def get(self, *keys):
         atom = self
         for k in keys:
@@ -165,15 +193,27 @@ def read_full_atom2(stream):
 
 def read_mvhd(stream, size, left, type):
     body, stream = read_body_stream(stream, left)
-    value = read_full_atom(stream)
+    ver, value = read_full_atom2(stream)
     left -= 4
     
     # new Date(movieTime * 1000 - 2082850791998L); 
-    creation_time = read_uint(stream)
-    modification_time = read_uint(stream)
-    time_scale = read_uint(stream)
-    duration = read_uint(stream)
-    left -= 16
+    if ver == 1:
+        creation_time = read_ulong(stream)
+        modification_time = read_ulong(stream)
+        time_scale = read_uint(stream)
+        duration = read_ulong(stream)
+        var = [('time_scale', 20, time_scale, 4),
+               ('duration', 24, duration, 8)]
+        left -= 28
+    else:
+        assert ver == 0, "ver=%d" % ver
+        creation_time = read_uint(stream)
+        modification_time = read_uint(stream)
+        time_scale = read_uint(stream)
+        duration = read_uint(stream)
+        var = [('time_scale', 12, time_scale, 4),
+               ('duration', 16, duration, 4)]
+        left -= 16
     
     qt_preferred_fate = read_uint(stream)
     qt_preferred_volume = read_ushort(stream)
@@ -194,22 +234,36 @@ def read_mvhd(stream, size, left, type):
     qt_selectionDuration = read_uint(stream)
     qt_currentTime = read_uint(stream)
     nextTrackID = read_uint(stream)
+    # the last field
+    var.append(('next_track_id', 4 + (28 if ver == 1 else 16) + 76,
+                nextTrackID, 4))
     left -= 80
     assert left == 0
-    return VariableAtom(b'mvhd', size, body, [('duration', 16, duration, 4)])
+    return VariableAtom(b'mvhd', size, body, var)
 
 def read_tkhd(stream, size, left, type):
     body, stream = read_body_stream(stream, left)
-    value = read_full_atom(stream)
+    ver, value = read_full_atom2(stream)
     left -= 4
     
     # new Date(movieTime * 1000 - 2082850791998L); 
-    creation_time = read_uint(stream)
-    modification_time = read_uint(stream)
-    track_id = read_uint(stream)
-    assert stream.read(4) == b'\x00' * 4
-    duration = read_uint(stream)
-    left -= 20
+    if ver == 1:
+        creation_time = read_ulong(stream)
+        modification_time = read_ulong(stream)
+        track_id = read_uint(stream)
+        assert stream.read(4) == b'\x00' * 4
+        duration = read_ulong(stream)
+        var = [('track_id', 20, track_id, 4), ('duration', 28, duration, 8)]
+        left -= 32
+    else:
+        assert ver == 0, "ver=%d" % ver
+        creation_time = read_uint(stream)
+        modification_time = read_uint(stream)
+        track_id = read_uint(stream)
+        assert stream.read(4) == b'\x00' * 4
+        duration = read_uint(stream)
+        var = [('track_id', 12, track_id, 4), ('duration', 20, duration, 4)]
+        left -= 20
     
     assert stream.read(8) == b'\x00' * 8
     qt_layer = read_ushort(stream)
@@ -231,7 +285,7 @@ def read_tkhd(stream, size, left, type):
     height = qt_track_height >> 16
     left -= 60
     assert left == 0
-    return VariableAtom(b'tkhd', size, body, [('duration', 20, duration, 4)])
+    return VariableAtom(b'tkhd', size, body, var)
 
 def read_mdhd(stream, size, left, type):
     body, stream = read_body_stream(stream, left)
@@ -243,7 +297,8 @@ def read_mdhd(stream, size, left, type):
         modification_time = read_ulong(stream)
         time_scale = read_uint(stream)
         duration = read_ulong(stream)
-        var = [('duration', 24, duration, 8)]
+        var = [('time_scale', 20, time_scale, 4),
+               ('duration', 24, duration, 8)]
         left -= 28
     else: 
         assert ver == 0, "ver=%d" % ver
@@ -251,7 +306,8 @@ def read_mdhd(stream, size, left, type):
         modification_time = read_uint(stream)
         time_scale = read_uint(stream)
         duration = read_uint(stream)
-        var = [('duration', 16, duration, 4)]
+        var = [('time_scale', 12, time_scale, 4),
+               ('duration', 16, duration, 4)]
         left -= 16
     
     packed_language = read_ushort(stream)
@@ -360,12 +416,9 @@ def read_stts(stream, size, left, type):
     #assert entry_count == 1
     left -= 4
     
-    samples = []
-    for i in range(entry_count):
-        sample_count = read_uint(stream)
-        sample_duration = read_uint(stream)
-        samples.append((sample_count, sample_duration))
-        left -= 8
+    # sample_count, sample_duration pairs, flattened
+    samples = read_uint_array(stream, entry_count * 2)
+    left -= entry_count * 8
 
     assert left == 0
     #return Atom('stts', size, None)
@@ -375,14 +428,10 @@ def read_stts(stream, size, left, type):
         def write(self, stream):
             self.write1(stream)
             write_uint(stream, self.body[0])
-            write_uint(stream, len(self.body[1]))
-            for sample_count, sample_duration in self.body[1]:
-                write_uint(stream, sample_count)
-                write_uint(stream, sample_duration)
+            write_uint(stream, len(self.body[1]) // 2)
+            write_uint_array(stream, self.body[1])
         def calsize(self):
-            #oldsize = self.size # TODO: remove
-            self.size = 8 + 4 + 4 + len(self.body[1]) * 8
-            #assert oldsize == self.size, '%s: %d, %d' % (self.type, oldsize, self.size) # TODO: remove
+            self.size = 8 + 4 + 4 + len(self.body[1]) * 4
             return self.size
     return stts_atom(b'stts', size, (value, samples))
 
@@ -393,11 +442,8 @@ def read_stss(stream, size, left, type):
     entry_count = read_uint(stream)
     left -= 4
     
-    samples = []
-    for i in range(entry_count):
-            sample = read_uint(stream)
-            samples.append(sample)
-            left -= 4
+    samples = read_uint_array(stream, entry_count)
+    left -= entry_count * 4
     
     assert left == 0
     #return Atom('stss', size, None)
@@ -408,8 +454,7 @@ def read_stss(stream, size, left, type):
             self.write1(stream)
             write_uint(stream, self.body[0])
             write_uint(stream, len(self.body[1]))
-            for sample in self.body[1]:
-                write_uint(stream, sample)
+            write_uint_array(stream, self.body[1])
         def calsize(self):
             self.size = 8 + 4 + 4 + len(self.body[1]) * 4
             return self.size
@@ -422,14 +467,11 @@ def read_stsc(stream, size, left, type):
     entry_count = read_uint(stream)
     left -= 4
     
-    chunks = []
-    for i in range(entry_count):
-        first_chunk = read_uint(stream)
-        samples_per_chunk = read_uint(stream)
-        sample_description_index = read_uint(stream)
-        assert sample_description_index == 1 # what is it?
-        chunks.append((first_chunk, samples_per_chunk, sample_description_index))
-        left -= 12
+    # first_chunk, samples_per_chunk, sample_description_index triples,
+    # flattened
+    chunks = read_uint_array(stream, entry_count * 3)
+    assert set(chunks[2::3]) <= {1} # what is it?
+    left -= entry_count * 12
     #chunks, samples = zip(*chunks)
     #total = 0
     #for c, s in zip(chunks[1:], samples):
@@ -444,13 +486,10 @@ def read_stsc(stream, size, left, type):
         def write(self, stream):
             self.write1(stream)
             write_uint(stream, self.body[0])
-            write_uint(stream, len(self.body[1]))
-            for first_chunk, samples_per_chunk, sample_description_index in self.body[1]:
-                write_uint(stream, first_chunk)
-                write_uint(stream, samples_per_chunk)
-                write_uint(stream, sample_description_index)
+            write_uint(stream, len(self.body[1]) // 3)
+            write_uint_array(stream, self.body[1])
         def calsize(self):
-            self.size = 8 + 4 + 4 + len(self.body[1]) * 12
+            self.size = 8 + 4 + 4 + len(self.body[1]) * 4
             return self.size
     return stsc_atom(b'stsc', size, (value, chunks))
 
@@ -463,14 +502,8 @@ def read_stsz(stream, size, left, type):
     left -= 8
     
     assert sample_size == 0
-    total = 0
-    sizes = []
-    if sample_size == 0:
-        for i in range(sample_count):
-            entry_size = read_uint(stream)
-            sizes.append(entry_size)
-            total += entry_size
-            left -= 4
+    sizes = read_uint_array(stream, sample_count)
+    left -= sample_count * 4
     
     assert left == 0
     #return Atom('stsz', size, None)
@@ -482,55 +515,56 @@ def read_stsz(stream, size, left, type):
             write_uint(stream, self.body[0])
             write_uint(stream, self.body[1])
             write_uint(stream, self.body[2])
-            for entry_size in self.body[3]:
-                write_uint(stream, entry_size)
+            write_uint_array(stream, self.body[3])
         def calsize(self):
             self.size = 8 + 4 + 8 + len(self.body[3]) * 4
             return self.size
     return stsz_atom(b'stsz', size, (value, sample_size, sample_count, sizes))
 
 def read_stco(stream, size, left, type):
+    # also reads co64, and writes either depending on its type
     value = read_full_atom(stream)
     left -= 4
     
     entry_count = read_uint(stream)
     left -= 4
     
-    offsets = []
-    for i in range(entry_count):
-        chunk_offset = read_uint(stream)
-        offsets.append(chunk_offset)
-        left -= 4
+    offsets = read_uint_array(stream, entry_count,
+                              UINT64 if type == b'co64' else UINT32)
+    left -= entry_count * offsets.itemsize
     
     assert left == 0
     #return Atom('stco', size, None)
     class stco_atom(Atom):
         def __init__(self, type, size, body):
             Atom.__init__(self, type, size, body)
+        def typecode(self):
+            return UINT64 if self.type == b'co64' else UINT32
         def write(self, stream):
+            offsets = self.body[1]
+            if offsets.typecode != self.typecode():
+                offsets = array(self.typecode(), offsets)
             self.write1(stream)
             write_uint(stream, self.body[0])
-            write_uint(stream, len(self.body[1]))
-            for chunk_offset in self.body[1]:
-                write_uint(stream, chunk_offset)
+            write_uint(stream, len(offsets))
+            write_uint_array(stream, offsets)
         def calsize(self):
-            self.size = 8 + 4 + 4 + len(self.body[1]) * 4
+            self.size = 8 + 4 + 4 + \
+                len(self.body[1]) * array(self.typecode()).itemsize
             return self.size
-    return stco_atom(b'stco', size, (value, offsets))
+    return stco_atom(type, size, (value, offsets))
 
 def read_ctts(stream, size, left, type):
-    value = read_full_atom(stream)
+    # version 1 has signed offsets, which are merged just the same
+    ver, value = read_full_atom2(stream)
     left -= 4
     
     entry_count = read_uint(stream)
     left -= 4
     
-    samples = []
-    for i in range(entry_count):
-        sample_count = read_uint(stream)
-        sample_offset = read_uint(stream)
-        samples.append((sample_count, sample_offset))
-        left -= 8
+    # sample_count, sample_offset pairs, flattened
+    samples = read_uint_array(stream, entry_count * 2)
+    left -= entry_count * 8
     
     assert left == 0
     class ctts_atom(Atom):
@@ -539,12 +573,10 @@ def read_ctts(stream, size, left, type):
         def write(self, stream):
             self.write1(stream)
             write_uint(stream, self.body[0])
-            write_uint(stream, len(self.body[1]))
-            for sample_count, sample_offset in self.body[1]:
-                write_uint(stream, sample_count)
-                write_uint(stream, sample_offset)
+            write_uint(stream, len(self.body[1]) // 2)
+            write_uint_array(stream, self.body[1])
         def calsize(self):
-            self.size = 8 + 4 + 4 + len(self.body[1]) * 8
+            self.size = 8 + 4 + 4 + len(self.body[1]) * 4
             return self.size
     return ctts_atom(b'ctts', size, (value, samples))
 
@@ -577,6 +609,9 @@ def read_mp4a(stream, size, left, type):
     assert atom.type == b'esds'
     left -= atom.size
     
+    # other children, like the btrt of ffmpeg, are kept in the raw body
+    while left > 0:
+        left -= read_atom(stream).size
     assert left == 0
     return Atom(b'mp4a', size, body)
 
@@ -612,6 +647,14 @@ def read_mdat(stream, size, left, type):
     class mdat_atom(Atom):
         def __init__(self, type, size, body):
             Atom.__init__(self, type, size, body)
+        def write1(self, stream):
+            # keeps a 64-bit size header, as offsets may count on its size
+            if self.size - self.body[2] == 16:
+                write_uint(stream, 1)
+                stream.write(self.type)
+                write_ulong(stream, self.size)
+            else:
+                Atom.write1(self, stream)
         def write(self, stream):
             self.write1(stream)
             self.write2(stream)
@@ -624,6 +667,38 @@ def read_mdat(stream, size, left, type):
             return self.size
     return mdat_atom(b'mdat', size, (stream, source_start, source_size))
 
+def read_mfhd(stream, size, left, type):
+    body, stream = read_body_stream(stream, left)
+    skip(stream, 4) # version and flags
+    sequence_number = read_uint(stream)
+    return VariableAtom(b'mfhd', size, body,
+                        [('sequence_number', 4, sequence_number, 4)])
+
+def read_tfhd(stream, size, left, type):
+    body, stream = read_body_stream(stream, left)
+    ver, value = read_full_atom2(stream)
+    flags = value & 0xffffff
+    track_id = read_uint(stream)
+    var = [('track_id', 4, track_id, 4)]
+    if flags & 0x01:
+        var.append(('base_data_offset', 8, read_ulong(stream), 8))
+    if flags & 0x02:
+        skip(stream, 4) # sample_description_index
+    default_sample_duration = read_uint(stream) if flags & 0x08 else None
+    atom = VariableAtom(b'tfhd', size, body, var)
+    atom.flags = flags
+    atom.default_sample_duration = default_sample_duration
+    return atom
+
+def read_tfdt(stream, size, left, type):
+    body, stream = read_body_stream(stream, left)
+    ver, value = read_full_atom2(stream)
+    if ver == 1:
+        var = [('base_media_decode_time', 4, read_ulong(stream), 8)]
+    else:
+        var = [('base_media_decode_time', 4, read_uint(stream), 4)]
+    return VariableAtom(b'tfdt', size, body, var)
+
 atom_readers = {
     b'mvhd': read_mvhd, # merge duration
     b'tkhd': read_tkhd, # merge duration
@@ -638,6 +713,7 @@ atom_readers = {
     b'stsc': read_stsc, # merge # sample numbers
     b'stsz': read_stsz, # merge # samples
     b'stco': read_stco, # merge # chunk offsets
+    b'co64': read_stco, # merge # 64-bit chunk offsets
     b'ctts': read_ctts, # merge
     b'smhd': read_smhd, # nothing
     b'mp4a': read_mp4a, # nothing
@@ -659,6 +735,13 @@ atom_readers = {
 
     b'mdat': read_mdat,
     b'udta': read_udta,
+
+    b'mvex': read_composite_atom,
+    b'moof': read_composite_atom,
+    b'traf': read_composite_atom,
+    b'mfhd': read_mfhd, # renumber
+    b'tfhd': read_tfhd, # move base_data_offset
+    b'tfdt': read_tfdt, # move base_media_decode_time
 }
 #stsd sample descriptions (codec types, initialization etc.) 
 #stts (decoding) time-to-sample  
@@ -679,6 +762,7 @@ atom_readers = {
 
 
 def read_atom(stream):
+    offset = stream.tell()
     header = stream.read(8)
     if not header:
         return
@@ -689,15 +773,16 @@ def read_atom(stream):
     n += 4
     type = header[4:8]
     n += 4
-    assert type != b'uuid'
     if size == 1:
         size = read_ulong(stream)
         n += 8
     
     left = size - n
-    if type in atom_readers:
-        return atom_readers[type](stream, size, left, type)
-    raise NotImplementedError('%s: %d' % (type, left))
+    # atoms that need no changes are copied as they are
+    atom = atom_readers.get(type, read_raw)(stream, size, left, type)
+    # position in the file, to move offsets relative to it
+    atom.offset = offset
+    return atom
 
 def write_atom(stream, atom):
     atom.write(stream)
@@ -716,68 +801,103 @@ def read_mp4(stream):
     print(stream.name)
     atoms = parse_atoms(stream)
     moov = list(filter(lambda x: x.type == b'moov', atoms))
-    mdat = list(filter(lambda x: x.type == b'mdat', atoms))
-    assert len(moov) == 1
-    assert len(mdat) == 1
-    moov = moov[0]
-    mdat = mdat[0]
-    return atoms, moov, mdat
+    mdats = list(filter(lambda x: x.type == b'mdat', atoms))
+    # a DASH init segment has no mdat, and a media segment no moov
+    assert len(moov) <= 1
+    moov = moov[0] if moov else None
+    return atoms, moov, mdats
 
 ##################################################
 # merge
 ##################################################
 
+def get_stco(trak):
+    """Returns the stco or co64 atom of a trak."""
+    stbl = trak.get(b'mdia', b'minf', b'stbl')
+    for atom in stbl.body:
+        if atom.type in (b'stco', b'co64'):
+            return atom
+    raise Exception('atom not found: stco')
+
+def concat_arrays(arrays):
+    results = array(UINT32)
+    for a in arrays:
+        results += a
+    return results
+
 def merge_stts(samples_list):
-    sample_list = []
-    for samples in samples_list:
-        #assert len(samples) == 1
-        #sample_list.append(samples[0])
-        sample_list += samples
-    counts, durations = zip(*sample_list)
+    sample_list = concat_arrays(samples_list)
+    durations = sample_list[1::2]
     #assert len(set(durations)) == 1, 'not all durations equal'
     if len(set(durations)) == 1:
-        return [(sum(counts), durations[0])]
+        return array(UINT32, [sum(sample_list[0::2]), durations[0]])
     return sample_list
 
 def merge_stss(samples, sample_number_list):
-    results = []
+    results = array(UINT32)
     start = 0
     for samples, sample_number_list in zip(samples, sample_number_list):
-        results.extend(map(lambda x: start + x, samples))
+        results += shift_array(samples, start)
         start += sample_number_list
     return results
 
 def merge_stsc(chunks_list, total_chunk_number_list):
-    results = []
+    results = array(UINT32)
     chunk_index = 1
     for chunks, total in zip(chunks_list, total_chunk_number_list):
-        for i in range(len(chunks)):
-            if i < len(chunks) - 1:
-                chunk_number = chunks[i + 1][0] - chunks[i][0]
-            else:
-                chunk_number = total + 1 - chunks[i][0]
-            sample_number = chunks[i][1]
-            description = chunks[i][2]
-            results.append((chunk_index, sample_number, description))
+        first_chunks = chunks[0::3].tolist()
+        # chunks of each entry, the last entry running to the last chunk
+        chunk_numbers = [b - a for a, b in
+                         zip(first_chunks, first_chunks[1:] + [total + 1])]
+        for i, chunk_number in enumerate(chunk_numbers):
+            results += array(UINT32, [chunk_index, chunks[i * 3 + 1],
+                                      chunks[i * 3 + 2]])
             chunk_index += chunk_number
     return results
 
-def merge_stco(offsets_list, mdats):
-    offset = 0
-    results = []
-    for offsets, mdat in zip(offsets_list, mdats):
-        results.extend(offset + x - mdat.body[1] for x in offsets)
-        offset += mdat.size - 8
+def merge_stco(offsets_list, mdats_list, start=0, typecode=UINT32):
+    """Maps the chunk offsets of each file into the payloads of its mdats,
+    as they are concatenated from start in the merged file.
+    """
+    offset = start
+    results = array(typecode)
+    for offsets, mdats in zip(offsets_list, mdats_list):
+        if len(mdats) == 1:
+            results += shift_array(offsets, offset - mdats[0].body[1],
+                                   typecode)
+        else:
+            starts = [mdat.body[1] for mdat in mdats]
+            deltas = []
+            for mdat in mdats:
+                deltas.append(offset - mdat.body[1])
+                offset += mdat.body[2]
+            results += array(typecode, (
+                x + deltas[bisect_right(starts, x) - 1] for x in offsets
+            ))
+            continue
+        offset += mdats[0].body[2]
     return results
 
 def merge_stsz(sizes_list):
-    return sum(sizes_list, [])
+    return concat_arrays(sizes_list)
+
+def mdat_header_size(payload_size):
+    # a 64-bit size follows the type if the size does not fit in 32 bits
+    return 8 if payload_size + 8 <= 0xffffffff else 16
 
 def merge_mdats(mdats):
-    total_size = sum(x.size - 8 for x in mdats) + 8
+    payload_size = sum(x.body[2] for x in mdats)
+    total_size = payload_size + mdat_header_size(payload_size)
     class multi_mdat_atom(Atom):
         def __init__(self, type, size, body):
             Atom.__init__(self, type, size, body)
+        def write1(self, stream):
+            if self.size > 0xffffffff:
+                write_uint(stream, 1)
+                stream.write(self.type)
+                write_ulong(stream, self.size)
+            else:
+                Atom.write1(self, stream)
         def write(self, stream):
             self.write1(stream)
             self.write2(stream)
@@ -788,104 +908,315 @@ def merge_mdats(mdats):
             return self.size
     return multi_mdat_atom(b'mdat', total_size, mdats)
 
-def merge_moov(moovs, mdats):
-    mvhd_duration = 0
-    for x in moovs:
-        mvhd_duration += x.get(b'mvhd').get('duration')
-    tkhd_durations = [0, 0]
-    mdhd_durations = [0, 0]
-    for x in moovs:
-        traks = x.get_all(b'trak')
-        assert len(traks) == 2
-        tkhd_durations[0] += traks[0].get(b'tkhd').get('duration')
-        tkhd_durations[1] += traks[1].get(b'tkhd').get('duration')
-        mdhd_durations[0] += traks[0].get(b'mdia', b'mdhd').get('duration')
-        mdhd_durations[1] += traks[1].get(b'mdia', b'mdhd').get('duration')
-    #mvhd_duration = min(mvhd_duration, tkhd_durations)
-    
-    trak0s = [x.get_all(b'trak')[0] for x in moovs]
-    trak1s = [x.get_all(b'trak')[1] for x in moovs]
+def new_atom(type, body):
+    """Returns an atom of type with body, as read by its reader."""
+    return read_atom(BytesIO(struct.pack('>I', 8 + len(body)) + type + body))
+
+# sample tables which are dropped, as they cannot be merged yet; they are
+# all optional
+UNMERGED_SAMPLE_TABLES = (b'sdtp', b'sbgp', b'subs', b'stsh', b'padb', b'stdp')
+
+def read_elst(trak):
+    """Returns the edits of the edit list of trak, as (segment_duration,
+    media_time, media_rate), or None if it has none.
+    """
+    for edts in trak.get_all(b'edts'):
+        body = edts.body
+        i = 0
+        while i < len(body):
+            size, type = struct.unpack('>I4s', body[i:i + 8])
+            if type == b'elst':
+                ver = body[i + 8]
+                entry_count, = struct.unpack('>I', body[i + 12:i + 16])
+                fmt = '>QqI' if ver == 1 else '>IiI'
+                return list(struct.iter_unpack(fmt, body[
+                    i + 16:i + 16 + entry_count * struct.calcsize(fmt)
+                ]))
+            i += size
+    return None
+
+def merge_edts(traks, time_scales):
+    """Merges the edit lists of several tracks into the first one, with
+    their media times moved to where their samples go in the merged
+    track, so that all parts are played and not only the first one.
+
+    Args:
+        time_scales: The time scales of the movies of the tracks, which
+            their segment durations are in.
+    """
+    elsts = [read_elst(x) for x in traks]
+    if all(x is None for x in elsts):
+        return
+    edits = []
+    media_start = 0
+    for trak, elst, time_scale in zip(traks, elsts, time_scales):
+        if elst is None:
+            # the whole track, from its start
+            elst = [(trak.get(b'tkhd').get('duration'), 0, 0x10000)]
+        for duration, media_time, rate in elst:
+            duration = duration * time_scales[0] // time_scale
+            # -1 is an empty edit, which has no media
+            if media_time != -1:
+                media_time += media_start
+            edits.append((duration, media_time, rate))
+        media_start += trak.get(b'mdia', b'mdhd').get('duration')
     
-    stts0 = merge_stts(x.get(b'mdia', b'minf', b'stbl', b'stts').body[1] for x in trak0s)
-    stts1 = merge_stts(x.get(b'mdia', b'minf', b'stbl', b'stts').body[1] for x in trak1s)
+    if max(max(d, t) for d, t, _ in edits) <= 0x7fffffff:
+        ver, fmt = 0, '>IiI'
+    else:
+        ver, fmt = 1, '>QqI'
+    elst = struct.pack('>II', ver << 24, len(edits)) + \
+        b''.join(struct.pack(fmt, *x) for x in edits)
+    edts = new_atom(b'edts', struct.pack('>I', 8 + len(elst)) + b'elst' +
+                    elst)
+    trak = traks[0]
+    trak.body = [x for x in trak.body if x.type != b'edts']
+    # edts goes after tkhd
+    trak.body.insert(1, edts)
+
+def merge_trak(traks):
+    """Merges the tracks of several files into the first one, except for
+    their chunk offsets, which are returned.
+    """
+    trak = traks[0]
+    trak.get(b'tkhd').set('duration', sum(
+        x.get(b'tkhd').get('duration') for x in traks
+    ))
+    trak.get(b'mdia', b'mdhd').set('duration', sum(
+        x.get(b'mdia', b'mdhd').get('duration') for x in traks
+    ))
     
-    stss = merge_stss((x.get(b'mdia', b'minf', b'stbl', b'stss').body[1] for x in trak0s), (len(x.get(b'mdia', b'minf', b'stbl', b'stsz').body[3]) for x in trak0s))
+    stbls = [x.get(b'mdia', b'minf', b'stbl') for x in traks]
+    sample_numbers = [len(x.get(b'stsz').body[3]) for x in stbls]
+    stco_list = [get_stco(x).body[1] for x in traks]
     
-    stsc0 = merge_stsc((x.get(b'mdia', b'minf', b'stbl', b'stsc').body[1] for x in trak0s), (len(x.get(b'mdia', b'minf', b'stbl', b'stco').body[1]) for x in trak0s))
-    stsc1 = merge_stsc((x.get(b'mdia', b'minf', b'stbl', b'stsc').body[1] for x in trak1s), (len(x.get(b'mdia', b'minf', b'stbl', b'stco').body[1]) for x in trak1s))
+    stts = merge_stts(x.get(b'stts').body[1] for x in stbls)
+    stsc = merge_stsc((x.get(b'stsc').body[1] for x in stbls),
+                      map(len, stco_list))
+    stsz = merge_stsz(x.get(b'stsz').body[3] for x in stbls)
+    # no stss means that all samples are sync samples, no ctts that they
+    # have no composition offsets
+    if any(x.get_all(b'stss') for x in stbls):
+        stss = merge_stss((x.get(b'stss').body[1] if x.get_all(b'stss')
+                           else array(UINT32, range(1, n + 1))
+                           for x, n in zip(stbls, sample_numbers)),
+                          sample_numbers)
+    else:
+        stss = None
+    if any(x.get_all(b'ctts') for x in stbls):
+        ctts = concat_arrays(x.get(b'ctts').body[1] if x.get_all(b'ctts')
+                             else array(UINT32, [n, 0])
+                             for x, n in zip(stbls, sample_numbers))
+    else:
+        ctts = None
     
-    stco0 = merge_stco((x.get(b'mdia', b'minf', b'stbl', b'stco').body[1] for x in trak0s), mdats)
-    stco1 = merge_stco((x.get(b'mdia', b'minf', b'stbl', b'stco').body[1] for x in trak1s), mdats)
+    stbl = stbls[0]
+    stbl.body = [x for x in stbl.body if x.type not in UNMERGED_SAMPLE_TABLES]
+    for type, table in ((b'stss', stss), (b'ctts', ctts)):
+        if table is not None and not stbl.get_all(type):
+            stbl.body.append(new_atom(type, bytes(8)))
     
-    stsz0 = merge_stsz((x.get(b'mdia', b'minf', b'stbl', b'stsz').body[3] for x in trak0s))
-    stsz1 = merge_stsz((x.get(b'mdia', b'minf', b'stbl', b'stsz').body[3] for x in trak1s))
+    stts_atom = stbl.get(b'stts')
+    stts_atom.body = stts_atom.body[0], stts
+    stsc_atom = stbl.get(b'stsc')
+    stsc_atom.body = stsc_atom.body[0], stsc
+    stsz_atom = stbl.get(b'stsz')
+    stsz_atom.body = stsz_atom.body[0], stsz_atom.body[1], len(stsz), stsz
+    if stss is not None:
+        stss_atom = stbl.get(b'stss')
+        stss_atom.body = stss_atom.body[0], stss
+    if ctts is not None:
+        ctts_atom = stbl.get(b'ctts')
+        ctts_atom.body = ctts_atom.body[0], ctts
     
-    ctts = sum((x.get(b'mdia', b'minf', b'stbl', b'ctts').body[1] for x in trak0s), [])
+    return stco_list
+
+def layout_moov(moov, stco_atoms, header_size, payload_size):
+    """Makes the chunk offset atoms of moov co64 if the payloads that
+    follow it end past 4 GiB, and stco otherwise.
+
+    Returns:
+        The offset of the payloads, after header_size bytes of other atoms,
+        the moov and the header of their mdat.
+    """
+    for atom_type in (b'stco', b'co64'):
+        for stco_atom in stco_atoms:
+            stco_atom.type = atom_type
+        mdat_start = header_size + moov.calsize() + \
+            mdat_header_size(payload_size)
+        if mdat_start + payload_size <= 0xffffffff:
+            break
+    return mdat_start
+
+def merge_moov(moovs, mdats_list, header_size):
+    """Merges the moovs of files, for a merged file made of header_size
+    bytes of other atoms, the merged moov, and one mdat with all the
+    payloads of mdats_list, the mdats of each file.
+    """
+    traks_list = [x.get_all(b'trak') for x in moovs]
+    assert len(set(map(len, traks_list))) == 1, 'not the same tracks'
     
     moov = moovs[0]
+    moov.get(b'mvhd').set('duration', sum(
+        x.get(b'mvhd').get('duration') for x in moovs
+    ))
+    time_scales = [x.get(b'mvhd').get('time_scale') for x in moovs]
     
-    moov.get(b'mvhd').set('duration', mvhd_duration)
-    trak0 = moov.get_all(b'trak')[0]
-    trak1 = moov.get_all(b'trak')[1]
-    trak0.get(b'tkhd').set('duration', tkhd_durations[0])
-    trak1.get(b'tkhd').set('duration', tkhd_durations[1])
-    trak0.get(b'mdia', b'mdhd').set('duration', mdhd_durations[0])
-    trak1.get(b'mdia', b'mdhd').set('duration', mdhd_durations[1])
-    
-    stts_atom = trak0.get(b'mdia', b'minf', b'stbl', b'stts')
-    stts_atom.body = stts_atom.body[0], stts0
-    stts_atom = trak1.get(b'mdia', b'minf', b'stbl', b'stts')
-    stts_atom.body = stts_atom.body[0], stts1
-    
-    stss_atom = trak0.get(b'mdia', b'minf', b'stbl', b'stss')
-    stss_atom.body = stss_atom.body[0], stss
-    
-    stsc_atom = trak0.get(b'mdia', b'minf', b'stbl', b'stsc')
-    stsc_atom.body = stsc_atom.body[0], stsc0
-    stsc_atom = trak1.get(b'mdia', b'minf', b'stbl', b'stsc')
-    stsc_atom.body = stsc_atom.body[0], stsc1
-    
-    stco_atom = trak0.get(b'mdia', b'minf', b'stbl', b'stco')
-    stco_atom.body = stss_atom.body[0], stco0
-    stco_atom = trak1.get(b'mdia', b'minf', b'stbl', b'stco')
-    stco_atom.body = stss_atom.body[0], stco1
-    
-    stsz_atom = trak0.get(b'mdia', b'minf', b'stbl', b'stsz')
-    stsz_atom.body = stsz_atom.body[0], stsz_atom.body[1], len(stsz0), stsz0
-    stsz_atom = trak1.get(b'mdia', b'minf', b'stbl', b'stsz')
-    stsz_atom.body = stsz_atom.body[0], stsz_atom.body[1], len(stsz1), stsz1
-    
-    ctts_atom = trak0.get(b'mdia', b'minf', b'stbl', b'ctts')
-    ctts_atom.body = ctts_atom.body[0], ctts
-    
-    old_moov_size = moov.size
-    new_moov_size = moov.calsize()
-    new_mdat_start = mdats[0].body[1] + new_moov_size - old_moov_size
-    stco0 = list(map(lambda x: x + new_mdat_start, stco0))
-    stco1 = list(map(lambda x: x + new_mdat_start, stco1))
-    stco_atom = trak0.get(b'mdia', b'minf', b'stbl', b'stco')
-    stco_atom.body = stss_atom.body[0], stco0
-    stco_atom = trak1.get(b'mdia', b'minf', b'stbl', b'stco')
-    stco_atom.body = stss_atom.body[0], stco1
+    stco_atoms = [get_stco(x) for x in traks_list[0]]
+    # offsets are merged once the size of the new moov is known, these
+    # only have the right sizes
+    stco_lists = []
+    for traks, stco_atom in zip(zip(*traks_list), stco_atoms):
+        # before the durations of the first track are summed
+        merge_edts(traks, time_scales)
+        stco_list = merge_trak(traks)
+        stco_lists.append(stco_list)
+        stco_atom.body = (stco_atom.body[0],
+                          array(UINT32, [0]) * sum(map(len, stco_list)))
+    
+    payload_size = sum(x.body[2] for mdats in mdats_list for x in mdats)
+    new_mdat_start = layout_moov(moov, stco_atoms, header_size, payload_size)
+    typecode = stco_atoms[0].typecode()
+    for stco_atom, stco_list in zip(stco_atoms, stco_lists):
+        stco_atom.body = stco_atom.body[0], merge_stco(
+            stco_list, mdats_list, new_mdat_start, typecode
+        )
     
     return moov
 
+# top-level atoms of fragmented files which are dropped, as their offsets
+# and indexes do not hold in the merged file
+FRAGMENT_INDEX_ATOMS = (b'styp', b'sidx', b'ssix', b'mfra')
+
+def trun_duration(trun, default_duration):
+    """Returns the total duration of the samples of a trun atom."""
+    value, sample_count = struct.unpack('>II', trun.body[:8])
+    flags = value & 0xffffff
+    if not flags & 0x100:
+        return sample_count * default_duration
+    # data_offset and first_sample_flags come before the samples
+    offset = 8 + 4 * bin(flags & 0x005).count('1')
+    fields = bin(flags & 0xf00).count('1')
+    samples = read_uint_array(BytesIO(trun.body[offset:]),
+                              sample_count * fields)
+    # the duration is the first field of each sample
+    return sum(samples[::fields])
+
+def merge_moof(moof, sequence_number, shift, default_durations, ends,
+               deltas):
+    """Renumbers a moof, moves its base data offsets by shift, and its
+    decode times after the ends of the previous fragments of its tracks.
+
+    Args:
+        default_durations: The default sample durations of the tracks.
+        ends: The decode times at which the tracks end so far, updated.
+        deltas: What the decode times of the tracks of this file are moved
+            by, updated.
+    """
+    moof.get(b'mfhd').set('sequence_number', sequence_number)
+    for traf in moof.get_all(b'traf'):
+        tfhd = traf.get(b'tfhd')
+        track_id = tfhd.get('track_id')
+        if tfhd.flags & 0x01:
+            tfhd.set('base_data_offset', tfhd.get('base_data_offset') + shift)
+        default_duration = tfhd.default_sample_duration
+        if default_duration is None:
+            default_duration = default_durations.get(track_id, 0)
+        duration = sum(trun_duration(x, default_duration)
+                       for x in traf.get_all(b'trun'))
+        
+        end = ends.get(track_id, 0)
+        tfdts = traf.get_all(b'tfdt')
+        if tfdts:
+            time = tfdts[0].get('base_media_decode_time')
+            if track_id not in deltas:
+                # a file whose timeline starts again goes after the others
+                deltas[track_id] = max(end - time, 0)
+            time += deltas[track_id]
+            assert time < 1 << 8 * tfdts[0].variables[0][3], \
+                'decode time too large for tfdt'
+            tfdts[0].set('base_media_decode_time', time)
+        else:
+            time = end
+        ends[track_id] = time + duration
+
+def is_fragmented(atoms, moov):
+    """Tells whether an MP4 file is fragmented, including a DASH init
+    segment (a moov with mvex, but no moof) and a media segment.
+    """
+    if any(x.type == b'moof' for x in atoms):
+        return True
+    return moov is not None and bool(moov.get_all(b'mvex'))
+
+def merge_fragments(mp4s, output):
+    """Concatenates fragmented MP4 files into output. The moov of the first
+    file is kept, along with the fragments of all files, so that a DASH init
+    segment followed by its media segments makes a single file.
+    """
+    moov = mp4s[0][1]
+    assert moov is not None, 'no moov in the first file'
+    mvex = moov.get(b'mvex')
+    default_durations = {}
+    for trex in mvex.get_all(b'trex'):
+        track_id, = struct.unpack('>I', trex.body[4:8])
+        default_durations[track_id], = struct.unpack('>I', trex.body[12:16])
+    # the duration of the fragments of the first file only
+    mvex.body = [x for x in mvex.body if x.type != b'mehd']
+    moov.calsize()
+    
+    sequence_number = 0
+    position = 0
+    ends = {}
+    for i, (atoms, _, _) in enumerate(mp4s):
+        deltas = {}
+        for atom in atoms:
+            if atom.type in FRAGMENT_INDEX_ATOMS:
+                continue
+            if i > 0 and atom.type in (b'ftyp', b'moov'):
+                continue
+            if atom.type == b'moof':
+                sequence_number += 1
+                merge_moof(atom, sequence_number, position - atom.offset,
+                           default_durations, ends, deltas)
+            atom.write(output)
+            position += atom.calsize()
+
 def merge_mp4s(files, output):
+    """Merges MP4 files into output in a single pass, with the moov before
+    the mdat (faststart) so that it can be played while downloaded.
+    Fragmented files are concatenated fragment by fragment instead.
+    """
     assert files
     ins = [open(mp4, 'rb') for mp4 in files]
-    mp4s = list(map(read_mp4, ins))
-    moovs = list(map(lambda x: x[1], mp4s))
-    mdats = list(map(lambda x: x[2], mp4s))
-    moov = merge_moov(moovs, mdats)
-    mdat = merge_mdats(mdats)
-    with open(output, 'wb') as output:
-        for x in mp4s[0][0]:
-            if x.type == b'moov':
-                moov.write(output)
-            elif x.type == b'mdat':
-                mdat.write(output)
-            else:
+    try:
+        mp4s = list(map(read_mp4, ins))
+        fragmented = [is_fragmented(atoms, moov)
+                      for atoms, moov, _ in mp4s]
+        if any(fragmented):
+            if not all(fragmented):
+                raise NotImplementedError(
+                    'fragmented and non-fragmented files'
+                )
+            with open(output, 'wb') as output:
+                merge_fragments(mp4s, output)
+            return
+        moovs = list(map(lambda x: x[1], mp4s))
+        assert None not in moovs, 'no moov found'
+        mdats_list = list(map(lambda x: x[2], mp4s))
+        assert all(mdats_list), 'no mdat found'
+        # ftyp and the like, in their order
+        headers = [x for x in mp4s[0][0] if x.type not in (b'moov', b'mdat')]
+        header_size = sum(x.calsize() for x in headers)
+        moov = merge_moov(moovs, mdats_list, header_size)
+        mdat = merge_mdats([x for mdats in mdats_list for x in mdats])
+        with open(output, 'wb') as output:
+            for x in headers:
                 x.write(output)
+            moov.write(output)
+            mdat.write(output)
+    finally:
+        for stream in ins:
+            stream.close()
 
 ##################################################
 # main
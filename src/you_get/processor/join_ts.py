@@ -3,6 +3,8 @@
 import struct
 from io import BytesIO
 
+from ..util.fs import copy_range
+
 ##################################################
 # main
 ##################################################
@@ -26,13 +28,10 @@ def concat_ts(ts_parts, output = None):
     
     print('Merging video parts...')
     
-    ts_out_file = open(output, "wb")
-    for ts_in in ts_parts:
-        ts_in_file = open(ts_in, "rb")
-        ts_in_data = ts_in_file.read()
-        ts_in_file.close()
-        ts_out_file.write(ts_in_data)
-    ts_out_file.close()
+    with open(output, "wb") as ts_out_file:
+        for ts_in in ts_parts:
+            with open(ts_in, "rb") as ts_in_file:
+                copy_range(ts_in_file, ts_out_file, os.path.getsize(ts_in))
     return output
 
 def usage():
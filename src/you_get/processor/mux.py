@@ -0,0 +1,625 @@
+#!/usr/bin/env python
+
+# muxes the video and the audio of DASH streams, downloaded as two files,
+# into one file, by remuxing only: payloads are copied as they are
+
+import heapq
+import struct
+from array import array
+from bisect import bisect_right
+from io import BytesIO
+
+from ..util.fs import copy_range
+from .join_mp4 import (FRAGMENT_INDEX_ATOMS, get_stco, is_fragmented,
+                       layout_moov, mdat_header_size, merge_moof, read_mp4,
+                       trun_duration)
+
+##################################################
+# mp4
+##################################################
+
+def rescale(n, time_scale, new_time_scale):
+    return n * new_time_scale // time_scale
+
+def rescale_edts(edts, time_scale, new_time_scale):
+    """Rescales the segment durations of the edit lists of an edts atom,
+    which are in the time scale of the movie.
+    """
+    body = bytearray(edts.body)
+    i = 0
+    while i < len(body):
+        size, type = struct.unpack('>I4s', body[i:i + 8])
+        if type == b'elst':
+            ver = body[i + 8]
+            entry_count, = struct.unpack('>I', body[i + 12:i + 16])
+            fmt, entry_size = ('>Q', 20) if ver == 1 else ('>I', 12)
+            for j in range(i + 16, i + 16 + entry_count * entry_size,
+                           entry_size):
+                duration, = struct.unpack_from(fmt, body, j)
+                struct.pack_into(fmt, body, j,
+                                 rescale(duration, time_scale, new_time_scale))
+        i += size
+    edts.body = bytes(body)
+
+def add_traks(moov, traks, time_scale, trexs=()):
+    """Moves traks, from a movie of time_scale, and their trex atoms into
+    moov, with track IDs after its own.
+
+    Returns:
+        The new track IDs, by the former ones.
+    """
+    mvhd = moov.get(b'mvhd')
+    new_time_scale = mvhd.get('time_scale')
+    track_ids = [x.get(b'tkhd').get('track_id')
+                 for x in moov.get_all(b'trak')]
+    next_track_id = max([mvhd.get('next_track_id')] +
+                        [x + 1 for x in track_ids])
+    new_track_ids = {}
+    for trak in traks:
+        tkhd = trak.get(b'tkhd')
+        new_track_ids[tkhd.get('track_id')] = next_track_id
+        tkhd.set('track_id', next_track_id)
+        next_track_id += 1
+        # durations of the track in the time scale of the movie
+        tkhd.set('duration', rescale(tkhd.get('duration'), time_scale,
+                                     new_time_scale))
+        for edts in trak.get_all(b'edts'):
+            rescale_edts(edts, time_scale, new_time_scale)
+        mvhd.set('duration', max(mvhd.get('duration'), tkhd.get('duration')))
+    mvhd.set('next_track_id', next_track_id)
+    # the traks go after the others, and before mvex
+    i = max(i for i, x in enumerate(moov.body) if x.type == b'trak') + 1
+    moov.body[i:i] = traks
+    if trexs:
+        mvex = moov.get(b'mvex')
+        for trex in trexs:
+            track_id, = struct.unpack('>I', trex.body[4:8])
+            trex.body = trex.body[:4] + \
+                struct.pack('>I', new_track_ids[track_id]) + trex.body[8:]
+        mvex.body += trexs
+    return new_track_ids
+
+def read_fragments(atoms, time_scales, default_durations):
+    """Yields the fragments of a fragmented file in order, as the moof and
+    the atoms up to the next one, with the time in seconds they start at.
+    """
+    ends = {}
+    fragment = None
+    for atom in atoms:
+        if atom.type == b'moof':
+            if fragment:
+                yield fragment
+            time = None
+            for traf in atom.get_all(b'traf'):
+                tfhd = traf.get(b'tfhd')
+                track_id = tfhd.get('track_id')
+                start = ends.get(track_id, 0)
+                tfdts = traf.get_all(b'tfdt')
+                if tfdts:
+                    start = tfdts[0].get('base_media_decode_time')
+                default_duration = tfhd.default_sample_duration
+                if default_duration is None:
+                    default_duration = default_durations.get(track_id, 0)
+                ends[track_id] = start + sum(
+                    trun_duration(x, default_duration)
+                    for x in traf.get_all(b'trun')
+                )
+                start /= time_scales[track_id]
+                time = start if time is None else min(time, start)
+            fragment = (time or 0, [atom])
+        elif fragment and atom.type not in FRAGMENT_INDEX_ATOMS:
+            fragment[1].append(atom)
+    if fragment:
+        yield fragment
+
+def get_trexs(moov):
+    """Returns the trex atoms of a moov, by track ID."""
+    trexs = {}
+    for trex in moov.get(b'mvex').get_all(b'trex'):
+        track_id, = struct.unpack('>I', trex.body[4:8])
+        trexs[track_id] = trex
+    return trexs
+
+def mux_fragments(mp4s, output):
+    """Muxes fragmented files into output: the moov of the first file, with
+    the tracks of the others, then their fragments interleaved by time.
+    """
+    moov = mp4s[0][1]
+    time_scales = {}
+    fragments_list = []
+    for i, (atoms, other_moov, _) in enumerate(mp4s):
+        trexs = get_trexs(other_moov)
+        traks = other_moov.get_all(b'trak')
+        if i == 0:
+            new_track_ids = {x: x for x in trexs}
+        else:
+            new_track_ids = add_traks(
+                moov, traks, other_moov.get(b'mvhd').get('time_scale'),
+                [trexs[x.get(b'tkhd').get('track_id')] for x in traks]
+            )
+        for trak in traks:
+            time_scales[trak.get(b'tkhd').get('track_id')] = \
+                trak.get(b'mdia', b'mdhd').get('time_scale')
+        for atom in atoms:
+            if atom.type == b'moof':
+                for traf in atom.get_all(b'traf'):
+                    tfhd = traf.get(b'tfhd')
+                    tfhd.set('track_id', new_track_ids[tfhd.get('track_id')])
+        fragments_list.append(read_fragments(
+            atoms, time_scales,
+            {new_track_ids[x]: struct.unpack('>I', trex.body[12:16])[0]
+             for x, trex in trexs.items()}
+        ))
+    default_durations = {}
+    for track_id, trex in get_trexs(moov).items():
+        default_durations[track_id], = struct.unpack('>I', trex.body[12:16])
+    # the duration of the fragments of the first file only
+    mvex = moov.get(b'mvex')
+    mvex.body = [x for x in mvex.body if x.type != b'mehd']
+    moov.calsize()
+
+    position = 0
+    for atom in mp4s[0][0]:
+        if atom.type == b'moof':
+            break
+        if atom.type not in FRAGMENT_INDEX_ATOMS:
+            atom.write(output)
+            position += atom.calsize()
+    # the tracks keep their decode times
+    ends, deltas = {}, {}
+    sequence_number = 0
+    for _, atoms in heapq.merge(*fragments_list, key=lambda x: x[0]):
+        sequence_number += 1
+        merge_moof(atoms[0], sequence_number, position - atoms[0].offset,
+                   default_durations, ends, deltas)
+        for atom in atoms:
+            atom.write(output)
+            position += atom.calsize()
+
+def decode_times(stts):
+    """Yields the decode times of the samples of an stts table."""
+    time = 0
+    for i in range(0, len(stts), 2):
+        for _ in range(stts[i]):
+            yield time
+            time += stts[i + 1]
+    while True:
+        yield time
+
+def read_chunks(trak, source):
+    """Yields the chunks of a trak, as the time in seconds of their first
+    sample, their index in the trak, their stream, offset and size.
+    """
+    stbl = trak.get(b'mdia', b'minf', b'stbl')
+    time_scale = trak.get(b'mdia', b'mdhd').get('time_scale')
+    offsets = get_stco(trak).body[1]
+    sizes = stbl.get(b'stsz').body[3]
+    stsc = stbl.get(b'stsc').body[1]
+    stts = stbl.get(b'stts').body[1]
+    # the sample counts of the chunks, by the stsc entry they start from
+    first_chunks = stsc[0::3].tolist() + [len(offsets) + 1]
+    times = decode_times(stts)
+    sample = 0
+    for i, offset in enumerate(offsets):
+        entry = bisect_right(first_chunks, i + 1) - 1
+        samples = stsc[entry * 3 + 1]
+        time = next(times)
+        for _ in range(samples - 1):
+            next(times)
+        yield (time / time_scale, i, source, offset,
+               sum(sizes[sample:sample + samples]))
+        sample += samples
+
+def mux_moovs(mp4s, output):
+    """Muxes non-fragmented files into output: the moov of the first file,
+    with the tracks of the others, then one mdat with the chunks of all
+    tracks interleaved by time, so that players need not seek back and
+    forth between the tracks.
+    """
+    moov = mp4s[0][1]
+    chunks_list = []
+    for i, (atoms, other_moov, mdats) in enumerate(mp4s):
+        traks = other_moov.get_all(b'trak')
+        chunks_list += [read_chunks(x, mdats[0].body[0]) for x in traks]
+        if i > 0:
+            add_traks(moov, traks, other_moov.get(b'mvhd').get('time_scale'))
+    stco_atoms = [get_stco(x) for x in moov.get_all(b'trak')]
+    # the chunks of a trak are in order, and of the traks in track order
+    # when they start at the same time
+    chunks = list(heapq.merge(*(
+        [(time, j, i, source, offset, size)
+         for time, i, source, offset, size in track_chunks]
+        for j, track_chunks in enumerate(chunks_list)
+    )))
+
+    headers = [x for x in mp4s[0][0] if x.type not in (b'moov', b'mdat')]
+    header_size = sum(x.calsize() for x in headers)
+    payload_size = sum(x[5] for x in chunks)
+    position = layout_moov(moov, stco_atoms, header_size, payload_size)
+    typecode = stco_atoms[0].typecode()
+    offsets_list = [array(typecode, [0]) * len(x.body[1])
+                    for x in stco_atoms]
+    for _, j, i, _, _, size in chunks:
+        offsets_list[j][i] = position
+        position += size
+    for stco_atom, offsets in zip(stco_atoms, offsets_list):
+        stco_atom.body = stco_atom.body[0], offsets
+
+    for x in headers:
+        x.write(output)
+    moov.write(output)
+    header = mdat_header_size(payload_size)
+    if header == 16:
+        output.write(struct.pack('>I4sQ', 1, b'mdat', header + payload_size))
+    else:
+        output.write(struct.pack('>I4s', header + payload_size, b'mdat'))
+    # chunks which follow each other in their file are copied at once
+    ranges = []
+    for _, _, _, source, offset, size in chunks:
+        if ranges and ranges[-1][0] is source and ranges[-1][2] == offset:
+            ranges[-1][2] += size
+        else:
+            ranges.append([source, offset, offset + size])
+    for source, start, end in ranges:
+        source.seek(start)
+        copy_range(source, output, end - start)
+
+def mux_mp4s(files, output):
+    ins = [open(mp4, 'rb') for mp4 in files]
+    try:
+        mp4s = list(map(read_mp4, ins))
+        assert None not in [x[1] for x in mp4s], 'no moov found'
+        fragmented = [is_fragmented(atoms, moov)
+                      for atoms, moov, _ in mp4s]
+        if all(fragmented):
+            mux = mux_fragments
+        elif not any(fragmented):
+            mux = mux_moovs
+        else:
+            raise NotImplementedError('fragmented and non-fragmented files')
+        with open(output, 'wb') as output:
+            mux(mp4s, output)
+    finally:
+        for stream in ins:
+            stream.close()
+
+##################################################
+# webm
+##################################################
+
+# reference: https://www.matroska.org/technical/elements.html
+
+EBML = 0x1A45DFA3
+SEGMENT = 0x18538067
+SEEK_HEAD = 0x114D9B74
+SEEK = 0x4DBB
+SEEK_ID = 0x53AB
+SEEK_POSITION = 0x53AC
+INFO = 0x1549A966
+TIMECODE_SCALE = 0x2AD7B1
+DURATION = 0x4489
+TRACKS = 0x1654AE6B
+TRACK_ENTRY = 0xAE
+TRACK_NUMBER = 0xD7
+TRACK_UID = 0x73C5
+CLUSTER = 0x1F43B675
+TIMECODE = 0xE7
+BLOCK_GROUP = 0xA0
+BLOCK = 0xA1
+SIMPLE_BLOCK = 0xA3
+CUES = 0x1C53BB6B
+CUE_POINT = 0xBB
+CUE_TIME = 0xB3
+CUE_TRACK_POSITIONS = 0xB7
+CUE_TRACK = 0xF7
+CUE_CLUSTER_POSITION = 0xF1
+CRC32 = 0xBF
+
+def read_vint(stream, keep_marker=False):
+    """Reads a variable size integer, or returns None for one with all
+    its bits set, which stands for an unknown size.
+    """
+    first = stream.read(1)
+    assert first, 'no enough data'
+    first = ord(first)
+    assert first, 'invalid variable size integer'
+    length = 1
+    while not first & 0x80 >> (length - 1):
+        length += 1
+    value = first if keep_marker else first & 0xff >> length
+    for b in stream.read(length - 1):
+        value = value << 8 | b
+    if not keep_marker and value == (1 << 7 * length) - 1:
+        return None
+    return value
+
+def vint_size(n):
+    length = 1
+    while n >= (1 << 7 * length) - 1:
+        length += 1
+    return length
+
+def write_vint(stream, n, length=None):
+    length = length or vint_size(n)
+    stream.write((n | 1 << 7 * length).to_bytes(length, 'big'))
+
+def read_element_header(stream):
+    """Returns the ID and the size of the next element, or None at the
+    end of stream.
+    """
+    first = stream.read(1)
+    if not first:
+        return None
+    stream.seek(-1, 1)
+    return read_vint(stream, keep_marker=True), read_vint(stream)
+
+def read_elements(data):
+    """Returns the (ID, body) of the elements in data."""
+    stream = BytesIO(data)
+    elements = []
+    while True:
+        header = read_element_header(stream)
+        if header is None:
+            return elements
+        id, size = header
+        assert size is not None, 'element of unknown size: %x' % id
+        elements.append((id, stream.read(size)))
+
+def write_element(stream, id, body):
+    stream.write(id.to_bytes((id.bit_length() + 7) // 8, 'big'))
+    write_vint(stream, len(body))
+    stream.write(body)
+
+def element(id, body):
+    stream = BytesIO()
+    write_element(stream, id, body)
+    return stream.getvalue()
+
+def elements(children):
+    return b''.join(element(id, body) for id, body in children)
+
+def uint(n, length=None):
+    return n.to_bytes(length or max((n.bit_length() + 7) // 8, 1), 'big')
+
+def read_uint(body):
+    return int.from_bytes(body, 'big')
+
+def read_float(body):
+    return struct.unpack('>d' if len(body) == 8 else '>f', body)[0]
+
+class Cluster:
+    def __init__(self, stream, offset, size, timecode, track_numbers):
+        self.stream = stream
+        self.offset = offset
+        self.size = size
+        self.timecode = timecode
+        # new track numbers of the blocks, by the former ones
+        self.track_numbers = track_numbers
+    def write(self, output):
+        self.stream.seek(self.offset)
+        if not any(k != v for k, v in self.track_numbers.items()):
+            copy_range(self.stream, output, self.size)
+            return
+        data = bytearray(self.stream.read(self.size))
+        stream = BytesIO(data)
+        id, size = read_element_header(stream)
+        renumber_blocks(stream, stream.tell() + size, data,
+                        self.track_numbers)
+        output.write(data)
+
+def renumber_blocks(stream, end, data, track_numbers):
+    """Changes in place the track numbers of the blocks in data, from the
+    position of stream up to end.
+    """
+    while stream.tell() < end:
+        id, size = read_element_header(stream)
+        start = stream.tell()
+        if id == BLOCK_GROUP:
+            renumber_blocks(stream, start + size, data, track_numbers)
+        elif id in (SIMPLE_BLOCK, BLOCK):
+            track_number = read_vint(stream)
+            length = stream.tell() - start
+            new_track_number = track_numbers[track_number]
+            if vint_size(new_track_number) != length:
+                raise NotImplementedError('track number too large')
+            data[start:start + length] = uint(
+                new_track_number | 1 << 7 * length, length
+            )
+        stream.seek(start + size)
+
+class WebM:
+    """The top-level elements of a WebM file, with its clusters left on
+    disk.
+    """
+    def __init__(self, stream):
+        self.stream = stream
+        id, size = read_element_header(stream)
+        assert id == EBML, 'not a WebM file'
+        header_end = stream.tell() + size
+        stream.seek(0)
+        self.header = stream.read(header_end)
+        id, size = read_element_header(stream)
+        assert id == SEGMENT, 'no segment found'
+        self.info = []
+        self.tracks = []
+        self.clusters = []
+        # an unknown size runs to the end of the file
+        end = stream.tell() + size if size is not None else None
+        while end is None or stream.tell() < end:
+            offset = stream.tell()
+            header = read_element_header(stream)
+            if header is None:
+                break
+            id, size = header
+            if size is None:
+                raise NotImplementedError('element of unknown size: %x' % id)
+            start = stream.tell()
+            if id == INFO:
+                self.info = read_elements(stream.read(size))
+            elif id == TRACKS:
+                self.tracks = [read_elements(body) for k, body
+                               in read_elements(stream.read(size))
+                               if k == TRACK_ENTRY]
+            elif id == CLUSTER:
+                self.clusters.append((stream, offset, start - offset + size,
+                                      self.read_timecode(size)))
+            stream.seek(start + size)
+    def read_timecode(self, size):
+        stream = self.stream
+        end = stream.tell() + size
+        while stream.tell() < end:
+            id, size = read_element_header(stream)
+            if id == TIMECODE:
+                return read_uint(stream.read(size))
+            stream.seek(stream.tell() + size)
+        raise Exception('cluster without timecode')
+    def get_info(self, id, default=None):
+        for k, body in self.info:
+            if k == id:
+                return body
+        return default
+    def track_numbers(self):
+        return [read_uint(dict(x)[TRACK_NUMBER]) for x in self.tracks]
+
+def mux_webms(files, output):
+    """Muxes WebM files into output: the tracks of the first file and those
+    of the others, renumbered after them, then their clusters interleaved
+    by time, with cues at the clusters of the first file.
+    """
+    ins = [open(webm, 'rb') for webm in files]
+    try:
+        webms = list(map(WebM, ins))
+        time_scale = webms[0].get_info(TIMECODE_SCALE, uint(1000000))
+        if any(x.get_info(TIMECODE_SCALE, uint(1000000)) != time_scale
+               for x in webms):
+            raise NotImplementedError('different timecode scales')
+        info = [(k, body) for k, body in webms[0].info
+                if k not in (DURATION, CRC32)]
+        durations = [read_float(x.get_info(DURATION))
+                     for x in webms if x.get_info(DURATION)]
+        if durations:
+            info.append((DURATION, struct.pack('>d', max(durations))))
+
+        tracks = []
+        clusters_list = []
+        next_track_number = 1
+        uids = set()
+        for i, webm in enumerate(webms):
+            track_numbers = {}
+            for track in webm.tracks:
+                track = [(k, body) for k, body in track if k != CRC32]
+                fields = dict(track)
+                track_number = read_uint(fields[TRACK_NUMBER])
+                uid = fields.get(TRACK_UID)
+                if i == 0:
+                    # the first file is copied as it is
+                    new_track_number = track_number
+                else:
+                    new_track_number = next_track_number
+                while uid is not None and uid in uids:
+                    uid = uint(read_uint(uid) + 1, len(uid))
+                track_numbers[track_number] = new_track_number
+                next_track_number = max(next_track_number,
+                                        new_track_number + 1)
+                if uid is not None:
+                    uids.add(uid)
+                tracks.append([
+                    (k, uint(new_track_number) if k == TRACK_NUMBER else
+                     uid if k == TRACK_UID else body) for k, body in track
+                ])
+            clusters_list.append([
+                Cluster(stream, offset, size, timecode, track_numbers)
+                for stream, offset, size, timecode in webm.clusters
+            ])
+        clusters = list(heapq.merge(*clusters_list,
+                                    key=lambda x: x.timecode))
+
+        # the elements before the clusters, whose cues need their positions;
+        # the cues have fixed sizes so that they can be laid out first
+        info = element(INFO, elements(info))
+        tracks = element(TRACKS, elements((TRACK_ENTRY, elements(x))
+                                          for x in tracks))
+        cue_track = webms[0].track_numbers()[0]
+        cue_clusters = set(clusters_list[0])
+
+        def make_cues(start):
+            positions = []
+            position = start
+            for cluster in clusters:
+                if cluster in cue_clusters:
+                    positions.append((cluster.timecode, position))
+                position += cluster.size
+            return element(CUES, elements(
+                (CUE_POINT, elements([
+                    (CUE_TIME, uint(timecode, 8)),
+                    (CUE_TRACK_POSITIONS, elements([
+                        (CUE_TRACK, uint(cue_track, 8)),
+                        (CUE_CLUSTER_POSITION, uint(position, 8)),
+                    ])),
+                ])) for timecode, position in positions
+            ))
+
+        def make_seek_head(info_position, tracks_position, cues_position):
+            return element(SEEK_HEAD, elements(
+                (SEEK, elements([(SEEK_ID, uint(k)),
+                                 (SEEK_POSITION, uint(position, 8))]))
+                for k, position in ((INFO, info_position),
+                                    (TRACKS, tracks_position),
+                                    (CUES, cues_position))
+            ))
+
+        seek_head_size = len(make_seek_head(0, 0, 0))
+        info_position = seek_head_size
+        tracks_position = info_position + len(info)
+        cues_position = tracks_position + len(tracks)
+        cues_size = len(make_cues(0))
+        cues = make_cues(cues_position + cues_size)
+        seek_head = make_seek_head(info_position, tracks_position,
+                                   cues_position)
+        segment_size = seek_head_size + len(info) + len(tracks) + \
+            cues_size + sum(x.size for x in clusters)
+
+        with open(output, 'wb') as output:
+            output.write(webms[0].header)
+            output.write(uint(SEGMENT))
+            # a size of 8 bytes, as it is only known here
+            write_vint(output, segment_size, 8)
+            for x in (seek_head, info, tracks, cues):
+                output.write(x)
+            for cluster in clusters:
+                cluster.write(output)
+    finally:
+        for stream in ins:
+            stream.close()
+
+##################################################
+# main
+##################################################
+
+# containers which can be muxed natively, and whether that is faster than
+# ffmpeg: MP4 payloads are copied as they are, in the kernel, while the
+# audio blocks of WebM files are parsed in Python to renumber their track
+# (see contrib/benchmark/mux.py: natively, 10 minutes of 2 Mbit/s video
+# and 128 kbit/s audio take 0.10 CPU s as MP4 and 0.22 CPU s as WebM)
+MUXERS = {
+    'mp4': (mux_mp4s, True),
+    'webm': (mux_webms, False),
+}
+
+def can_mux(ext):
+    return ext in MUXERS
+
+def prefers_native(ext):
+    """Tells whether muxing natively is faster than with ffmpeg."""
+    return can_mux(ext) and MUXERS[ext][1]
+
+def mux_av(files, output, ext):
+    """Muxes the video file and the audio file of a stream into output,
+    with the tracks of the first file first.
+    """
+    assert len(files) > 1, 'nothing to mux'
+    if not can_mux(ext):
+        raise NotImplementedError('cannot mux %s files' % ext)
+    print('Merging video parts... ', end="", flush=True)
+    MUXERS[ext][0](files, output)
+    return output
@@ -0,0 +1,378 @@
+#!/usr/bin/env python
+
+"""A download server, which runs jobs submitted over a local HTTP/JSON API
+in one long-running process, so that they share its connections, caches
+and loaded extractors.
+
+    POST   /jobs       {"url": URL, "options": {"format": "mp4", ...}}
+    GET    /jobs       the status of all jobs
+    GET    /jobs/ID    the status of a job, with its output
+    DELETE /jobs/ID    cancels a job that has not started yet
+
+Options are those of the command line, by their long names ("output-dir"
+or "output_dir"), with true for flags. The options about the process, like
+timeouts or rate limits, are taken from the command line of the server.
+
+Jobs are posted as application/json, and requests naming another host or
+coming from another origin are refused, so that web pages cannot submit
+them.
+"""
+
+import io
+import ipaddress
+import json
+import re
+import socketserver
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http import server
+from urllib import parse
+
+from . import common
+from .util import log
+from .util.pool import ConnectionPool
+
+# the options a job may set, by their dest
+JOB_OPTIONS = {
+    'info', 'url', 'json', 'no_merge', 'no_caption', 'force', 'format',
+    'stream', 'itag', 'output_filename', 'output_dir', 'cookies', 'password',
+    'playlist', 'auto_rename', 'insecure', 'http_proxy', 'extractor_proxy',
+    'no_proxy',
+}
+
+# finished jobs kept for their status
+MAX_FINISHED_JOBS = 10000
+
+
+class JobError(ValueError):
+    pass
+
+
+def is_local_host(host, server_host=''):
+    """Whether host, as in a Host or Origin header, names the server by
+    an address or its own name rather than some other domain, which may
+    be resolved to it by DNS rebinding."""
+    try:
+        name = parse.urlsplit('//' + host).hostname
+    except ValueError:
+        return False
+    if not name:
+        return False
+    if name in ('localhost', server_host.lower()):
+        return True
+    try:
+        ipaddress.ip_address(name)
+    except ValueError:
+        return False
+    return True
+
+
+class JobProgressBar:
+    """Records the progress of a job instead of drawing it."""
+
+    def __init__(self, job, total_size, total_pieces=1):
+        self.job = job
+        job.total = total_size or None
+        job.pieces = total_pieces
+        job.piece = 0
+        # restarted downloads count their bytes again
+        job.received = 0
+
+    def update(self):
+        pass
+
+    def update_received(self, n):
+        with self.job.lock:
+            self.job.received += n
+
+    def update_piece(self, n):
+        self.job.piece = n
+
+    def done(self):
+        pass
+
+
+class Job:
+    """A download submitted to the server."""
+
+    def __init__(self, id, url, args):
+        self.id = id
+        self.url = url
+        self.args = args
+        self.state = 'queued'
+        self.received = 0
+        self.total = None
+        self.piece = 0
+        self.pieces = 0
+        self.error = None
+        self.output = io.StringIO()
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.future = None
+        self.lock = threading.Lock()
+
+    def status(self, output=False):
+        status = {
+            'id': self.id,
+            'url': self.url,
+            'state': self.state,
+            'received': self.received,
+            'total': self.total,
+            'progress': min(self.received / self.total, 1)
+            if self.total else None,
+            'piece': self.piece,
+            'pieces': self.pieces,
+            'error': self.error,
+            'created': self.created,
+            'started': self.started,
+            'finished': self.finished,
+        }
+        if output:
+            # keep only the last state of progress bars
+            status['output'] = '\n'.join(
+                line.rsplit('\r', 1)[-1]
+                for line in self.output.getvalue().split('\n')
+            )
+        return status
+
+
+def parse_job(data):
+    """Returns the URL and the parsed options of a job submitted as JSON."""
+    if not isinstance(data, dict) or not isinstance(data.get('url'), str):
+        raise JobError('a job needs a "url"')
+    options = data.get('options') or {}
+    if not isinstance(options, dict):
+        raise JobError('"options" must be an object')
+    argv = []
+    for name, value in options.items():
+        dest = name.replace('-', '_')
+        if dest not in JOB_OPTIONS:
+            raise JobError('option %s cannot be set for a job' % name)
+        if value is True:
+            argv.append('--' + dest.replace('_', '-'))
+        elif value not in (False, None):
+            argv += ['--' + dest.replace('_', '-'), str(value)]
+
+    def error(message):
+        raise JobError(message)
+
+    parser = common.build_parser()
+    parser.error = error
+    return data['url'], parser.parse_args(argv + ['--', data['url']])
+
+
+class JobServer(socketserver.ThreadingMixIn, server.HTTPServer):
+    """Runs the submitted jobs, up to workers at a time."""
+
+    daemon_threads = True
+
+    def __init__(self, address, workers=1):
+        super().__init__(address, JobHandler)
+        self.host = address[0]
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(workers)
+        self.pools = {}
+        self.ids = iter(range(1, sys.maxsize))
+        self.output = common.OutputRouter(sys.stdout)
+        self.errors = common.OutputRouter(sys.stderr)
+
+    def submit(self, url, args):
+        with self.lock:
+            job = Job(next(self.ids), url, args)
+            self.jobs[job.id] = job
+            finished = [j for j in self.jobs.values() if j.finished]
+            for old in finished[:max(len(finished) - MAX_FINISHED_JOBS, 0)]:
+                del self.jobs[old.id]
+        job.future = self.executor.submit(self.run, job)
+        return job
+
+    def cancel(self, job):
+        if job.future.cancel():
+            job.state = 'cancelled'
+            job.finished = time.time()
+            return True
+        return False
+
+    def session(self, job):
+        args = job.args
+        if args.no_proxy:
+            proxies = {}
+        elif args.http_proxy:
+            proxies = {'http': args.http_proxy, 'https': args.http_proxy}
+        else:
+            proxies = common.proxies
+        insecure = args.insecure or common.insecure
+        # connections are kept for the next jobs with the same settings
+        key = (json.dumps(proxies, sort_keys=True), insecure)
+        with self.lock:
+            pool = self.pools.get(key)
+            if pool is None:
+                pool = self.pools[key] = ConnectionPool(
+                    resolver=common.dns_cache
+                )
+        return common.DownloadSession(
+            force=args.force or common.force,
+            dry_run=args.url or args.json,
+            json_output=args.json,
+            cookies=common.read_cookies(args.cookies) if args.cookies
+            else common.cookies,
+            output_filename=args.output_filename,
+            auto_rename=args.auto_rename or common.auto_rename,
+            insecure=insecure,
+            proxies=proxies,
+            connection_pool=pool,
+            progress_bar=lambda total_size, total_pieces=1: JobProgressBar(
+                job, total_size, total_pieces
+            ),
+        )
+
+    def run(self, job):
+        args = job.args
+        job.state = 'running'
+        job.started = time.time()
+        ident = threading.get_ident()
+        self.output.outputs[ident] = self.errors.outputs[ident] = job.output
+        kwargs = {
+            'output_dir': args.output_dir,
+            'merge': not args.no_merge,
+            'info_only': args.info and not args.json,
+            'json_output': args.json,
+            'caption': not args.no_caption,
+            'password': args.password,
+        }
+        stream_id = args.format or args.stream or args.itag
+        if stream_id:
+            kwargs['stream_id'] = stream_id
+        if args.extractor_proxy:
+            kwargs['extractor_proxy'] = args.extractor_proxy
+        try:
+            url = job.url
+            if re.match(r'https?://', url) is None:
+                url = 'http://' + url
+            with self.session(job):
+                common.any_download_isolated(url, args.playlist, **kwargs)
+            job.state = 'done'
+        except (Exception, SystemExit) as e:
+            job.state = 'failed'
+            job.error = '%s: %s' % (type(e).__name__, e)
+            log.e('[error] job %d: %s' % (job.id, job.error))
+        finally:
+            del self.output.outputs[ident], self.errors.outputs[ident]
+            job.finished = time.time()
+
+    def serve_forever(self, *args, **kwargs):
+        sys.stdout, sys.stderr = self.output, self.errors
+        try:
+            super().serve_forever(*args, **kwargs)
+        finally:
+            sys.stdout, sys.stderr = self.output.stream, self.errors.stream
+            # the jobs not started yet are dropped, as shutdown() only does
+            # itself from Python 3.9
+            with self.lock:
+                jobs = list(self.jobs.values())
+            for job in jobs:
+                if job.future is not None:
+                    self.cancel(job)
+            self.executor.shutdown(wait=False)
+
+
+class JobHandler(server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        common.logging.debug('server: ' + format % args)
+
+    def send_json(self, code, data, headers={}):
+        body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def check_request(self):
+        # web pages the user visits can send requests here too, but not
+        # with a Host or an Origin of their own
+        host = self.headers.get('Host')
+        origin = self.headers.get('Origin')
+        if host is None or not is_local_host(host, self.server.host) or \
+                origin is not None and (
+                    not origin.startswith('http://') or
+                    not is_local_host(origin[7:], self.server.host)):
+            self.send_json(403, {'error': 'forbidden'})
+            return False
+        return True
+
+    def find_job(self):
+        match = re.match(r'^/jobs/(\d+)$', self.path)
+        job = match and self.server.jobs.get(int(match.group(1)))
+        if not job:
+            self.send_json(404, {'error': 'no such job'})
+        return job
+
+    def do_GET(self):
+        if not self.check_request():
+            return
+        if self.path.rstrip('/') == '/jobs':
+            with self.server.lock:
+                jobs = list(self.server.jobs.values())
+            self.send_json(200, [job.status() for job in jobs])
+            return
+        job = self.find_job()
+        if job:
+            self.send_json(200, job.status(output=True))
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length)
+        if not self.check_request():
+            return
+        if self.path.rstrip('/') != '/jobs':
+            self.send_json(404, {'error': 'not found'})
+            return
+        # unlike a form, which pages can post anywhere without asking
+        content_type = self.headers.get('Content-Type', '')
+        if content_type.split(';')[0].strip().lower() != 'application/json':
+            self.send_json(415, {'error': 'jobs must be application/json'})
+            return
+        try:
+            url, args = parse_job(json.loads(body.decode('utf-8')))
+        except (ValueError, UnicodeDecodeError) as e:
+            self.send_json(400, {'error': str(e)})
+            return
+        job = self.server.submit(url, args)
+        self.send_json(201, job.status(), {'Location': '/jobs/%d' % job.id})
+
+    def do_DELETE(self):
+        if not self.check_request():
+            return
+        job = self.find_job()
+        if not job:
+            return
+        if self.server.cancel(job):
+            self.send_json(200, job.status())
+        else:
+            self.send_json(409, {'error': 'job is %s' % job.state})
+
+
+def serve(address, workers=1):
+    """Serves the job API at [HOST:]PORT until interrupted."""
+    host, _, port = address.rpartition(':')
+    try:
+        httpd = JobServer((host or '127.0.0.1', int(port)), workers)
+    except (ValueError, OSError) as e:
+        log.wtf('[Failed] Cannot serve at %s: %s' % (address, e))
+    log.i('serving download jobs at http://%s:%d/jobs' %
+          httpd.server_address[:2])
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from http import client
+
+# never cached: downloads are not what the cache is meant for
+MEDIA_TYPES = ('video/', 'audio/', 'image/', 'application/octet-stream',
+               'application/vnd.apple.mpegurl', 'application/x-mpegurl',
+               'application/dash+xml', 'application/f4m')
+
+# request headers that do not change what the server answers
+IGNORED_HEADERS = ('if-none-match', 'if-modified-since', 'connection')
+
+class CacheEntry:
+    def __init__(self, url, headers, body, stored, expires):
+        self.url = url
+        self.headers = headers
+        self.body = body
+        self.stored = stored
+        self.expires = expires
+
+    def is_fresh(self):
+        return time.time() < self.expires
+
+    def validators(self):
+        """Returns the headers to revalidate a stale entry with."""
+        headers = {}
+        if self.headers.get('ETag'):
+            headers['If-None-Match'] = self.headers['ETag']
+        if self.headers.get('Last-Modified'):
+            headers['If-Modified-Since'] = self.headers['Last-Modified']
+        return headers
+
+class ResponseCache:
+    """Stores HTTP responses in a directory, evicting the least recently used
+    ones once it grows beyond max_size bytes.
+
+    Args:
+        path: The cache directory.
+        max_size: Maximum total size of the entries, in bytes.
+        ttl: Seconds an entry is fresh for, unless the server says otherwise
+            with Cache-Control: max-age.
+    """
+
+    def __init__(self, path, max_size=64 * 1024 * 1024, ttl=3600):
+        self.path = path
+        self.max_size = max_size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+
+    def key(self, method, url, headers={}, body=None):
+        """Returns the key of a request."""
+        headers = sorted((k.lower(), v) for k, v in dict(headers).items()
+                         if k.lower() not in IGNORED_HEADERS)
+        digest = hashlib.sha256(
+            json.dumps([method.upper(), url, headers]).encode('utf-8')
+        )
+        if body is not None:
+            digest.update(body if isinstance(body, bytes)
+                          else body.encode('utf-8'))
+        return digest.hexdigest()
+
+    def _filepath(self, key):
+        return os.path.join(self.path, key + '.entry')
+
+    def load(self, key):
+        """Returns the CacheEntry of key, or None if there is none."""
+        filepath = self._filepath(key)
+        try:
+            with open(filepath, 'rb') as f:
+                meta = json.loads(f.readline().decode('utf-8'))
+                body = f.read()
+            # mark as recently used
+            os.utime(filepath)
+        except (OSError, ValueError):
+            return None
+        headers = client.HTTPMessage()
+        for name, value in meta['headers']:
+            headers[name] = value
+        return CacheEntry(meta['url'], headers, body, meta['stored'],
+                          meta['expires'])
+
+    def _max_age(self, headers):
+        cache_control = headers.get('Cache-Control', '').lower()
+        if 'no-store' in cache_control:
+            return None
+        max_age = re.search(r'max-age=(\d+)', cache_control)
+        if max_age:
+            return int(max_age.group(1))
+        return self.ttl
+
+    def store(self, key, url, headers, body):
+        """Saves a response, unless it is media or not to be stored."""
+        content_type = headers.get('Content-Type', '').lower()
+        if content_type.startswith(MEDIA_TYPES) or \
+                len(body) > self.max_size // 8:
+            return
+        max_age = self._max_age(headers)
+        if max_age is None:
+            return
+        now = time.time()
+        self._write(key, {
+            'url': url,
+            'headers': list(headers.items()),
+            'stored': now,
+            'expires': now + max_age,
+        }, body)
+
+    def refresh(self, key, entry, headers):
+        """Makes an entry fresh again after a 304 Not Modified."""
+        for name, value in headers.items():
+            if name.lower() in ('etag', 'last-modified', 'cache-control',
+                                'expires', 'date'):
+                del entry.headers[name]
+                entry.headers[name] = value
+        max_age = self._max_age(entry.headers)
+        if max_age is None:
+            return
+        entry.stored = time.time()
+        entry.expires = entry.stored + max_age
+        self._write(key, {
+            'url': entry.url,
+            'headers': list(entry.headers.items()),
+            'stored': entry.stored,
+            'expires': entry.expires,
+        }, entry.body)
+
+    def _write(self, key, meta, body):
+        filepath = self._filepath(key)
+        temp_filepath = '%s.%d.tmp' % (filepath, threading.get_ident())
+        with open(temp_filepath, 'wb') as f:
+            f.write(json.dumps(meta).encode('utf-8') + b'\n')
+            f.write(body)
+        os.replace(temp_filepath, filepath)
+        self.evict()
+
+    def evict(self):
+        """Removes the least recently used entries beyond max_size."""
+        with self._lock:
+            entries = []
+            for name in os.listdir(self.path):
+                if not name.endswith('.entry'):
+                    continue
+                try:
+                    stat = os.stat(os.path.join(self.path, name))
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, name))
+            total = sum(size for _, size, _ in entries)
+            for _, size, name in sorted(entries):
+                if total <= self.max_size:
+                    break
+                try:
+                    os.remove(os.path.join(self.path, name))
+                except OSError:
+                    pass
+                total -= size
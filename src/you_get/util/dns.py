@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+
+import socket
+import threading
+import time
+
+class DNSCache:
+    """Remembers the results of socket.getaddrinfo() for ttl seconds.
+
+    getaddrinfo() does not tell the TTLs of the DNS records, so ttl should
+    stay short enough for CDNs that move hosts around (0 disables caching).
+    """
+
+    def __init__(self, ttl=60):
+        self.ttl = ttl
+        self.stats = {'hits': 0, 'misses': 0}
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def getaddrinfo(self, host, port, family=0, type=0, proto=0, flags=0):
+        key = (host, port, family, type, proto, flags)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                self.stats['hits'] += 1
+                return entry[1]
+            self.stats['misses'] += 1
+        # looked up on each call, as set_socks_proxy() may replace it
+        result = socket.getaddrinfo(host, port, family, type, proto, flags)
+        if self.ttl:
+            with self._lock:
+                self._entries[key] = (now + self.ttl, result)
+        return result
+
+    def forget(self, host):
+        """Drops the entries of host, e.g. after its addresses failed."""
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == host]:
+                del self._entries[key]
+
+    def create_connection(self, address, timeout=socket._GLOBAL_DEFAULT_TIMEOUT,
+                          source_address=None):
+        """Like socket.create_connection(), resolving through the cache."""
+        host, port = address
+        err = None
+        for af, socktype, proto, _, sa in self.getaddrinfo(
+            host, port, 0, socket.SOCK_STREAM
+        ):
+            sock = None
+            try:
+                sock = socket.socket(af, socktype, proto)
+                if timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+                    sock.settimeout(timeout)
+                if source_address:
+                    sock.bind(source_address)
+                sock.connect(sa)
+                return sock
+            except OSError as e:
+                err = e
+                if sock is not None:
+                    sock.close()
+        self.forget(host)
+        if err is not None:
+            raise err
+        raise OSError('getaddrinfo returns an empty list')
+
+    def prefetch(self, hosts, workers=8):
+        """Resolves (host, port) pairs concurrently, ignoring failures."""
+        hosts = list(set(hosts))
+
+        def resolve():
+            while True:
+                try:
+                    host, port = hosts.pop()
+                except IndexError:
+                    return
+                try:
+                    self.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+                except OSError:
+                    pass
+
+        threads = [threading.Thread(target=resolve, daemon=True)
+                   for _ in range(min(workers, len(hosts)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
@@ -1,5 +1,8 @@
 #!/usr/bin/env python
 
+import errno
+import os as _os
+
 from .os import detect_os
 
 def legitimize(text, os=detect_os()):
@@ -45,3 +48,72 @@ def legitimize(text, os=detect_os()):
 
     text = text[:80] # Trim to 82 Unicode characters long
     return text
+
+# errors telling that a kernel-side copy is not possible for these files
+_COPY_UNSUPPORTED = {errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EBADF,
+                     errno.EOPNOTSUPP, errno.ENOTSUP, errno.ETXTBSY}
+
+def _copy_kernel(source, target, n):
+    src, dst = source.fileno(), target.fileno()
+    src_offset, dst_offset = source.tell(), target.tell()
+    copied = 0
+    if hasattr(_os, 'copy_file_range'):
+        try:
+            while copied < n:
+                count = _os.copy_file_range(src, dst, n - copied,
+                                            src_offset + copied,
+                                            dst_offset + copied)
+                if not count:
+                    break
+                copied += count
+        except OSError as e:
+            if e.errno not in _COPY_UNSUPPORTED or copied:
+                raise
+    if not copied and hasattr(_os, 'sendfile'):
+        # sendfile() writes at the position of the target
+        _os.lseek(dst, dst_offset, _os.SEEK_SET)
+        try:
+            while copied < n:
+                count = _os.sendfile(dst, src, src_offset + copied, n - copied)
+                if not count:
+                    break
+                copied += count
+        except OSError as e:
+            if e.errno not in _COPY_UNSUPPORTED or copied:
+                raise
+    source.seek(src_offset + copied)
+    target.seek(dst_offset + copied)
+    return copied
+
+def copy_range(source, target, n, buffer_size=1024 * 1024,
+               kernel_min_size=64 * 1024):
+    """Copies n bytes from the position of file source to that of file
+    target, in the kernel with copy_file_range() or sendfile() where it can,
+    otherwise through a buffer of buffer_size bytes.
+
+    Copies smaller than kernel_min_size go through the buffers of the files,
+    as they would cost more system calls than they save.
+    """
+    copied = 0
+    if n >= kernel_min_size:
+        try:
+            target.flush()
+            copied = _copy_kernel(source, target, n)
+        except (AttributeError, ValueError, OSError) as e:
+            # not real files, e.g. BytesIO
+            if isinstance(e, OSError) and e.errno is not None:
+                raise
+    n -= copied
+    if n <= 0:
+        return
+    if n <= buffer_size:
+        data = source.read(n)
+        assert len(data) == n, 'no enough data'
+        target.write(data)
+        return
+    view = memoryview(bytearray(buffer_size))
+    while n > 0:
+        read = source.readinto(view[:min(buffer_size, n)])
+        assert read, 'no enough data'
+        target.write(view[:read])
+        n -= read
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+
+import json
+import os
+import threading
+import time
+
+class Journal:
+    """The progress of a download, kept in a small JSON file next to it, so
+    that an interrupted download can be resumed exactly.
+
+    Args:
+        path: The journal file.
+        size: Total size of the file being downloaded.
+        etag: ETag of the file, to tell whether it has changed since.
+        last_modified: Last-Modified of the file, likewise.
+    """
+
+    def __init__(self, path, size=None, etag=None, last_modified=None):
+        self.path = path
+        self.size = size
+        self.etag = etag
+        self.last_modified = last_modified
+        # sorted, non-overlapping [start, end) byte ranges on disk
+        self.ranges = []
+        # finished parts of a multi-part download, by filename, with sizes
+        self.parts = {}
+        # seconds between two saves while ranges are being added
+        self.interval = 1
+        self._saved = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path):
+        """Returns the journal saved at path, or None if there is none."""
+        try:
+            with open(path, encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        journal = cls(path, data.get('size'), data.get('etag'),
+                      data.get('last_modified'))
+        journal.ranges = [list(r) for r in data.get('ranges', [])]
+        journal.parts = data.get('parts', {})
+        return journal
+
+    @classmethod
+    def for_response(cls, path, size, headers):
+        return cls(path, size, headers.get('ETag'),
+                   headers.get('Last-Modified'))
+
+    def matches(self, size, headers):
+        """Tells whether a response is about the same version of the file."""
+        if self.size is not None and size != self.size:
+            return False
+        for name, value in (('ETag', self.etag),
+                            ('Last-Modified', self.last_modified)):
+            if value and headers.get(name) and headers.get(name) != value:
+                return False
+        return True
+
+    def validator(self):
+        """Returns the value for If-Range, or None if there is none."""
+        if self.etag and not self.etag.startswith('W/'):
+            # weak ETags are not allowed in If-Range
+            return self.etag
+        return self.last_modified
+
+    def completed(self):
+        """Returns the number of bytes on disk."""
+        with self._lock:
+            return sum(end - start for start, end in self.ranges)
+
+    def head(self):
+        """Returns the end of the range that starts the file."""
+        with self._lock:
+            if self.ranges and self.ranges[0][0] == 0:
+                return self.ranges[0][1]
+            return 0
+
+    def missing(self):
+        """Returns the [start, end) ranges still to be downloaded."""
+        missing = []
+        offset = 0
+        with self._lock:
+            for start, end in self.ranges:
+                if start > offset:
+                    missing.append([offset, start])
+                offset = end
+        if self.size is not None and offset < self.size:
+            missing.append([offset, self.size])
+        return missing
+
+    def add_range(self, start, end, output=None):
+        """Records that bytes [start, end) are on disk, saving the journal
+        if it has not been saved for interval seconds.
+
+        Args:
+            output: The file being written, flushed before saving.
+        """
+        with self._lock:
+            ranges = []
+            for r in self.ranges:
+                if r[1] < start or r[0] > end:
+                    ranges.append(r)
+                else:
+                    start, end = min(start, r[0]), max(end, r[1])
+            ranges.append([start, end])
+            self.ranges = sorted(ranges)
+        if time.time() - self._saved >= self.interval:
+            if output is not None:
+                output.flush()
+            self.save()
+
+    def add_part(self, filename, size):
+        with self._lock:
+            self.parts[filename] = size
+        self.save()
+
+    def save(self):
+        with self._lock:
+            data = json.dumps({
+                'size': self.size,
+                'etag': self.etag,
+                'last_modified': self.last_modified,
+                'ranges': self.ranges,
+                'parts': self.parts,
+            })
+            temp_path = '%s.%d.tmp' % (self.path, threading.get_ident())
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                f.write(data)
+            os.replace(temp_path, self.path)
+            self._saved = time.time()
+
+    def remove(self):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+
+import logging
+import socket
+import ssl
+import threading
+import time
+from collections import deque
+from http import client
+from urllib import request
+from urllib.error import URLError
+
+class ConnectionPool:
+    """Keeps idle HTTP connections open so that they can be reused for
+    subsequent requests to the same host.
+
+    Args:
+        max_per_host: Maximum number of idle connections kept per host.
+        idle_timeout: Seconds after which an idle connection is dropped.
+        resolver: An object whose create_connection() opens new connections
+            (like socket.create_connection(), which is used if None).
+    """
+
+    def __init__(self, max_per_host=4, idle_timeout=30, resolver=None):
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self.resolver = resolver
+        self.stats = {'new': 0, 'reused': 0}
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, key):
+        """Returns an idle connection for key, or None if there is none."""
+        now = time.time()
+        with self._lock:
+            conns = self._idle.get(key)
+            while conns:
+                conn, last_used = conns.pop()
+                if now - last_used <= self.idle_timeout and conn.sock:
+                    self.stats['reused'] += 1
+                    return conn
+                conn.close()
+            self.stats['new'] += 1
+        return None
+
+    def release(self, key, conn, reusable=True):
+        """Returns a connection whose response has been fully read."""
+        if not reusable or conn.sock is None:
+            conn.close()
+            return
+        now = time.time()
+        with self._lock:
+            conns = self._idle.setdefault(key, deque())
+            while conns and now - conns[0][1] > self.idle_timeout:
+                conns.popleft()[0].close()
+            if len(conns) >= self.max_per_host:
+                conn.close()
+            else:
+                conns.append((conn, now))
+
+    def clear(self):
+        """Closes all idle connections."""
+        with self._lock:
+            for conns in self._idle.values():
+                for conn, _ in conns:
+                    conn.close()
+            self._idle.clear()
+
+class TLSSessionCache:
+    """Keeps the last TLS session of each host, so that new connections can
+    resume it with an abbreviated handshake. Sessions are kept per SSL
+    context, as a session cannot be resumed with another context.
+    """
+
+    def __init__(self):
+        self.stats = {'full': 0, 'resumed': 0}
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def get(self, context, host):
+        with self._lock:
+            return self._sessions.get((context, host))
+
+    def set(self, context, host, session):
+        if session is None:
+            return
+        with self._lock:
+            self._sessions[context, host] = session
+
+    def record(self, resumed):
+        with self._lock:
+            self.stats['resumed' if resumed else 'full'] += 1
+
+class SessionHTTPSConnection(client.HTTPSConnection):
+    """HTTPSConnection that resumes TLS sessions from session_cache."""
+
+    def __init__(self, host, session_cache=None, **kwargs):
+        client.HTTPSConnection.__init__(self, host, **kwargs)
+        self.session_cache = session_cache
+
+    def connect(self):
+        client.HTTPConnection.connect(self)
+        server_hostname = self._tunnel_host or self.host
+        session = None
+        if self.session_cache is not None:
+            session = self.session_cache.get(self._context, server_hostname)
+        start = time.time()
+        self.sock = self._context.wrap_socket(
+            self.sock, server_hostname=server_hostname, session=session
+        )
+        resumed = self.sock.session_reused
+        logging.debug('TLS handshake with %s: %.1f ms%s' % (
+            server_hostname, (time.time() - start) * 1000,
+            ' (resumed)' if resumed else ''
+        ))
+        if self.session_cache is not None:
+            self.session_cache.record(resumed)
+            self.session_cache.set(self._context, server_hostname,
+                                   self.sock.session)
+
+    def _save_session(self):
+        # the socket is not wrapped yet if the handshake has failed
+        if self.session_cache is not None and \
+                isinstance(self.sock, ssl.SSLSocket):
+            self.session_cache.set(self._context,
+                                   self._tunnel_host or self.host,
+                                   self.sock.session)
+
+    def getresponse(self):
+        response = client.HTTPSConnection.getresponse(self)
+        # with TLS 1.3, the session ticket comes along with the first response
+        self._save_session()
+        return response
+
+    def close(self):
+        self._save_session()
+        client.HTTPSConnection.close(self)
+
+class PooledHTTPResponse(client.HTTPResponse):
+    # called with reusable=True|False once the response is done with
+    _pool_release = None
+
+    def _done(self, reusable):
+        release, self._pool_release = self._pool_release, None
+        if release is not None:
+            release(reusable=reusable)
+
+    def _close_conn(self):
+        client.HTTPResponse._close_conn(self)
+        # the body has been drained, the connection can serve another request
+        self._done(not self.will_close)
+
+    def readinto1(self, b):
+        """Like readinto(), but returns what has arrived instead of waiting
+        for b to fill.
+        """
+        if self.fp is None or self._method == 'HEAD':
+            return 0
+        if self.chunked:
+            data = self.read1(len(b))
+            b[:len(data)] = data
+            return len(data)
+        if self.length is not None and len(b) > self.length:
+            b = memoryview(b)[:self.length]
+        n = self.fp.readinto1(b)
+        if not n and b:
+            self._close_conn()
+        elif self.length is not None:
+            self.length -= n
+            if not self.length:
+                self._close_conn()
+        return n
+
+    def close(self):
+        if self.fp:
+            # closed before the body was drained
+            self._done(False)
+        client.HTTPResponse.close(self)
+
+def _socket_timeout(timeout):
+    if timeout is socket._GLOBAL_DEFAULT_TIMEOUT:
+        return socket.getdefaulttimeout()
+    return timeout
+
+def pooled_open(pool, http_class, req, timeouts=(None, None),
+                **http_conn_args):
+    """Like AbstractHTTPHandler.do_open(), but takes the connection from pool
+    and does not ask the server to close it after the response.
+
+    Args:
+        timeouts: Seconds to wait for a new connection to be established, and
+            for a read unless the request sets its own timeout. None stands
+            for the request's timeout.
+    """
+    connect_timeout, read_timeout = timeouts
+    if read_timeout is None or \
+            req.timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+        read_timeout = _socket_timeout(req.timeout)
+    host = req.host
+    if not host:
+        raise URLError('no host given')
+
+    headers = dict(req.unredirected_hdrs)
+    headers.update({k: v for k, v in req.headers.items()
+                    if k not in headers})
+    headers = {name.title(): val for name, val in headers.items()}
+
+    tunnel_headers = {}
+    if req._tunnel_host:
+        proxy_auth_hdr = 'Proxy-Authorization'
+        if proxy_auth_hdr in headers:
+            tunnel_headers[proxy_auth_hdr] = headers.pop(proxy_auth_hdr)
+
+    key = (http_class.__name__, host, req._tunnel_host)
+    while True:
+        conn = pool.acquire(key)
+        reused = conn is not None
+        if not reused:
+            if connect_timeout is None:
+                connect_timeout = req.timeout
+            conn = http_class(host, timeout=connect_timeout, **http_conn_args)
+            if pool.resolver is not None:
+                conn._create_connection = pool.resolver.create_connection
+            if req._tunnel_host:
+                conn.set_tunnel(req._tunnel_host, headers=tunnel_headers)
+        conn.response_class = PooledHTTPResponse
+
+        try:
+            if not reused:
+                conn.connect()
+            conn.timeout = read_timeout
+            conn.sock.settimeout(read_timeout)
+            conn.request(req.get_method(), req.selector, req.data, headers,
+                         encode_chunked=req.has_header('Transfer-encoding'))
+            r = conn.getresponse()
+        except (ConnectionError, client.BadStatusLine) as err:
+            conn.close()
+            if reused:
+                # the server has dropped the idle connection meanwhile
+                continue
+            raise URLError(err)
+        except OSError as err:  # timeout error
+            conn.close()
+            raise URLError(err)
+        except:
+            conn.close()
+            raise
+        break
+
+    r._pool_release = lambda reusable: pool.release(key, conn, reusable)
+    if r.isclosed():
+        r._done(not r.will_close)
+
+    r.url = req.get_full_url()
+    r.msg = r.reason
+    return r
+
+class PooledHTTPHandler(request.HTTPHandler):
+    def __init__(self, pool, get_timeouts=None, debuglevel=0):
+        request.HTTPHandler.__init__(self, debuglevel)
+        self.pool = pool
+        self.get_timeouts = get_timeouts
+
+    def http_open(self, req):
+        timeouts = self.get_timeouts() if self.get_timeouts else (None, None)
+        return pooled_open(self.pool, client.HTTPConnection, req, timeouts)
+
+class PooledHTTPSHandler(request.HTTPSHandler):
+    """HTTPS handler backed by a ConnectionPool.
+
+    Args:
+        pool: The ConnectionPool to take connections from.
+        get_context: A callable returning the SSLContext for new connections
+            (or None for the default context).
+        get_timeouts: A callable returning the connect and read timeouts
+            (see pooled_open()).
+        session_cache: A TLSSessionCache to resume TLS sessions from.
+    """
+
+    def __init__(self, pool, get_context=None, get_timeouts=None,
+                 session_cache=None, debuglevel=0):
+        request.HTTPSHandler.__init__(self, debuglevel)
+        self.pool = pool
+        self.get_context = get_context
+        self.get_timeouts = get_timeouts
+        self.session_cache = session_cache
+
+    def https_open(self, req):
+        context = self.get_context() if self.get_context else None
+        timeouts = self.get_timeouts() if self.get_timeouts else (None, None)
+        return pooled_open(self.pool, SessionHTTPSConnection, req, timeouts,
+                           context=context, session_cache=self.session_cache)
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+
+import re
+import threading
+import time
+
+def parse_rate(text):
+    """Parses a rate like '500K' or '2M' into bytes per second."""
+    match = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([kmg]?)i?b?\s*$', text, re.I)
+    if not match:
+        raise ValueError('invalid rate: %s' % text)
+    number, unit = match.groups()
+    return int(float(number) * 1024 ** ' kmg'.index(unit.lower() or ' '))
+
+class TokenBucket:
+    """Hands out rate bytes per second, with bursts of up to burst bytes."""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or rate
+        self._tokens = self.burst
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, n):
+        """Takes n bytes from the bucket.
+
+        Returns:
+            The seconds to wait before the bytes may be used. The bucket goes
+            into debt meanwhile, so that concurrent callers queue up.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.burst, self._tokens + (now - self._last) * self.rate
+            )
+            self._last = now
+            self._tokens -= n
+            if self._tokens >= 0:
+                return 0
+            return -self._tokens / self.rate
+
+class RateLimiter:
+    """Caps the bandwidth of all transfers together, and optionally of the
+    transfers from given hosts.
+
+    Args:
+        rate: Bytes per second for all transfers, or None for no limit.
+        host_rates: A dict of hostnames to bytes per second.
+    """
+
+    def __init__(self, rate=None, host_rates={}):
+        self.bucket = TokenBucket(rate) if rate else None
+        self.host_buckets = {host: TokenBucket(host_rate)
+                             for host, host_rate in host_rates.items()}
+
+    def reserve(self, host, n):
+        """Accounts for n bytes received from host, and returns the seconds
+        to wait before receiving more."""
+        delay = self.bucket.reserve(n) if self.bucket else 0
+        if host in self.host_buckets:
+            delay = max(delay, self.host_buckets[host].reserve(n))
+        return delay
+
+    def throttle(self, host, n):
+        """Like reserve(), but waits itself."""
+        delay = self.reserve(host, n)
+        if delay > 0:
+            time.sleep(delay)
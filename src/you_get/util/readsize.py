@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+
+import time
+
+class ReadSizer:
+    """Picks the size of the reads of a transfer from its throughput.
+
+    Reads are about target seconds worth of data, in powers of two between
+    min_size and max_size, so that fast transfers take few large reads while
+    slow ones still update the progress bar often.
+
+    Args:
+        min_size: The smallest read size.
+        max_size: The largest read size.
+        target: Seconds of data to read at once.
+        interval: Seconds between two measures of the throughput.
+    """
+
+    def __init__(self, min_size=64 * 1024, max_size=4 * 1024 * 1024,
+                 target=0.05, interval=0.25):
+        self.min_size = min_size
+        self.max_size = max(max_size, min_size)
+        self.target = target
+        self.interval = interval
+        self.size = max(min(256 * 1024, self.max_size), self.min_size)
+        # bytes per second
+        self.rate = None
+        self._buffer = None
+        self._start = time.monotonic()
+        self._received = 0
+
+    def view(self):
+        """Returns a reused buffer of the current read size."""
+        if self._buffer is None or len(self._buffer) < self.size:
+            self._buffer = memoryview(bytearray(self.size))
+        return self._buffer[:self.size]
+
+    def reset(self):
+        """Starts measuring anew, e.g. after reconnecting."""
+        self._start = time.monotonic()
+        self._received = 0
+
+    def update(self, n):
+        """Records n received bytes.
+
+        Returns:
+            The size of the next read.
+        """
+        self._received += n
+        now = time.monotonic()
+        elapsed = now - self._start
+        if elapsed < self.interval:
+            return self.size
+        rate = self._received / elapsed
+        self.rate = rate if self.rate is None else (self.rate + rate) / 2
+        self._start, self._received = now, 0
+        size = self.min_size
+        while size < self.rate * self.target and size < self.max_size:
+            size *= 2
+        self.size = min(size, self.max_size)
+        return self.size
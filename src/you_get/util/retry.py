@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+
+import itertools
+import logging
+import random
+import socket
+import ssl
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from http import client
+from urllib.error import HTTPError, URLError
+
+# status codes that tell to try again later
+RETRY_STATUS = (408, 425, 429, 500, 502, 503, 504)
+
+# errors a response may raise while its body is being read
+STREAM_ERRORS = (OSError, client.HTTPException)
+
+# certificates that do not verify, which no retry would change; the
+# specific error is from Python 3.7
+CERT_ERROR = getattr(ssl, 'SSLCertVerificationError', ssl.CertificateError)
+
+class CircuitOpenError(URLError):
+    def __init__(self, host):
+        URLError.__init__(self, 'too many failures from %s, giving up' % host)
+        self.host = host
+
+class CircuitBreaker:
+    """Stops sending requests to a host after threshold failures in a row,
+    until cooldown seconds have passed.
+    """
+
+    def __init__(self, threshold=5, cooldown=60):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self._failures = {}
+        self._opened = {}
+        self._lock = threading.Lock()
+
+    def check(self, host):
+        """Raises CircuitOpenError if host is not to be contacted now."""
+        with self._lock:
+            opened = self._opened.get(host)
+        if opened is not None and time.time() - opened < self.cooldown:
+            raise CircuitOpenError(host)
+
+    def failure(self, host):
+        with self._lock:
+            failures = self._failures.get(host, 0) + 1
+            self._failures[host] = failures
+            if failures >= self.threshold:
+                if host not in self._opened:
+                    logging.debug('circuit opened for %s' % host)
+                # (re)opened, also when a trial after the cooldown fails
+                self._opened[host] = time.time()
+
+    def success(self, host):
+        with self._lock:
+            self._failures.pop(host, None)
+            self._opened.pop(host, None)
+
+class RetryPolicy:
+    """Decides which failures are retried, and how long to wait in between.
+
+    Args:
+        retries: Maximum number of retries after the first attempt.
+        backoff: Seconds to wait before the first retry, doubled for each
+            further one.
+        max_backoff: Upper bound of a wait, also for Retry-After.
+        jitter: Fraction of each wait that is randomized.
+    """
+
+    def __init__(self, retries=2, backoff=1, max_backoff=60, jitter=0.5):
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+
+    def retryable(self, err):
+        if isinstance(err, CircuitOpenError):
+            return False
+        if isinstance(err, HTTPError):
+            return err.code in RETRY_STATUS
+        if isinstance(err, URLError):
+            return isinstance(err.reason, OSError) and \
+                not isinstance(err.reason, CERT_ERROR)
+        return isinstance(err, (socket.timeout, ConnectionError,
+                                client.HTTPException))
+
+    def retry_after(self, err):
+        """Returns the seconds the server asks to wait with Retry-After."""
+        value = getattr(err, 'headers', None) and err.headers.get('Retry-After')
+        if not value:
+            return None
+        try:
+            return max(float(value), 0)
+        except ValueError:
+            pass
+        try:
+            return max(parsedate_to_datetime(value).timestamp() - time.time(), 0)
+        except (TypeError, ValueError):
+            return None
+
+    def delay(self, attempt, err=None):
+        """Returns the seconds to wait before the attempt-th retry."""
+        retry_after = self.retry_after(err) if err is not None else None
+        if retry_after is not None:
+            return min(retry_after, self.max_backoff)
+        delay = min(self.backoff * 2 ** (attempt - 1), self.max_backoff)
+        return delay * (1 - self.jitter * random.random())
+
+    def handle(self, err, attempt, host=None, breaker=None):
+        """Records that attempt (counted from 0) failed with err.
+
+        Returns:
+            The seconds to wait before trying again, or None if err is not to
+            be retried.
+        """
+        if not self.retryable(err):
+            if breaker is not None and isinstance(err, HTTPError):
+                # the host is up, it just does not like the request
+                breaker.success(host)
+            return None
+        if breaker is not None:
+            breaker.failure(host)
+        if attempt >= self.retries:
+            return None
+        return self.delay(attempt + 1, err)
+
+    def call(self, func, host=None, breaker=None):
+        """Calls func until it succeeds, or fails for good."""
+        for attempt in itertools.count():
+            if breaker is not None:
+                breaker.check(host)
+            try:
+                result = func()
+            except Exception as err:
+                delay = self.handle(err, attempt, host, breaker)
+                if delay is None:
+                    raise
+                logging.debug('request attempt %d failed (%s), retrying in '
+                              '%.1fs' % (attempt + 1, err, delay))
+                if isinstance(err, HTTPError):
+                    # gives its connection back before waiting
+                    err.close()
+                time.sleep(delay)
+            else:
+                if breaker is not None:
+                    breaker.success(host)
+                return result
@@ -0,0 +1,37 @@
+#!/usr/bin/env python
+
+import time
+
+class StallWatchdog:
+    """Tells when a transfer has received less than min_speed bytes per
+    second over the last window seconds (never if window is 0).
+    """
+
+    def __init__(self, window=30, min_speed=1024):
+        self.window = window
+        self.min_speed = min_speed
+        self.stalls = 0
+        self.reset()
+
+    def reset(self):
+        """Starts a new window, e.g. after reconnecting."""
+        self._start = time.time()
+        self._received = 0
+
+    def update(self, n):
+        """Records n received bytes.
+
+        Returns:
+            True if the transfer has stalled, False otherwise.
+        """
+        if not self.window:
+            return False
+        self._received += n
+        elapsed = time.time() - self._start
+        if elapsed < self.window:
+            return False
+        stalled = self._received < self.min_speed * elapsed
+        self.reset()
+        if stalled:
+            self.stalls += 1
+        return stalled
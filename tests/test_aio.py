@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+
+import os
+import tempfile
+import threading
+import unittest
+from http import cookiejar, server
+
+from you_get import aio
+from you_get.common import DownloadSession
+
+DATA = bytes(range(256)) * 64
+
+class Handler(server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def send_body(self, body, code=200, headers={}):
+        self.send_response(code)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/data':
+            start = 0
+            byte_range = self.headers.get('Range')
+            self.server.ranges.append(byte_range)
+            if byte_range:
+                start = int(byte_range[6:].split('-')[0])
+                self.send_body(DATA[start:], 206, {
+                    'Content-Range': 'bytes %d-%d/%d' % (
+                        start, len(DATA) - 1, len(DATA)
+                    )
+                })
+            else:
+                self.send_body(DATA)
+        elif self.path == '/chunked':
+            self.send_response(200)
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            for i in range(0, len(DATA), 1000):
+                chunk = DATA[i:i + 1000]
+                self.wfile.write(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+            self.wfile.write(b'0\r\n\r\n')
+        elif self.path.startswith('/login?to='):
+            self.send_body(b'', 302, {'Location': self.path[10:],
+                                      'Set-Cookie': 'token=secret; Path=/'})
+        elif self.path == '/cookie':
+            self.send_body(self.headers.get('Cookie', '').encode())
+        else:
+            self.send_body(b'', 404)
+
+class TestAio(unittest.TestCase):
+    def setUp(self):
+        # a port of its own, so that no connection is left from other tests
+        self.server = server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.server.connections = 0
+        self.server.ranges = []
+        threading.Thread(target=self.server.serve_forever,
+                         daemon=True).start()
+        self.port = self.server.server_address[1]
+        self.base = 'http://127.0.0.1:%d' % self.port
+        self.session = DownloadSession(proxies={},
+                                       cookies=cookiejar.CookieJar())
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def urlopen(self, url):
+        return aio.run(aio.aurlopen(url, session=self.session))
+
+    def test_keep_alive(self):
+        for _ in range(3):
+            with self.urlopen(self.base + '/data') as response:
+                self.assertEqual(response.read(), DATA)
+        self.assertEqual(self.server.connections, 1)
+
+    def test_chunked(self):
+        response = self.urlopen(self.base + '/chunked')
+        self.assertTrue(response.chunked)
+        self.assertEqual(response.read(), DATA)
+        # the connection is reused after the last chunk
+        self.assertEqual(self.urlopen(self.base + '/data').read(), DATA)
+        self.assertEqual(self.server.connections, 1)
+
+    def test_redirect_cookies(self):
+        response = self.urlopen(self.base + '/login?to=/cookie')
+        self.assertEqual(response.url, self.base + '/cookie')
+        self.assertEqual(response.read(), b'token=secret')
+        # not sent to another host
+        other = 'http://localhost:%d/cookie' % self.port
+        response = self.urlopen(self.base + '/login?to=' + other)
+        self.assertEqual(response.url, other)
+        self.assertEqual(response.read(), b'')
+
+    def test_save_parts_resume(self):
+        with tempfile.TemporaryDirectory() as dir:
+            path = os.path.join(dir, 'part')
+            with open(path + '.download', 'wb') as f:
+                f.write(DATA[:1000])
+            with self.session:
+                aio.save_parts([(self.base + '/data', path)], None,
+                               workers=1, timeout=10)
+            with open(path, 'rb') as f:
+                self.assertEqual(f.read(), DATA)
+            self.assertFalse(os.path.exists(path + '.download'))
+        self.assertEqual(self.server.ranges, ['bytes=1000-'])
+
+    def test_supports(self):
+        session = DownloadSession(proxies={'https': 'proxy:3128'})
+        self.assertTrue(aio.supports('http://example.com/', session))
+        self.assertEqual(aio.supports('https://example.com/', session),
+                         hasattr(aio.asyncio.StreamWriter, 'start_tls'))
+        self.assertTrue(aio.supports('https://example.com/',
+                                     DownloadSession(proxies={})))
+
+if __name__ == '__main__':
+    unittest.main()
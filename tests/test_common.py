@@ -9,3 +9,138 @@ class TestCommon(unittest.TestCase):
     def test_match1(self):
         self.assertEqual(match1('http://youtu.be/1234567890A', r'youtu.be/([^/]+)'), '1234567890A')
         self.assertEqual(match1('http://youtu.be/1234567890A', r'youtu.be/([^/]+)', r'youtu.(\w+)'), ['1234567890A', 'be'])
+
+    def test_decode_chunks(self):
+        import gzip
+        data = gzip.compress('中文'.encode('utf-8')) + gzip.compress(b'!')
+        chunks = [data[i:i + 3] for i in range(0, len(data), 3)]
+        self.assertEqual(''.join(decode_chunks(chunks, 'gzip', 'utf-8')), '中文!')
+        self.assertEqual(b''.join(decode_chunks([b'ab', b'c'])), b'abc')
+
+    def test_download_session(self):
+        from you_get import common
+        self.assertIs(get_session(), default_session)
+        common.force = True
+        self.assertTrue(default_session.force)
+        common.force = False
+        session = DownloadSession(force=True)
+        with session:
+            self.assertIs(get_session(), session)
+            self.assertTrue(get_session().force)
+        self.assertIs(get_session(), default_session)
+        self.assertFalse(get_session().force)
+
+    def test_download_jobs(self):
+        import io
+        import sys
+        from you_get import common
+        def download(url, **kwargs):
+            print(url, get_session().force, get_session().output_filename)
+            if url.endswith('bad'):
+                raise ValueError(url)
+        output = io.StringIO()
+        stdout, sys.stdout = sys.stdout, output
+        try:
+            with DownloadSession(force=True, output_filename='v.mp4'):
+                failed = common.download_jobs(
+                    download, None, ['http://a', 'b', 'http://bad'], False, 2
+                )
+        finally:
+            sys.stdout = stdout
+        self.assertEqual(failed, 1)
+        # in the order of the URLs, with the settings of the caller
+        self.assertEqual(output.getvalue().splitlines(), [
+            'http://a True v.mp4', 'http://b True v.mp4',
+            'http://bad True v.mp4',
+        ])
+
+    def test_parse_job(self):
+        from you_get.server import JobError, parse_job
+        url, args = parse_job({'url': 'http://example.com/v',
+                               'options': {'output-dir': '/tmp', 'force': True,
+                                           'no_merge': False}})
+        self.assertEqual(url, 'http://example.com/v')
+        self.assertEqual(args.output_dir, '/tmp')
+        self.assertTrue(args.force)
+        self.assertFalse(args.no_merge)
+        self.assertRaises(JobError, parse_job, {'options': {}})
+        self.assertRaises(JobError, parse_job,
+                          {'url': 'http://example.com/v', 'options': {'timeout': 1}})
+
+    def test_url_save_preallocates(self):
+        import os
+        import tempfile
+        import threading
+        from http import server
+        from you_get import common
+        data = os.urandom(100000)
+
+        class Handler(server.BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        httpd = server.HTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        calls = []
+        preallocate = common.preallocate
+        common.preallocate = lambda output, size: calls.append(size)
+        try:
+            with tempfile.TemporaryDirectory() as dir:
+                path = os.path.join(dir, 'video.mp4')
+                # a fresh download, without force
+                url_save('http://127.0.0.1:%d/video.mp4' %
+                         httpd.server_address[1], path, None)
+                with open(path, 'rb') as f:
+                    self.assertEqual(f.read(), data)
+        finally:
+            common.preallocate = preallocate
+            httpd.shutdown()
+            httpd.server_close()
+        self.assertEqual(calls, [len(data)])
+
+    def test_job_server_shutdown(self):
+        import threading
+        from you_get.server import JobServer
+        httpd = JobServer(('127.0.0.1', 0))
+        started = threading.Event()
+        release = threading.Event()
+        httpd.run = lambda job: (started.set(), release.wait(5))
+        jobs = [httpd.submit('http://example.com/%d' % i, None)
+                for i in range(3)]
+        started.wait(5)
+        thread = threading.Thread(target=httpd.serve_forever)
+        thread.start()
+        httpd.shutdown()
+        thread.join()
+        release.set()
+        httpd.server_close()
+        self.assertEqual([job.state for job in jobs],
+                         ['queued', 'cancelled', 'cancelled'])
+
+    def test_is_local_host(self):
+        from you_get.server import is_local_host
+        self.assertTrue(is_local_host('127.0.0.1:8080'))
+        self.assertTrue(is_local_host('[::1]:8080'))
+        self.assertTrue(is_local_host('localhost'))
+        self.assertTrue(is_local_host('box:8080', 'box'))
+        self.assertFalse(is_local_host('example.com:8080'))
+        self.assertFalse(is_local_host('127.0.0.1.example.com'))
+        self.assertFalse(is_local_host(''))
+
+    def test_receiver(self):
+        import io
+        output = io.BytesIO()
+        receiver = Receiver('http://example.com/v', output, offset=2)
+        self.assertEqual(receiver.receive(io.BytesIO(b'abcdef'), 6),
+                         Receiver.DONE)
+        self.assertEqual((output.getvalue(), receiver.offset), (b'abcd', 6))
+        self.assertEqual(receiver.receive(io.BytesIO(b'gh')), Receiver.EOF)
+        self.assertEqual(receiver.offset, 8)
+        receiver.failures = retry_policy.retries
+        self.assertRaises(IOError, receiver.fail)
@@ -0,0 +1,491 @@
+#!/usr/bin/env python
+
+import os
+import struct
+import tempfile
+import unittest
+from io import BytesIO
+
+from you_get.processor.join_mp4 import (get_stco, layout_moov, merge_mp4s,
+                                        merge_stco, read_atom, read_elst,
+                                        read_mp4)
+from you_get.processor.mux import (CLUSTER, CUE_CLUSTER_POSITION, CUE_POINT,
+                                   CUE_TRACK_POSITIONS, CUES, DURATION, EBML,
+                                   INFO, SEGMENT, SIMPLE_BLOCK, TIMECODE,
+                                   TIMECODE_SCALE, TRACK_ENTRY, TRACK_NUMBER,
+                                   TRACK_UID, TRACKS, WebM, element, elements,
+                                   mux_mp4s, mux_webms, read_element_header,
+                                   read_elements, read_uint, read_vint, uint)
+
+def box(type, body):
+    return struct.pack('>I', 8 + len(body)) + type + body
+
+def full_box(type, body, flags=0):
+    return box(type, struct.pack('>I', flags) + body)
+
+def table(type, entries, fmt):
+    return full_box(type, struct.pack('>I', len(entries)) + b''.join(
+        struct.pack(fmt, *x) for x in entries
+    ))
+
+def sample_entry(handler):
+    if handler == b'vide':
+        avcC = box(b'avcC', b'\x01\x64\x00\x1f\xff\xe1\x00\x04abcd\x01\x00\x02ef')
+        return box(b'avc1', bytes(6) + struct.pack('>H', 1) + bytes(16) +
+                   struct.pack('>HHIIIH', 320, 240, 72 << 16, 72 << 16, 0, 1) +
+                   bytes(32) + b'\x00\x18\xff\xff' + avcC)
+    esds = full_box(b'esds', bytes(26))
+    # ffmpeg writes a btrt after esds
+    btrt = box(b'btrt', bytes(12))
+    return box(b'mp4a', bytes(6) + struct.pack('>H', 1) + bytes(8) +
+               struct.pack('>HHIHH', 2, 16, 0, 44100, 0) + esds + btrt)
+
+def make_mp4(path, tracks, chunk_size=4, movie_time_scale=1000):
+    """Writes an MP4 file with an mdat then a moov, of tracks given as
+    (handler, time_scale, sample_delta, samples, edits), with chunks of
+    chunk_size samples, those of the first track first.
+    """
+    ftyp = box(b'ftyp', b'isom\x00\x00\x02\x00isomavc1')
+    offset = len(ftyp) + 8
+    traks = []
+    duration = 0
+    for i, (handler, time_scale, delta, samples, edits) in enumerate(tracks):
+        chunks = [samples[j:j + chunk_size]
+                  for j in range(0, len(samples), chunk_size)]
+        offsets = []
+        for chunk in chunks:
+            offsets.append((offset,))
+            offset += sum(map(len, chunk))
+        track_duration = len(samples) * delta * movie_time_scale // time_scale
+        duration = max(duration, track_duration)
+        stsc = [(1, chunk_size, 1)]
+        if len(samples) % chunk_size:
+            stsc.append((len(chunks), len(samples) % chunk_size, 1))
+        stbl = box(b'stbl', b''.join([
+            full_box(b'stsd', struct.pack('>I', 1) + sample_entry(handler)),
+            table(b'stts', [(len(samples), delta)], '>II'),
+            table(b'stsc', stsc, '>III'),
+            full_box(b'stsz', struct.pack('>II', 0, len(samples)) +
+                     b''.join(struct.pack('>I', len(x)) for x in samples)),
+            table(b'stco', offsets, '>I'),
+        ]))
+        header = full_box(b'vmhd', bytes(8), 1) if handler == b'vide' \
+            else full_box(b'smhd', bytes(4))
+        dinf = box(b'dinf', full_box(b'dref', struct.pack('>I', 1) +
+                                     full_box(b'url ', b'', 1)))
+        mdia = box(b'mdia', b''.join([
+            full_box(b'mdhd', struct.pack('>IIIIHH', 0, 0, time_scale,
+                                          len(samples) * delta, 0x55c4, 0)),
+            full_box(b'hdlr', bytes(4) + handler + bytes(12) + b'name\x00'),
+            box(b'minf', header + dinf + stbl),
+        ]))
+        tkhd = full_box(b'tkhd', struct.pack('>IIIII', 0, 0, i + 1, 0,
+                                             track_duration) +
+                        bytes(52) + struct.pack('>II', 320 << 16, 240 << 16),
+                        3)
+        edts = b''
+        if edits is not None:
+            edts = box(b'edts', table(b'elst', edits, '>IiI'))
+        traks.append(box(b'trak', tkhd + edts + mdia))
+    mvhd = full_box(b'mvhd', struct.pack('>IIII', 0, 0, movie_time_scale,
+                                         duration) +
+                    struct.pack('>IH', 0x10000, 0x100) + bytes(70) +
+                    struct.pack('>I', len(tracks) + 1))
+    payload = b''.join(b''.join(x[3]) for x in tracks)
+    with open(path, 'wb') as f:
+        f.write(ftyp + box(b'mdat', payload) + box(b'moov', mvhd +
+                                                    b''.join(traks)))
+
+def make_init(path, handlers, time_scale=1000):
+    """Writes a DASH init segment, with a moov of tracks of the given
+    handlers and time scale, and no samples.
+    """
+    traks = []
+    trexs = []
+    for i, handler in enumerate(handlers):
+        stbl = box(b'stbl', b''.join([
+            full_box(b'stsd', struct.pack('>I', 1) + sample_entry(handler)),
+            table(b'stts', [], '>II'),
+            table(b'stsc', [], '>III'),
+            full_box(b'stsz', struct.pack('>II', 0, 0)),
+            table(b'stco', [], '>I'),
+        ]))
+        mdia = box(b'mdia', b''.join([
+            full_box(b'mdhd', struct.pack('>IIIIHH', 0, 0, time_scale, 0,
+                                          0x55c4, 0)),
+            full_box(b'hdlr', bytes(4) + handler + bytes(12) + b'name\x00'),
+            box(b'minf', full_box(b'nmhd', b'') + stbl),
+        ]))
+        tkhd = full_box(b'tkhd', struct.pack('>IIIII', 0, 0, i + 1, 0, 0) +
+                        bytes(60), 3)
+        traks.append(box(b'trak', tkhd + mdia))
+        trexs.append(full_box(b'trex', struct.pack('>IIIII', i + 1, 1, 0, 0,
+                                                    0)))
+    mvhd = full_box(b'mvhd', struct.pack('>IIII', 0, 0, 1000, 0) +
+                    struct.pack('>IH', 0x10000, 0x100) + bytes(70) +
+                    struct.pack('>I', len(handlers) + 1))
+    mvex = box(b'mvex', full_box(b'mehd', struct.pack('>I', 999)) +
+               b''.join(trexs))
+    with open(path, 'wb') as f:
+        f.write(box(b'ftyp', b'iso6\x00\x00\x02\x00iso6dash') +
+                box(b'moov', mvhd + b''.join(traks) + mvex))
+
+def make_segment(path, fragments, start, delta, base_data_offset=False,
+                 append=False):
+    """Writes a DASH media segment of fragments, each a list of the samples
+    of every track, whose decode times start at start and whose samples all
+    last delta. Data offsets are from the moof, or from the start of the
+    file with base_data_offset. With append, the segment is written after
+    what path has, as in a single fragmented file.
+    """
+    position = os.path.getsize(path) if append else 0
+    data = bytearray(box(b'styp', b'msdh\x00\x00\x00\x00msdhmsix'))
+    data += full_box(b'sidx', bytes(24))
+    time = start
+    for fragment in fragments:
+        def moof(offset):
+            trafs = []
+            for i, samples in enumerate(fragment):
+                if base_data_offset:
+                    tfhd = full_box(b'tfhd', struct.pack(
+                        '>IQ', i + 1, position + len(data)
+                    ), 0x01)
+                else:
+                    tfhd = full_box(b'tfhd', struct.pack('>I', i + 1),
+                                    0x020000)
+                tfdt = box(b'tfdt', struct.pack('>BxxxQ', 1, time))
+                trun = full_box(b'trun', struct.pack(
+                    '>Ii', len(samples), offset
+                ) + b''.join(struct.pack('>II', delta, len(x))
+                             for x in samples), 0x301)
+                trafs.append(box(b'traf', tfhd + tfdt + trun))
+                offset += sum(map(len, samples))
+            return box(b'moof', full_box(b'mfhd', struct.pack('>I', 1)) +
+                       b''.join(trafs))
+        # the samples follow the mdat header, after the moof
+        data += moof(len(moof(0)) + 8)
+        data += box(b'mdat', b''.join(b''.join(x) for x in fragment))
+        time += len(fragment[0]) * delta
+    with open(path, 'ab' if append else 'wb') as f:
+        f.write(data)
+
+def read_fragments(path):
+    """Returns the top-level atom types of a fragmented MP4 file, the
+    sequence numbers of its moofs, and the decode times and the samples of
+    its fragments by track.
+    """
+    with open(path, 'rb') as f:
+        atoms, _, _ = read_mp4(f)
+        sequence_numbers = []
+        times = {}
+        samples = {}
+        for moof in atoms:
+            if moof.type != b'moof':
+                continue
+            sequence_numbers.append(moof.get(b'mfhd').get('sequence_number'))
+            for traf in moof.get_all(b'traf'):
+                tfhd = traf.get(b'tfhd')
+                track_id = tfhd.get('track_id')
+                offset = tfhd.get('base_data_offset') if tfhd.flags & 0x01 \
+                    else moof.offset
+                times.setdefault(track_id, []).append(
+                    traf.get(b'tfdt').get('base_media_decode_time')
+                )
+                body = traf.get(b'trun').body
+                count, data_offset = struct.unpack('>Ii', body[4:12])
+                offset += data_offset
+                for j in range(count):
+                    _, size = struct.unpack('>II', body[12 + 8 * j:20 + 8 * j])
+                    f.seek(offset)
+                    samples.setdefault(track_id, []).append(f.read(size))
+                    offset += size
+    return [x.type for x in atoms], sequence_numbers, times, samples
+
+def read_tracks(path):
+    """Returns the moov of an MP4 file, its top-level atom types, and the
+    samples of its tracks.
+    """
+    with open(path, 'rb') as f:
+        atoms, moov, _ = read_mp4(f)
+        tracks = []
+        for trak in moov.get_all(b'trak'):
+            stbl = trak.get(b'mdia', b'minf', b'stbl')
+            sizes = stbl.get(b'stsz').body[3]
+            stco = [x for x in stbl.body if x.type in (b'stco', b'co64')][0]
+            chunks = stbl.get(b'stsc').body[1]
+            samples = []
+            for i, offset in enumerate(stco.body[1]):
+                # the last entry of stsc which the chunk is in
+                n = [chunks[j + 1] for j in range(0, len(chunks), 3)
+                     if chunks[j] <= i + 1][-1]
+                for _ in range(n):
+                    f.seek(offset)
+                    size = sizes[len(samples)]
+                    samples.append(f.read(size))
+                    offset += size
+            tracks.append(samples)
+    return moov, [x.type for x in atoms], tracks
+
+def make_webm(path, track_uid, timecodes, tag):
+    """Writes a WebM file of one track, with a cluster of one block at each
+    of the timecodes (in milliseconds).
+    """
+    info = elements([(TIMECODE_SCALE, uint(1000000)),
+                     (DURATION, struct.pack('>d', timecodes[-1] + 100))])
+    tracks = element(TRACK_ENTRY, elements([(TRACK_NUMBER, uint(1)),
+                                            (TRACK_UID, uint(track_uid))]))
+    clusters = b''.join(element(CLUSTER, elements([
+        (TIMECODE, uint(timecode)),
+        # track 1, at the timecode of the cluster, a keyframe
+        (SIMPLE_BLOCK, b'\x81\x00\x00\x80' + ('%s%d' % (tag, i)).encode()),
+    ])) for i, timecode in enumerate(timecodes))
+    with open(path, 'wb') as f:
+        f.write(element(EBML, elements([(0x4282, b'webm')])) + element(
+            SEGMENT, element(INFO, info) + element(TRACKS, tracks) + clusters
+        ))
+
+def make_samples(tag, n):
+    return [('%s %d;' % (tag, i)).encode() * (i % 5 + 1) for i in range(n)]
+
+class TestProcessor(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def path(self, name):
+        return os.path.join(self.dir.name, name)
+
+    def test_merge_mp4s(self):
+        parts = []
+        for i, n in enumerate((10, 7)):
+            video = make_samples('v%d' % i, n)
+            audio = make_samples('a%d' % i, n + 2)
+            # audio starts after 1024 samples of priming
+            make_mp4(self.path('%d.mp4' % i), [
+                (b'vide', 1000, 40, video, [(n * 40, 0, 0x10000)]),
+                (b'soun', 44100, 1024, audio,
+                 [((n + 1) * 1024 * 1000 // 44100, 1024, 0x10000)]),
+            ])
+            parts.append((video, audio))
+        merge_mp4s([self.path('0.mp4'), self.path('1.mp4')],
+                   self.path('merged.mp4'))
+
+        moov, types, tracks = read_tracks(self.path('merged.mp4'))
+        self.assertEqual(types, [b'ftyp', b'moov', b'mdat'])
+        self.assertEqual(tracks, [parts[0][0] + parts[1][0],
+                                  parts[0][1] + parts[1][1]])
+        self.assertEqual(moov.get(b'mvhd').get('duration'), 17 * 40)
+        video, audio = moov.get_all(b'trak')
+        self.assertEqual(video.get(b'mdia', b'mdhd').get('duration'),
+                         17 * 40)
+        self.assertEqual(audio.get(b'mdia', b'mdhd').get('duration'),
+                         21 * 1024)
+        # each part is played, after the priming of its own audio
+        self.assertEqual(read_elst(video), [(400, 0, 0x10000),
+                                            (280, 400, 0x10000)])
+        self.assertEqual(read_elst(audio), [(255, 1024, 0x10000),
+                                            (185, 13 * 1024, 0x10000)])
+
+    def test_merge_mp4s_faststart(self):
+        video = make_samples('v', 9)
+        make_mp4(self.path('0.mp4'), [(b'vide', 1000, 40, video[:5], None)])
+        make_mp4(self.path('1.mp4'), [(b'vide', 1000, 40, video[5:], None)])
+        merge_mp4s([self.path('0.mp4'), self.path('1.mp4')],
+                   self.path('merged.mp4'))
+
+        moov, types, tracks = read_tracks(self.path('merged.mp4'))
+        # the moov comes before the mdat, which the offsets are moved past
+        self.assertEqual(types, [b'ftyp', b'moov', b'mdat'])
+        self.assertEqual(tracks, [video])
+        self.assertEqual(get_stco(moov.get(b'trak')).type, b'stco')
+
+    def test_layout_moov_co64(self):
+        make_mp4(self.path('0.mp4'), [
+            (b'vide', 1000, 40, make_samples('v', 10), None),
+            (b'soun', 44100, 1024, make_samples('a', 12), None),
+        ])
+        with open(self.path('0.mp4'), 'rb') as f:
+            _, moov, mdats = read_mp4(f)
+        stco_atoms = [get_stco(x) for x in moov.get_all(b'trak')]
+        offsets = stco_atoms[0].body[1]
+        size = moov.calsize()
+
+        start = layout_moov(moov, stco_atoms, 32, 1 << 20)
+        self.assertEqual([x.type for x in stco_atoms], [b'stco', b'stco'])
+        self.assertEqual(start, 32 + size + 8)
+
+        # payloads ending past 4 GiB need 64-bit offsets, and mdat size
+        start = layout_moov(moov, stco_atoms, 32, 1 << 32)
+        self.assertEqual([x.type for x in stco_atoms], [b'co64', b'co64'])
+        # 3 chunks of each track, with offsets of 8 bytes instead of 4
+        self.assertEqual(moov.calsize(), size + 6 * 4)
+        self.assertEqual(start, 32 + moov.calsize() + 16)
+
+        # as if the payloads of other files came first
+        shift = (1 << 32) + 100
+        stco_atom = stco_atoms[0]
+        stco_atom.body = stco_atom.body[0], merge_stco(
+            [offsets], [mdats], start + shift, stco_atom.typecode()
+        )
+        expected = [x - mdats[0].body[1] + start + shift for x in offsets]
+        self.assertEqual(stco_atom.body[1].tolist(), expected)
+        output = BytesIO()
+        stco_atom.write(output)
+        self.assertEqual(len(output.getvalue()), stco_atom.calsize())
+        output.seek(0)
+        self.assertEqual(read_atom(output).body[1].tolist(), expected)
+
+    def test_merge_mixed_mp4s(self):
+        make_mp4(self.path('0.mp4'), [(b'vide', 1000, 40,
+                                       make_samples('v', 4), None)])
+        with open(self.path('1.mp4'), 'wb') as f:
+            f.write(box(b'ftyp', b'iso6\x00\x00\x02\x00iso6') +
+                    box(b'moov', b'') + box(b'moof', b'') + box(b'mdat', b''))
+        self.assertRaises(NotImplementedError, merge_mp4s,
+                          [self.path('0.mp4'), self.path('1.mp4')],
+                          self.path('merged.mp4'))
+
+    def test_merge_fragments(self):
+        make_init(self.path('init.mp4'), [b'vide', b'soun'])
+        fragments = [[make_samples('v%d' % i, 3), make_samples('a%d' % i, 3)]
+                     for i in range(4)]
+        make_segment(self.path('0.m4s'), fragments[:2], 0, 40)
+        # a segment whose timeline starts again, with absolute offsets
+        make_segment(self.path('1.m4s'), fragments[2:], 0, 40,
+                     base_data_offset=True)
+        merge_mp4s([self.path('init.mp4'), self.path('0.m4s'),
+                    self.path('1.m4s')], self.path('merged.mp4'))
+
+        types, sequence_numbers, times, samples = read_fragments(
+            self.path('merged.mp4')
+        )
+        # the segment headers and indexes are dropped
+        self.assertEqual(types, [b'ftyp', b'moov'] + [b'moof', b'mdat'] * 4)
+        self.assertEqual(sequence_numbers, [1, 2, 3, 4])
+        self.assertEqual(times, {1: [0, 120, 240, 360],
+                                 2: [0, 120, 240, 360]})
+        # base_data_offset is moved along with its fragment
+        self.assertEqual(samples, {
+            1: [x for fragment in fragments for x in fragment[0]],
+            2: [x for fragment in fragments for x in fragment[1]],
+        })
+        with open(self.path('merged.mp4'), 'rb') as f:
+            _, moov, _ = read_mp4(f)
+        self.assertEqual(moov.get_all(b'mvex')[0].get_all(b'mehd'), [])
+
+    def test_mux_fragments(self):
+        video = [make_samples('v%d' % i, 3) for i in range(3)]
+        audio = [make_samples('a%d' % i, 3) for i in range(4)]
+        make_init(self.path('video.mp4'), [b'vide'])
+        make_segment(self.path('video.mp4'), [[x] for x in video], 0, 40,
+                     append=True)
+        make_init(self.path('audio.mp4'), [b'soun'], 44100)
+        make_segment(self.path('audio.mp4'), [[x] for x in audio], 0, 1024,
+                     base_data_offset=True, append=True)
+        mux_mp4s([self.path('video.mp4'), self.path('audio.mp4')],
+                 self.path('muxed.mp4'))
+
+        types, sequence_numbers, times, samples = read_fragments(
+            self.path('muxed.mp4')
+        )
+        self.assertEqual(types, [b'ftyp', b'moov'] + [b'moof', b'mdat'] * 7)
+        self.assertEqual(sequence_numbers, list(range(1, 8)))
+        # the fragments of 0.12 and 0.07 seconds, interleaved by time
+        self.assertEqual(times, {1: [0, 120, 240],
+                                 2: [0, 3072, 6144, 9216]})
+        self.assertEqual(samples, {1: sum(video, []), 2: sum(audio, [])})
+        with open(self.path('muxed.mp4'), 'rb') as f:
+            atoms, moov, _ = read_mp4(f)
+        order = [moof.get(b'traf', b'tfhd').get('track_id')
+                 for moof in atoms if moof.type == b'moof']
+        self.assertEqual(order, [1, 2, 2, 1, 2, 2, 1])
+        self.assertEqual([x.get(b'tkhd').get('track_id')
+                          for x in moov.get_all(b'trak')], [1, 2])
+        trexs = moov.get(b'mvex').get_all(b'trex')
+        self.assertEqual([struct.unpack('>I', x.body[4:8])[0] for x in trexs],
+                         [1, 2])
+        self.assertEqual(moov.get(b'mvhd').get('next_track_id'), 3)
+
+    def test_mux_webms(self):
+        make_webm(self.path('video.webm'), 7, [0, 1000, 2000], 'v')
+        # the same track UID, which is changed
+        make_webm(self.path('audio.webm'), 7, [0, 500, 1000, 1500, 2000], 'a')
+        mux_webms([self.path('video.webm'), self.path('audio.webm')],
+                  self.path('muxed.webm'))
+
+        with open(self.path('muxed.webm'), 'rb') as f:
+            webm = WebM(f)
+            self.assertEqual(webm.track_numbers(), [1, 2])
+            self.assertEqual([read_uint(dict(x)[TRACK_UID])
+                              for x in webm.tracks], [7, 8])
+            self.assertEqual(struct.unpack('>d', webm.get_info(DURATION)),
+                             (2100,))
+            blocks = []
+            for _, offset, size, timecode in webm.clusters:
+                f.seek(offset)
+                body = dict(read_elements(f.read(size)))[CLUSTER]
+                block = dict(read_elements(body))[SIMPLE_BLOCK]
+                blocks.append((timecode, read_vint(BytesIO(block)),
+                               block[4:].decode()))
+            # the audio blocks come after the video of the same time
+            self.assertEqual(blocks, [
+                (0, 1, 'v0'), (0, 2, 'a0'), (500, 2, 'a1'), (1000, 1, 'v1'),
+                (1000, 2, 'a2'), (1500, 2, 'a3'), (2000, 1, 'v2'),
+                (2000, 2, 'a4'),
+            ])
+
+            # cues at the video clusters, by their positions in the segment
+            f.seek(0)
+            f.seek(read_element_header(f)[1], 1)
+            read_element_header(f)
+            segment_start = f.tell()
+            while True:
+                id, size = read_element_header(f)
+                if id == CUES:
+                    break
+                f.seek(size, 1)
+            positions = []
+            for id, body in read_elements(f.read(size)):
+                self.assertEqual(id, CUE_POINT)
+                cue = dict(read_elements(body))
+                cue = dict(read_elements(cue[CUE_TRACK_POSITIONS]))
+                positions.append(segment_start +
+                                 read_uint(cue[CUE_CLUSTER_POSITION]))
+            self.assertEqual(positions,
+                             [webm.clusters[i][1] for i in (0, 3, 6)])
+
+    def test_mux_mp4s(self):
+        video = make_samples('v', 10)
+        audio = make_samples('a', 12)
+        make_mp4(self.path('video.mp4'), [(b'vide', 1000, 40, video, None)])
+        make_mp4(self.path('audio.mp4'),
+                 [(b'soun', 44100, 1024, audio, None)], movie_time_scale=600)
+        mux_mp4s([self.path('video.mp4'), self.path('audio.mp4')],
+                 self.path('muxed.mp4'))
+
+        moov, types, tracks = read_tracks(self.path('muxed.mp4'))
+        self.assertEqual(types, [b'ftyp', b'moov', b'mdat'])
+        self.assertEqual(tracks, [video, audio])
+        self.assertEqual(moov.get(b'mvhd').get('duration'), 400)
+        self.assertEqual([x.get(b'tkhd').get('track_id')
+                          for x in moov.get_all(b'trak')], [1, 2])
+        self.assertEqual([x.get(b'tkhd').get('duration')
+                          for x in moov.get_all(b'trak')],
+                         [400, 12 * 1024 * 1000 // 44100])
+        # chunks of 4 samples start at 0, 0.16 and 0.32 seconds for the
+        # video, and at 0, 0.093 and 0.186 seconds for the audio
+        chunks = sorted((offset, i) for i, trak in
+                        enumerate(moov.get_all(b'trak'))
+                        for offset in get_stco(trak).body[1])
+        self.assertEqual([i for _, i in chunks], [0, 1, 1, 0, 1, 0])
+        with open(self.path('muxed.mp4'), 'rb') as f:
+            f.seek(chunks[0][0])
+            payload = f.read()
+        self.assertEqual(payload, b''.join(
+            video[:4] + audio[:8] + video[4:8] + audio[8:] + video[8:]
+        ))
+
+if __name__ == '__main__':
+    unittest.main()
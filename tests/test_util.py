@@ -1,8 +1,24 @@
 #!/usr/bin/env python
 
+import tempfile
+import time
 import unittest
+from http import client
 
+from you_get.util.cache import ResponseCache
+from you_get.util.dns import DNSCache
 from you_get.util.fs import *
+from you_get.util.journal import Journal
+from you_get.util.pool import ConnectionPool
+from you_get.util.ratelimit import TokenBucket, parse_rate
+from you_get.util.readsize import ReadSizer
+from you_get.util.retry import CircuitBreaker, CircuitOpenError, RetryPolicy
+from you_get.util.watchdog import StallWatchdog
+
+class FakeConnection:
+    sock = True
+    def close(self):
+        self.sock = None
 
 class TestUtil(unittest.TestCase):
     def test_legitimize(self):
@@ -10,3 +26,158 @@ class TestUtil(unittest.TestCase):
         self.assertEqual(legitimize("1*2", os="mac"), "1*2")
         self.assertEqual(legitimize("1*2", os="windows"), "1-2")
         self.assertEqual(legitimize("1*2", os="wsl"), "1-2")
+
+    def test_copy_range(self):
+        import io, os
+        data = os.urandom(200 * 1024)
+        with tempfile.TemporaryDirectory() as path:
+            with open(path + '/a', 'wb') as f:
+                f.write(data)
+            with open(path + '/a', 'rb') as source, \
+                 open(path + '/b', 'wb') as target:
+                source.seek(10)
+                target.write(b'x')
+                copy_range(source, target, len(data) - 20)
+                target.write(b'y')
+                self.assertEqual(source.tell(), len(data) - 10)
+            with open(path + '/b', 'rb') as f:
+                self.assertEqual(f.read(), b'x' + data[10:-10] + b'y')
+        target = io.BytesIO()
+        copy_range(io.BytesIO(data), target, len(data))
+        self.assertEqual(target.getvalue(), data)
+        self.assertRaises(AssertionError, copy_range,
+                          io.BytesIO(data), io.BytesIO(), len(data) + 1)
+
+    def test_connection_pool(self):
+        pool = ConnectionPool(max_per_host=1)
+        self.assertIsNone(pool.acquire('a'))
+        conn, extra = FakeConnection(), FakeConnection()
+        pool.release('a', conn)
+        pool.release('a', extra)
+        self.assertIsNone(extra.sock)
+        self.assertIs(pool.acquire('a'), conn)
+        pool.idle_timeout = -1
+        pool.release('a', conn)
+        self.assertIsNone(pool.acquire('a'))
+        self.assertEqual(pool.stats, {'new': 2, 'reused': 1})
+
+    def test_tls_session_cache(self):
+        import socket, ssl
+        from you_get.util.pool import SessionHTTPSConnection, TLSSessionCache
+        cache = TLSSessionCache()
+        secure, insecure = ssl.create_default_context(), \
+            ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        cache.set(secure, 'a', 'session')
+        self.assertEqual(cache.get(secure, 'a'), 'session')
+        self.assertIsNone(cache.get(insecure, 'a'))
+        # a connection whose handshake has failed still has a plain socket
+        conn = SessionHTTPSConnection('a', session_cache=cache,
+                                      context=insecure)
+        conn.sock = socket.socket()
+        conn.close()
+        self.assertIsNone(conn.sock)
+
+    def test_response_cache(self):
+        with tempfile.TemporaryDirectory() as path:
+            cache = ResponseCache(path, max_size=240)
+            headers = client.HTTPMessage()
+            headers['Content-Type'] = 'application/json'
+            headers['ETag'] = '"1"'
+            key = cache.key('GET', 'http://a/', {'Referer': 'http://b/'})
+            self.assertNotEqual(key, cache.key('GET', 'http://a/'))
+            cache.store(key, 'http://a/', headers, b'{}')
+            entry = cache.load(key)
+            self.assertTrue(entry.is_fresh())
+            self.assertEqual(entry.body, b'{}')
+            self.assertEqual(entry.validators(), {'If-None-Match': '"1"'})
+
+            headers.replace_header('Content-Type', 'video/mp4')
+            cache.store('media', 'http://a/v', headers, b'')
+            self.assertIsNone(cache.load('media'))
+
+            headers.replace_header('Content-Type', 'text/html')
+            cache.store('other', 'http://a/b', headers, b'x' * 30)
+            self.assertIsNone(cache.load(key))
+
+    def test_retry_policy(self):
+        from urllib.error import HTTPError
+        policy = RetryPolicy(retries=2, backoff=0, jitter=0)
+        breaker = CircuitBreaker(threshold=3)
+        attempts = []
+
+        def fail():
+            attempts.append(1)
+            raise ConnectionResetError()
+        self.assertRaises(ConnectionResetError, policy.call, fail, 'a', breaker)
+        self.assertEqual(len(attempts), 3)
+        self.assertRaises(CircuitOpenError, policy.call, fail, 'a', breaker)
+        self.assertEqual(len(attempts), 3)
+
+        headers = client.HTTPMessage()
+        headers['Retry-After'] = '5'
+        self.assertIsNone(policy.handle(HTTPError('', 404, '', headers, None), 0))
+        self.assertEqual(policy.handle(HTTPError('', 503, '', headers, None), 0), 5)
+
+        import io
+        bodies = []
+
+        def unavailable():
+            bodies.append(io.BytesIO())
+            raise HTTPError('', 503, '', client.HTTPMessage(), bodies[-1])
+        self.assertRaises(HTTPError, RetryPolicy(retries=1, backoff=0).call,
+                          unavailable)
+        self.assertTrue(bodies[0].closed)
+
+    def test_stall_watchdog(self):
+        watchdog = StallWatchdog(window=0.01, min_speed=1000)
+        self.assertFalse(watchdog.update(1))
+        time.sleep(0.02)
+        self.assertTrue(watchdog.update(1))
+        self.assertEqual(watchdog.stalls, 1)
+        self.assertFalse(StallWatchdog(window=0).update(0))
+
+    def test_rate_limit(self):
+        self.assertEqual(parse_rate('500K'), 500 * 1024)
+        self.assertEqual(parse_rate('1.5m'), 1536 * 1024)
+        self.assertRaises(ValueError, parse_rate, 'fast')
+        bucket = TokenBucket(1000)
+        self.assertEqual(bucket.reserve(1000), 0)
+        self.assertAlmostEqual(bucket.reserve(500), 0.5, places=2)
+        self.assertAlmostEqual(bucket.reserve(500), 1, places=2)
+
+    def test_dns_cache(self):
+        cache = DNSCache(ttl=60)
+        first = cache.getaddrinfo('127.0.0.1', 80)
+        self.assertEqual(cache.getaddrinfo('127.0.0.1', 80), first)
+        self.assertEqual(cache.stats, {'hits': 1, 'misses': 1})
+        cache.forget('127.0.0.1')
+        cache.prefetch([('127.0.0.1', 80)])
+        self.assertEqual(cache.stats, {'hits': 1, 'misses': 2})
+
+    def test_journal(self):
+        with tempfile.TemporaryDirectory() as path:
+            journal = Journal(path + '/a.journal', 100, etag='"x"')
+            journal.add_range(50, 60)
+            journal.add_range(0, 10)
+            journal.add_range(10, 20)
+            journal.save()
+            journal = Journal.load(path + '/a.journal')
+            self.assertEqual(journal.ranges, [[0, 20], [50, 60]])
+            self.assertEqual(journal.head(), 20)
+            self.assertEqual(journal.completed(), 30)
+            self.assertEqual(journal.missing(), [[20, 50], [60, 100]])
+            self.assertEqual(journal.validator(), '"x"')
+            self.assertTrue(journal.matches(100, {'ETag': '"x"'}))
+            self.assertFalse(journal.matches(100, {'ETag': '"y"'}))
+            self.assertFalse(journal.matches(99, {}))
+            journal.remove()
+            self.assertIsNone(Journal.load(path + '/a.journal'))
+
+    def test_read_sizer(self):
+        sizer = ReadSizer(min_size=1024, max_size=8192, target=1, interval=0)
+        self.assertEqual(len(sizer.view()), 8192)
+        time.sleep(0.01)
+        self.assertEqual(sizer.update(10), 1024)
+        time.sleep(0.01)
+        self.assertEqual(sizer.update(10 ** 6), 8192)
+        self.assertEqual(len(sizer.view()), 8192)